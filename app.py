@@ -1,132 +1,342 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Blueprint, Flask, current_app, g, render_template, request, jsonify, Response, stream_with_context
+import click
 import sqlite3
 import csv
-from datetime import datetime, date
+import functools
+import io
+import zlib
+from datetime import date, timedelta
 import os
 
-app = Flask(__name__)
-DATABASE = 'data/ontrack.db'
+import backup
+import batch
+import cache
+import clock
+import db
+import events
+import importer
+import metrics
+import migrations
+import overlaps
+import paging
+import responses
+import rollups
+import search
+import series
+import snapshot
+import streaks
+import sync
+import tenants
+import versions
+import writer
+from db import get_db
 
-def get_db():
-    """Connect to the SQLite database"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Routes and CLI commands live on a blueprint so create_app() can build
+# independent app instances
+bp = Blueprint('ontrack', __name__, cli_group=None)
 
 def init_db():
-    """Initialize the database with required tables"""
+    """Initialize the database, applying any pending schema migrations"""
+    return migrations.migrate(get_db())
+
+def setup_database(app):
+    """Create the database directory and apply migrations once, outside any request
+    
+    Run this in the process that starts the server, before workers fork, so
+    migrations are not raced by every worker and no connection is inherited.
+    """
+    os.makedirs(os.path.dirname(app.config['DATABASE']) or '.', exist_ok=True)
+    with app.app_context():
+        applied = init_db()
+    tenants.migrate_all(app)
+    db.close_pools(app)
+    return applied
+
+def tenant_option(command):
+    """Give a CLI command --tenant, to run it against that tenant's shard instead of DATABASE"""
+    @click.option('--tenant', help='Tenant whose shard to use (needs ONTRACK_TENANT_DIR)')
+    @functools.wraps(command)
+    def wrapper(*args, tenant=None, **kwargs):
+        if tenant is not None:
+            try:
+                tenants.use(tenant)
+            except tenants.InvalidTenant as e:
+                raise click.ClickException(str(e))
+        return command(*args, **kwargs)
+    return wrapper
+
+@bp.cli.command('init-db')
+@tenant_option
+def init_db_command():
+    """Create the database or bring an existing one up to date"""
+    os.makedirs(os.path.dirname(current_app.config['DATABASE']) or '.', exist_ok=True)
+    applied = init_db()
+    print(f'Applied migrations: {applied}' if applied else 'Database is up to date')
+
+@bp.cli.command('check-indexes')
+@tenant_option
+def check_indexes_command():
+    """Verify that the hot queries are planned against their indexes"""
+    failures = migrations.check_indexes(get_db())
+    for sql, index, plan in failures:
+        print(f'{index} not used by: {sql}\n  plan: {plan}')
+    if failures:
+        raise SystemExit(1)
+    print(f'All {len(migrations.INDEX_CHECKS)} queries use their indexes')
+
+@bp.cli.command('rebuild-rollups')
+@tenant_option
+def rebuild_rollups_command():
+    """Recompute the analytics rollup tables from raw rows"""
     conn = get_db()
     cursor = conn.cursor()
+    # Streaks are rebuilt once at the end rather than by their triggers row by row
+    conn.execute('BEGIN IMMEDIATE')
+    streaks.drop_triggers(cursor)
+    rollups.rebuild(cursor)
+    streaks.rebuild(cursor)
+    streaks.create_triggers(cursor)
+    conn.commit()
+    print('Rollup tables rebuilt')
+
+@bp.cli.command('compact-changes')
+@tenant_option
+@click.option('--days', type=int, default=sync.TOMBSTONE_DAYS, show_default=True,
+              help='Keep tombstones for deleted rows this many days')
+def compact_changes_command(days):
+    """Drop old tombstones from the sync change log"""
+    conn = get_db()
+    dropped = sync.compact(conn.cursor(), days)
+    conn.commit()
+    print(f'Dropped {dropped} tombstones older than {days} days')
+
+@bp.cli.command('backup')
+@tenant_option
+def backup_command():
+    """Back up the database, or every tenant's shard, into BACKUP_DIR while the app keeps running"""
+    if 'tenant' in g:
+        results = [backup.run(current_app, g.database, g.tenant)]
+    else:
+        results = backup.run_all(current_app)
+    for result in results:
+        print(f"Backed up {result['database_bytes']} bytes to {result['path']} in {result['seconds']} s")
+        for name in result['pruned']:
+            print(f'Removed old backup {name}')
+
+@bp.cli.command('restore-backup')
+@tenant_option
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def restore_backup_command(path):
+    """Replace the database's contents with a backup, then restart the server"""
+    try:
+        backup.restore(db.database_path(), path)
+    except backup.InvalidBackup as e:
+        raise click.ClickException(str(e))
+    # The backup may predate the current schema
+    applied = init_db()
+    print(f'Restored {path}' + (f', applied migrations: {applied}' if applied else ''))
+
+@bp.cli.command('rebuild-streaks')
+@tenant_option
+def rebuild_streaks_command():
+    """Recompute every habit's streaks from the daily rollup"""
+    conn = get_db()
+    streaks.rebuild(conn.cursor())
+    conn.commit()
+    print('Habit streaks rebuilt')
+
+def streak_columns(alias='s'):
+    """SELECT columns for a LEFT JOINed habit_streaks row, plus the date param they need
     
-    # Habits table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS habits (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            habit_type TEXT NOT NULL,
-            target_hours INTEGER,
-            target_value INTEGER,
-            target_type TEXT DEFAULT 'binary',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Habit logs table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS habit_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            habit_id INTEGER,
-            log_date DATE NOT NULL,
-            hours_spent REAL,
-            value INTEGER,
-            completed BOOLEAN,
-            completion_percentage INTEGER,
-            notes TEXT,
-            FOREIGN KEY (habit_id) REFERENCES habits (id)
-        )
-    ''')
-    
-    # Categories table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS categories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL UNIQUE,
-            color TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Tasks table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tasks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL UNIQUE,
-            category_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (category_id) REFERENCES categories (id)
-        )
-    ''')
-    
-    # Time blocks table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS time_blocks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            block_date DATE NOT NULL,
-            start_time TEXT NOT NULL,
-            end_time TEXT NOT NULL,
-            activity TEXT NOT NULL,
-            duration_minutes INTEGER,
-            category_id INTEGER,
-            task_id INTEGER,
-            FOREIGN KEY (category_id) REFERENCES categories (id),
-            FOREIGN KEY (task_id) REFERENCES tasks (id)
-        )
-    ''')
+    A streak is still current if its last completed day is today or
+    yesterday, since today may not have been logged yet.
+    """
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    return f'''
+        CASE WHEN {alias}.last_completed_date >= ? THEN {alias}.current_streak ELSE 0 END as current_streak,
+        COALESCE({alias}.longest_streak, 0) as longest_streak,
+        {alias}.last_completed_date''', [yesterday]
+
+def found(row, name):
+    """JSON for a single row, or 404 when there is none"""
+    if row is None:
+        return jsonify({'success': False, 'error': f'{name} not found'}), 404
+    return jsonify(dict(row))
+
+def conditional(*tables):
+    """Serve GETs with a strong ETag built from the tables' change counters
     
-    conn.commit()
-    conn.close()
+    A matching If-None-Match gets 304 Not Modified without running the view.
+    Gzipped responses carry the same ETag as a weak one (see responses.py).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+            
+            # Tenants' shards have counters of their own, so the database is part of the key
+            etag = versions.etag(get_db(), tables, db.database_path() + request.full_path)
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+            response.set_etag(etag)
+            # Let browsers keep the body but revalidate before reusing it
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+def requested_range():
+    """The request's start_date and end_date, today by default, checked like every date parameter"""
+    today = date.today().isoformat()
+    start_date = request.args.get('start_date', today)
+    end_date = request.args.get('end_date', today)
+    clock.parse_date(start_date)
+    clock.parse_date(end_date)
+    return start_date, end_date
+
+def cached(*tables):
+    """Serve an analytics GET from the result cache, keyed by its date range
+    
+    Entries are dropped when a write touches one of the tables on a day
+    inside the range; see cache.py.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            results = cache.get_cache()
+            if not results.max_bytes:
+                return view(*args, **kwargs)
+            
+            today = date.today().isoformat()
+            start_date = request.args.get('start_date', today)
+            end_date = request.args.get('end_date', today)
+            # Today is part of the key since streaks and default ranges depend on it
+            key = (request.path, today, start_date, end_date, tuple(sorted(request.args.items(multi=True))))
+            seq = results.sync(get_db())
+            body = results.get(key)
+            if body is not None:
+                return current_app.response_class(body, mimetype='application/json')
+            
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                results.put(key, response.get_data(), tables, start_date, end_date, seq)
+            return response
+        return wrapper
+    return decorator
+
+@bp.errorhandler(paging.InvalidCursor)
+def invalid_cursor(e):
+    return jsonify({'success': False, 'error': str(e)}), 400
+
+@bp.errorhandler(clock.InvalidDate)
+def invalid_date(e):
+    return jsonify({'success': False, 'error': str(e)}), 400
+
+@bp.errorhandler(sync.InvalidToken)
+def invalid_sync_token(e):
+    return jsonify({'success': False, 'error': str(e)}), 400
+
+@bp.errorhandler(search.InvalidQuery)
+def invalid_search(e):
+    return jsonify({'success': False, 'error': str(e)}), 400
+
+@bp.errorhandler(backup.BackupBusy)
+def backup_busy(e):
+    return jsonify({'success': False, 'error': str(e)}), 409
+
+@bp.errorhandler(responses.InvalidShape)
+def invalid_shape(e):
+    return jsonify({'success': False, 'error': str(e)}), 400
 
-@app.route('/')
+@bp.errorhandler(overlaps.InvalidMode)
+def invalid_overlap_mode(e):
+    return jsonify({'success': False, 'error': str(e)}), 400
+
+@bp.errorhandler(overlaps.OverlapError)
+def overlapping_block(e):
+    return jsonify({'success': False, 'error': str(e), 'overlaps': e.blocks}), 409
+
+@bp.route('/')
 def index():
     """Main dashboard"""
     return render_template('index.html')
 
-@app.route('/api/habits', methods=['GET', 'POST'])
+@bp.route('/api/habits', methods=['GET', 'POST'])
+@conditional('habits', 'habit_logs')
 def habits():
-    """Get all habits or create a new habit"""
+    """Get all habits with their progress totals or create a new habit"""
     conn = get_db()
     cursor = conn.cursor()
     
     if request.method == 'POST':
         data = request.json
-        cursor.execute('''
+        habit_id = writer.execute(('''
             INSERT INTO habits (name, habit_type, target_hours, target_value, target_type)
             VALUES (?, ?, ?, ?, ?)
         ''', (data['name'], data['habit_type'], data.get('target_hours'), 
-              data.get('target_value'), data.get('target_type', 'binary')))
-        conn.commit()
-        habit_id = cursor.lastrowid
-        conn.close()
+              data.get('target_value'), data.get('target_type', 'binary'))))
         return jsonify({'id': habit_id, 'success': True})
     
+    elif paging.requested():
+        # Newest first like the full list; totals come from the daily rollup
+        limit = paging.page_size()
+        after, params = paging.after(('h.id',), descending=True)
+        streak, streak_params = streak_columns()
+        cursor.execute(f'''
+            SELECT h.*, 
+                   (SELECT COALESCE(SUM(r.total_hours), 0) FROM habit_daily r WHERE r.habit_id = h.id) as total_hours,
+                   {streak}
+            FROM habits h
+            LEFT JOIN habit_streaks s ON s.habit_id = h.id
+            WHERE {after}
+            ORDER BY h.id DESC
+            LIMIT ?
+        ''', streak_params + params + [limit + 1])
+        habits, next_cursor = paging.fetch_page(cursor, limit, ('id',))
+        return jsonify({'habits': habits, 'next_cursor': next_cursor})
+    
     else:
-        cursor.execute('SELECT * FROM habits ORDER BY created_at DESC')
+        # Progress totals from the daily rollup, as in the paged branch
+        streak, streak_params = streak_columns()
+        cursor.execute(f'''
+            SELECT h.*, 
+                   (SELECT COALESCE(SUM(r.total_hours), 0) FROM habit_daily r WHERE r.habit_id = h.id) as total_hours,
+                   {streak}
+            FROM habits h
+            LEFT JOIN habit_streaks s ON s.habit_id = h.id
+            ORDER BY h.created_at DESC
+        ''', streak_params)
         habits = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         return jsonify(habits)
 
-@app.route('/api/habits/<int:habit_id>', methods=['DELETE'])
-def delete_habit(habit_id):
-    """Delete a habit"""
+@bp.route('/api/habits/<int:habit_id>', methods=['GET', 'DELETE'])
+@conditional('habits', 'habit_logs')
+def edit_habit(habit_id):
+    """Get one habit as listed by /api/habits, or delete it"""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('DELETE FROM habits WHERE id = ?', (habit_id,))
-    cursor.execute('DELETE FROM habit_logs WHERE habit_id = ?', (habit_id,))
-    conn.commit()
-    conn.close()
+    
+    if request.method == 'GET':
+        streak, streak_params = streak_columns()
+        cursor.execute(f'''
+            SELECT h.*, 
+                   (SELECT COALESCE(SUM(r.total_hours), 0) FROM habit_daily r WHERE r.habit_id = h.id) as total_hours,
+                   {streak}
+            FROM habits h
+            LEFT JOIN habit_streaks s ON s.habit_id = h.id
+            WHERE h.id = ?
+        ''', streak_params + [habit_id])
+        return found(cursor.fetchone(), 'Habit')
+    
+    writer.execute(('DELETE FROM habits WHERE id = ?', (habit_id,)),
+                   ('DELETE FROM habit_logs WHERE habit_id = ?', (habit_id,)))
     return jsonify({'success': True})
 
-@app.route('/api/habit-logs', methods=['GET', 'POST'])
+@bp.route('/api/habit-logs', methods=['GET', 'POST'])
+@conditional('habit_logs', 'habits')
 def habit_logs():
     """Get habit logs or create a new log entry"""
     conn = get_db()
@@ -134,55 +344,80 @@ def habit_logs():
     
     if request.method == 'POST':
         data = request.json
-        cursor.execute('''
-            INSERT INTO habit_logs (habit_id, log_date, hours_spent, value, completed, completion_percentage, notes)
+        log_id = writer.execute(('''
+            INSERT INTO habit_logs (habit_id, day, hours_spent, value, completed, completion_percentage, notes)
             VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (data['habit_id'], data['log_date'], data.get('hours_spent'), 
+        ''', (data['habit_id'], clock.day(data['log_date']), data.get('hours_spent'), 
               data.get('value'), data.get('completed', False), 
-              data.get('completion_percentage'), data.get('notes', '')))
-        conn.commit()
-        log_id = cursor.lastrowid
-        conn.close()
+              data.get('completion_percentage'), data.get('notes', ''))))
         return jsonify({'id': log_id, 'success': True})
     
+    elif any(arg in request.args for arg in ('start_date', 'end_date', 'cursor')):
+        # Date range, a page at a time in idx_habit_logs_day_habit order
+        limit = paging.page_size()
+        after, after_params = paging.after(('hl.day', 'hl.habit_id', 'hl.id'))
+        where, params = date_range_filter('hl.day', [after], after_params)
+        cursor.execute(f'''
+            SELECT hl.id, hl.habit_id, hl.log_date, hl.hours_spent, hl.value, hl.completed,
+                   hl.completion_percentage, hl.notes, hl.day,
+                   h.name, h.habit_type, h.target_hours, h.target_value, h.target_type
+            FROM habit_logs hl
+            JOIN habits h ON hl.habit_id = h.id
+            {where}
+            ORDER BY hl.day, hl.habit_id, hl.id
+            LIMIT ?
+        ''', params + [limit + 1])
+        logs, next_cursor = paging.fetch_page(cursor, limit, ('day', 'habit_id', 'id'), hidden=('day',))
+        return jsonify({'logs': logs, 'next_cursor': next_cursor})
+    
     else:
         log_date = request.args.get('date', date.today().isoformat())
         cursor.execute('''
-            SELECT hl.*, h.name, h.habit_type, h.target_hours, h.target_value, h.target_type
+            SELECT hl.id, hl.habit_id, hl.log_date, hl.hours_spent, hl.value, hl.completed,
+                   hl.completion_percentage, hl.notes,
+                   h.name, h.habit_type, h.target_hours, h.target_value, h.target_type
             FROM habit_logs hl
             JOIN habits h ON hl.habit_id = h.id
-            WHERE hl.log_date = ?
+            WHERE hl.day = ?
             ORDER BY hl.id DESC
-        ''', (log_date,))
+        ''', (clock.day(log_date),))
         logs = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         return jsonify(logs)
 
-@app.route('/api/habit-logs/<int:log_id>', methods=['PUT', 'DELETE'])
+@bp.route('/api/habit-logs/<int:log_id>', methods=['GET', 'PUT', 'DELETE'])
+@conditional('habit_logs', 'habits')
 def edit_habit_log(log_id):
-    """Edit or delete a habit log entry"""
+    """Get, edit or delete a habit log entry"""
     conn = get_db()
     cursor = conn.cursor()
     
-    if request.method == 'PUT':
-        data = request.json
+    if request.method == 'GET':
         cursor.execute('''
+            SELECT hl.id, hl.habit_id, hl.log_date, hl.hours_spent, hl.value, hl.completed,
+                   hl.completion_percentage, hl.notes,
+                   h.name, h.habit_type, h.target_hours, h.target_value, h.target_type
+            FROM habit_logs hl
+            JOIN habits h ON hl.habit_id = h.id
+            WHERE hl.id = ?
+        ''', (log_id,))
+        return found(cursor.fetchone(), 'Habit log')
+    
+    elif request.method == 'PUT':
+        data = request.json
+        writer.execute(('''
             UPDATE habit_logs 
             SET hours_spent = ?, value = ?, completed = ?, completion_percentage = ?, notes = ?
             WHERE id = ?
         ''', (data.get('hours_spent'), data.get('value'), data.get('completed', False), 
-              data.get('completion_percentage'), data.get('notes', ''), log_id))
-        conn.commit()
-        conn.close()
+              data.get('completion_percentage'), data.get('notes', ''), log_id)))
         return jsonify({'success': True})
     
     elif request.method == 'DELETE':
-        cursor.execute('DELETE FROM habit_logs WHERE id = ?', (log_id,))
-        conn.commit()
-        conn.close()
+        writer.execute(('DELETE FROM habit_logs WHERE id = ?', (log_id,)))
         return jsonify({'success': True})
 
-@app.route('/api/habit-progress/<int:habit_id>')
+@bp.route('/api/habit-progress/<int:habit_id>')
+@conditional('habits', 'habit_logs')
 def habit_progress(habit_id):
     """Get total progress for a project-based habit"""
     conn = get_db()
@@ -194,11 +429,10 @@ def habit_progress(habit_id):
         WHERE h.id = ?
         GROUP BY h.id
     ''', (habit_id,))
-    result = dict(cursor.fetchone())
-    conn.close()
-    return jsonify(result)
+    return found(cursor.fetchone(), 'Habit')
 
-@app.route('/api/categories', methods=['GET', 'POST'])
+@bp.route('/api/categories', methods=['GET', 'POST'])
+@conditional('categories')
 def categories():
     """Get all categories or create a new category"""
     conn = get_db()
@@ -207,61 +441,58 @@ def categories():
     if request.method == 'POST':
         data = request.json
         try:
-            cursor.execute('''
+            category_id = writer.execute(('''
                 INSERT INTO categories (name, color)
                 VALUES (?, ?)
-            ''', (data['name'], data.get('color', '#667eea')))
-            conn.commit()
-            category_id = cursor.lastrowid
-            conn.close()
+            ''', (data['name'], data.get('color', '#667eea'))))
             return jsonify({'id': category_id, 'success': True})
         except sqlite3.IntegrityError:
-            conn.close()
             return jsonify({'success': False, 'error': 'Category already exists'}), 400
     
     else:
         cursor.execute('SELECT * FROM categories ORDER BY name')
         categories = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         return jsonify(categories)
 
-@app.route('/api/categories/<int:category_id>', methods=['PUT', 'DELETE'])
+@bp.route('/api/categories/<int:category_id>', methods=['GET', 'PUT', 'DELETE'])
+@conditional('categories')
 def edit_category(category_id):
-    """Edit or delete a category"""
+    """Get, edit or delete a category"""
     conn = get_db()
     cursor = conn.cursor()
     
-    if request.method == 'PUT':
+    if request.method == 'GET':
+        cursor.execute('SELECT * FROM categories WHERE id = ?', (category_id,))
+        return found(cursor.fetchone(), 'Category')
+    
+    elif request.method == 'PUT':
         data = request.json
         try:
-            cursor.execute('''
+            writer.execute(('''
                 UPDATE categories 
                 SET name = ?, color = ?
                 WHERE id = ?
-            ''', (data['name'], data.get('color', '#667eea'), category_id))
-            conn.commit()
-            conn.close()
+            ''', (data['name'], data.get('color', '#667eea'), category_id)))
             return jsonify({'success': True})
         except sqlite3.IntegrityError:
-            conn.close()
             return jsonify({'success': False, 'error': 'Category name already exists'}), 400
     
     elif request.method == 'DELETE':
-        # Check if category is being used
-        cursor.execute('SELECT COUNT(*) as count FROM time_blocks WHERE category_id = ?', (category_id,))
-        count = cursor.fetchone()['count']
+        def delete(conn):
+            # Check if category is being used, in the same transaction as the delete
+            count = conn.execute('SELECT COUNT(*) FROM time_blocks WHERE category_id = ?', (category_id,)).fetchone()[0]
+            if count == 0:
+                conn.execute('DELETE FROM categories WHERE id = ?', (category_id,))
+                conn.execute('DELETE FROM tasks WHERE category_id = ?', (category_id,))
+            return count
         
+        count = writer.run(delete)
         if count > 0:
-            conn.close()
             return jsonify({'success': False, 'error': f'Cannot delete. {count} time blocks use this category.'}), 400
-        
-        cursor.execute('DELETE FROM categories WHERE id = ?', (category_id,))
-        cursor.execute('DELETE FROM tasks WHERE category_id = ?', (category_id,))
-        conn.commit()
-        conn.close()
         return jsonify({'success': True})
 
-@app.route('/api/tasks', methods=['GET', 'POST'])
+@bp.route('/api/tasks', methods=['GET', 'POST'])
+@conditional('tasks', 'categories')
 def tasks():
     """Get all tasks or create a new task"""
     conn = get_db()
@@ -270,18 +501,32 @@ def tasks():
     if request.method == 'POST':
         data = request.json
         try:
-            cursor.execute('''
+            task_id = writer.execute(('''
                 INSERT INTO tasks (name, category_id)
                 VALUES (?, ?)
-            ''', (data['name'], data.get('category_id')))
-            conn.commit()
-            task_id = cursor.lastrowid
-            conn.close()
+            ''', (data['name'], data.get('category_id'))))
             return jsonify({'id': task_id, 'success': True})
         except sqlite3.IntegrityError:
-            conn.close()
             return jsonify({'success': False, 'error': 'Task already exists'}), 400
     
+    elif paging.requested():
+        # Alphabetical on the unique name index
+        limit = paging.page_size()
+        after, params = paging.after(('t.name',))
+        if request.args.get('category_id'):
+            after += ' AND t.category_id = ?'
+            params.append(request.args['category_id'])
+        cursor.execute(f'''
+            SELECT t.*, c.name as category_name, c.color as category_color
+            FROM tasks t
+            LEFT JOIN categories c ON t.category_id = c.id
+            WHERE {after}
+            ORDER BY t.name
+            LIMIT ?
+        ''', params + [limit + 1])
+        tasks, next_cursor = paging.fetch_page(cursor, limit, ('name',))
+        return jsonify({'tasks': tasks, 'next_cursor': next_cursor})
+    
     else:
         category_id = request.args.get('category_id')
         if category_id:
@@ -300,45 +545,51 @@ def tasks():
                 ORDER BY c.name, t.name
             ''')
         tasks = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         return jsonify(tasks)
 
-@app.route('/api/tasks/<int:task_id>', methods=['PUT', 'DELETE'])
+@bp.route('/api/tasks/<int:task_id>', methods=['GET', 'PUT', 'DELETE'])
+@conditional('tasks', 'categories')
 def edit_task(task_id):
-    """Edit or delete a task"""
+    """Get, edit or delete a task"""
     conn = get_db()
     cursor = conn.cursor()
     
-    if request.method == 'PUT':
+    if request.method == 'GET':
+        cursor.execute('''
+            SELECT t.*, c.name as category_name, c.color as category_color
+            FROM tasks t
+            LEFT JOIN categories c ON t.category_id = c.id
+            WHERE t.id = ?
+        ''', (task_id,))
+        return found(cursor.fetchone(), 'Task')
+    
+    elif request.method == 'PUT':
         data = request.json
         try:
-            cursor.execute('''
+            writer.execute(('''
                 UPDATE tasks 
                 SET name = ?, category_id = ?
                 WHERE id = ?
-            ''', (data['name'], data.get('category_id'), task_id))
-            conn.commit()
-            conn.close()
+            ''', (data['name'], data.get('category_id'), task_id)))
             return jsonify({'success': True})
         except sqlite3.IntegrityError:
-            conn.close()
             return jsonify({'success': False, 'error': 'Task name already exists'}), 400
     
     elif request.method == 'DELETE':
-        # Check if task is being used
-        cursor.execute('SELECT COUNT(*) as count FROM time_blocks WHERE task_id = ?', (task_id,))
-        count = cursor.fetchone()['count']
+        def delete(conn):
+            # Check if task is being used, in the same transaction as the delete
+            count = conn.execute('SELECT COUNT(*) FROM time_blocks WHERE task_id = ?', (task_id,)).fetchone()[0]
+            if count == 0:
+                conn.execute('DELETE FROM tasks WHERE id = ?', (task_id,))
+            return count
         
+        count = writer.run(delete)
         if count > 0:
-            conn.close()
             return jsonify({'success': False, 'error': f'Cannot delete. {count} time blocks use this task.'}), 400
-        
-        cursor.execute('DELETE FROM tasks WHERE id = ?', (task_id,))
-        conn.commit()
-        conn.close()
         return jsonify({'success': True})
 
-@app.route('/api/time-blocks', methods=['GET', 'POST'])
+@bp.route('/api/time-blocks', methods=['GET', 'POST'])
+@conditional('time_blocks', 'categories', 'tasks')
 def time_blocks():
     """Get time blocks or create a new time block"""
     conn = get_db()
@@ -346,117 +597,309 @@ def time_blocks():
     
     if request.method == 'POST':
         data = request.json
+        mode = overlaps.requested_mode(data)
+        day = clock.day(data['block_date'])
+        start_minute, end_minute = clock.span(data['start_time'], data['end_time'])
+        fields = (data['activity'], data.get('category_id'), data.get('task_id'))
         
-        # Calculate duration in minutes
-        start = datetime.strptime(data['start_time'], '%H:%M')
-        end = datetime.strptime(data['end_time'], '%H:%M')
-        duration = int((end - start).total_seconds() / 60)
+        # Check and write in one job so two requests can't both fill a gap
+        def insert(conn):
+            cursor = conn.cursor()
+            pieces, merged = overlaps.place(cursor, mode, day, start_minute, end_minute)
+            ids = []
+            for piece in pieces:
+                cursor.execute('''
+                    INSERT INTO time_blocks (day, start_minute, end_minute, activity, category_id, task_id)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', piece + fields)
+                ids.append(cursor.lastrowid)
+            return ids, merged
         
-        cursor.execute('''
-            INSERT INTO time_blocks (block_date, start_time, end_time, activity, duration_minutes, category_id, task_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (data['block_date'], data['start_time'], data['end_time'], 
-              data['activity'], duration, data.get('category_id'), data.get('task_id')))
-        conn.commit()
-        block_id = cursor.lastrowid
-        conn.close()
-        return jsonify({'id': block_id, 'success': True})
+        ids, merged = writer.run(insert)
+        return jsonify({'id': ids[0], 'ids': ids, 'merged': merged, 'success': True})
+    
+    elif any(arg in request.args for arg in ('start_date', 'end_date', 'cursor')):
+        # Date range, a page at a time in idx_time_blocks_day_start order
+        limit = paging.page_size()
+        after, after_params = paging.after(('tb.day', 'tb.start_minute', 'tb.id'))
+        where, params = date_range_filter('tb.day', [after], after_params)
+        cursor.execute(f'''
+            SELECT tb.id, tb.block_date, tb.start_time, tb.end_time, tb.activity, tb.duration_minutes,
+                   tb.category_id, tb.task_id, tb.day, tb.start_minute,
+                   c.name as category_name, c.color as category_color, t.name as task_name
+            FROM time_blocks tb
+            LEFT JOIN categories c ON tb.category_id = c.id
+            LEFT JOIN tasks t ON tb.task_id = t.id
+            {where}
+            ORDER BY tb.day, tb.start_minute, tb.id
+            LIMIT ?
+        ''', params + [limit + 1])
+        blocks, next_cursor = paging.fetch_page(cursor, limit, ('day', 'start_minute', 'id'),
+                                                hidden=('day', 'start_minute'))
+        return jsonify({'blocks': responses.shaped(blocks), 'next_cursor': next_cursor})
     
     else:
         block_date = request.args.get('date', date.today().isoformat())
         cursor.execute('''
-            SELECT tb.*, c.name as category_name, c.color as category_color, t.name as task_name
+            SELECT tb.id, tb.block_date, tb.start_time, tb.end_time, tb.activity, tb.duration_minutes,
+                   tb.category_id, tb.task_id,
+                   c.name as category_name, c.color as category_color, t.name as task_name
             FROM time_blocks tb
             LEFT JOIN categories c ON tb.category_id = c.id
             LEFT JOIN tasks t ON tb.task_id = t.id
-            WHERE tb.block_date = ?
-            ORDER BY tb.start_time
-        ''', (block_date,))
+            WHERE tb.day = ?
+            ORDER BY tb.start_minute
+        ''', (clock.day(block_date),))
         blocks = [dict(row) for row in cursor.fetchall()]
         
         # Calculate total time tracked
         total_minutes = sum(block['duration_minutes'] for block in blocks)
-        conn.close()
         return jsonify({
-            'blocks': blocks,
+            'blocks': responses.shaped(blocks),
             'total_minutes': total_minutes,
             'total_hours': round(total_minutes / 60, 2)
         })
 
-@app.route('/api/time-blocks/<int:block_id>', methods=['PUT', 'DELETE'])
+def run_batch(insert_items, key):
+    """Run a batch inserter on the request's items inside one transaction
+    
+    The body is a JSON array of items or an object holding them under `key`.
+    With "atomic": true nothing is written unless every item succeeds.
+    """
+    data = request.get_json(silent=True)
+    atomic = False
+    if isinstance(data, dict):
+        atomic = bool(data.get('atomic', False))
+        data = data.get(key)
+    if not isinstance(data, list):
+        return jsonify({'success': False, 'error': f'Expected a list of items or an object with "{key}"'}), 400
+    if len(data) > batch.MAX_ITEMS:
+        return jsonify({'success': False, 'error': f'At most {batch.MAX_ITEMS} items per batch'}), 400
+    
+    def insert(conn):
+        result = insert_items(conn, data)
+        if atomic and result.error_count:
+            result.rollback()
+            raise writer.Rollback(result)
+        return result
+    
+    try:
+        result = writer.run(insert)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    if atomic and result.error_count:
+        return jsonify(result.to_dict()), 400
+    return jsonify(result.to_dict())
+
+@bp.route('/api/time-blocks/batch', methods=['POST'])
+def time_blocks_batch():
+    """Create many time blocks in one transaction"""
+    mode = overlaps.requested_mode(request.get_json(silent=True))
+    return run_batch(functools.partial(batch.insert_time_blocks, overlap=mode), 'blocks')
+
+@bp.route('/api/habit-logs/batch', methods=['POST'])
+def habit_logs_batch():
+    """Create many habit log entries in one transaction"""
+    return run_batch(batch.insert_habit_logs, 'logs')
+
+@bp.route('/api/time-blocks/overlaps')
+@conditional('time_blocks')
+def time_block_overlaps():
+    """List overlapping time blocks in a date range and the minutes they double count"""
+    pairs, days = overlaps.day_overlaps(get_db().cursor(), request.args.get('start_date'),
+                                        request.args.get('end_date'))
+    return jsonify({
+        'overlaps': pairs,
+        'days': days,
+        'double_counted_minutes': sum(day['double_counted_minutes'] for day in days)
+    })
+
+@bp.route('/api/events')
+def event_stream():
+    """Stream change events as Server-Sent Events; see events.py"""
+    messages = events.stream(events.requested_since())
+    broker = events.get_broker()
+    if not broker.open_stream():
+        # Every stream holds a request thread; refuse rather than starve the other routes
+        return jsonify({'success': False, 'error': 'Too many open event streams'}), 503, {'Retry-After': '30'}
+    response = Response(messages, mimetype='text/event-stream')
+    response.call_on_close(broker.close_stream)
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx and similar proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@bp.route('/api/search')
+@conditional('time_blocks', 'habit_logs', 'categories', 'tasks', 'habits')
+def search_text():
+    """Ranked full-text search over time block activities and habit log notes; see search.py"""
+    filters = search.requested_filters()
+    limit = paging.page_size()
+    results = search.run(get_db().cursor(), request.args.get('q'), limit, filters)
+    return jsonify({'results': results})
+
+@bp.route('/api/sync')
+def sync_changes():
+    """Rows changed since a sync token, and the ids of deleted ones; see sync.py"""
+    since = sync.parse_token(request.args.get('since'))
+    limit = paging.page_size()
+    conn = get_db()
+    # One read transaction, so every row is as of the log entries it was listed from
+    conn.execute('BEGIN')
+    try:
+        result = sync.changes_since(conn.cursor(), since, limit)
+    finally:
+        conn.rollback()
+    return jsonify(result)
+
+@bp.route('/api/time-blocks/<int:block_id>', methods=['GET', 'PUT', 'DELETE'])
+@conditional('time_blocks', 'categories', 'tasks')
 def edit_time_block(block_id):
-    """Edit or delete a time block"""
+    """Get, edit or delete a time block"""
     conn = get_db()
     cursor = conn.cursor()
     
-    if request.method == 'PUT':
+    if request.method == 'GET':
+        cursor.execute('''
+            SELECT tb.id, tb.block_date, tb.start_time, tb.end_time, tb.activity, tb.duration_minutes,
+                   tb.category_id, tb.task_id,
+                   c.name as category_name, c.color as category_color, t.name as task_name
+            FROM time_blocks tb
+            LEFT JOIN categories c ON tb.category_id = c.id
+            LEFT JOIN tasks t ON tb.task_id = t.id
+            WHERE tb.id = ?
+        ''', (block_id,))
+        return found(cursor.fetchone(), 'Time block')
+    
+    elif request.method == 'PUT':
         data = request.json
+        mode = overlaps.requested_mode(data)
         
-        # Calculate duration in minutes
-        start = datetime.strptime(data['start_time'], '%H:%M')
-        end = datetime.strptime(data['end_time'], '%H:%M')
-        duration = int((end - start).total_seconds() / 60)
+        start_minute, end_minute = clock.span(data['start_time'], data['end_time'])
+        fields = (data['activity'], data.get('category_id'), data.get('task_id'))
         
-        cursor.execute('''
-            UPDATE time_blocks 
-            SET start_time = ?, end_time = ?, activity = ?, duration_minutes = ?, category_id = ?, task_id = ?
-            WHERE id = ?
-        ''', (data['start_time'], data['end_time'], data['activity'], duration, 
-              data.get('category_id'), data.get('task_id'), block_id))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True})
+        def update(conn):
+            cursor = conn.cursor()
+            cursor.execute('SELECT day FROM time_blocks WHERE id = ?', (block_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            
+            # The block keeps the first piece; trimming around others adds the rest as new blocks
+            pieces, merged = overlaps.place(cursor, mode, row['day'], start_minute, end_minute, exclude_id=block_id)
+            ids = [block_id]
+            for i, piece in enumerate(pieces):
+                if i == 0:
+                    cursor.execute('''
+                        UPDATE time_blocks 
+                        SET day = ?, start_minute = ?, end_minute = ?, activity = ?, category_id = ?, task_id = ?
+                        WHERE id = ?
+                    ''', piece + fields + (block_id,))
+                else:
+                    cursor.execute('''
+                        INSERT INTO time_blocks (day, start_minute, end_minute, activity, category_id, task_id)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', piece + fields)
+                    ids.append(cursor.lastrowid)
+            return ids, merged
+        
+        placed = writer.run(update)
+        if placed is None:
+            return jsonify({'success': False, 'error': 'Time block not found'}), 404
+        ids, merged = placed
+        return jsonify({'ids': ids, 'merged': merged, 'success': True})
     
     elif request.method == 'DELETE':
-        cursor.execute('DELETE FROM time_blocks WHERE id = ?', (block_id,))
-        conn.commit()
-        conn.close()
+        writer.execute(('DELETE FROM time_blocks WHERE id = ?', (block_id,)))
         return jsonify({'success': True})
 
-@app.route('/export/habits')
+EXPORT_CHUNK_ROWS = 1000
+
+def date_range_filter(column, conditions=(), params=()):
+    """Build a WHERE clause on a day-number column from optional start_date/end_date query parameters
+    
+    Extra conditions and their params are ANDed with the date range.
+    """
+    conditions = list(conditions)
+    params = list(params)
+    if request.args.get('start_date'):
+        conditions.append(f'{column} >= ?')
+        params.append(clock.day(request.args['start_date']))
+    if request.args.get('end_date'):
+        conditions.append(f'{column} <= ?')
+        params.append(clock.day(request.args['end_date']))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    return where, params
+
+def csv_response(cursor, header, download_name):
+    """Stream a cursor's rows as CSV, optionally gzipped with ?gzip=1"""
+    compress = request.args.get('gzip', '').lower() in ['1', 'true', 'yes']
+    
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        compressor = zlib.compressobj(wbits=31) if compress else None
+        writer.writerow(header)
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+            writer.writerows(rows)
+            chunk = buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+            if not rows:
+                break
+        if compressor:
+            yield compressor.flush()
+    
+    if compress:
+        download_name += '.gz'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/gzip' if compress else 'text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={download_name}'})
+
+@bp.route('/export/habits')
 def export_habits():
-    """Export habit logs to CSV"""
+    """Stream habit logs as CSV"""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('''
+    where, params = date_range_filter('hl.day')
+    cursor.execute(f'''
         SELECT h.name, h.habit_type, h.target_hours, hl.log_date, 
                hl.hours_spent, hl.completed, hl.notes
         FROM habit_logs hl
         JOIN habits h ON hl.habit_id = h.id
-        ORDER BY hl.log_date DESC, h.name
-    ''')
-    
-    filename = f'data/habits_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
+        {where}
+        ORDER BY hl.day DESC, h.name
+    ''', params)
     
-    with open(filename, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['Habit Name', 'Type', 'Target Hours', 'Date', 
-                        'Hours Spent', 'Completed', 'Notes'])
-        writer.writerows(cursor.fetchall())
-    
-    conn.close()
-    return send_file(filename, as_attachment=True, download_name='habits_export.csv')
+    return csv_response(cursor, ['Habit Name', 'Type', 'Target Hours', 'Date', 
+                                 'Hours Spent', 'Completed', 'Notes'], 'habits_export.csv')
 
-@app.route('/api/analytics')
+@bp.route('/api/analytics')
+@conditional('categories', 'time_blocks')
+@cached('categories', 'time_blocks')
 def analytics():
     """Get time tracking analytics by category for a date range"""
     conn = get_db()
     cursor = conn.cursor()
     
-    start_date = request.args.get('start_date', date.today().isoformat())
-    end_date = request.args.get('end_date', date.today().isoformat())
+    start_date, end_date = requested_range()
     
-    # Get total hours by category
+    # Get total hours by category from the daily rollups
     cursor.execute('''
         SELECT 
             c.id,
             c.name,
             c.color,
-            COALESCE(SUM(tb.duration_minutes), 0) as total_minutes,
-            COUNT(tb.id) as block_count
+            COALESCE(SUM(r.total_minutes), 0) as total_minutes,
+            COALESCE(SUM(r.block_count), 0) as block_count
         FROM categories c
-        LEFT JOIN time_blocks tb ON c.id = tb.category_id 
-            AND tb.block_date BETWEEN ? AND ?
+        LEFT JOIN category_daily r ON c.id = r.category_id 
+            AND r.block_date BETWEEN ? AND ?
         GROUP BY c.id, c.name, c.color
         ORDER BY total_minutes DESC
     ''', (start_date, end_date))
@@ -472,13 +915,13 @@ def analytics():
             'block_count': row['block_count']
         })
     
-    # Get uncategorized blocks
+    # Get uncategorized blocks (rolled up under category 0)
     cursor.execute('''
         SELECT 
-            COALESCE(SUM(duration_minutes), 0) as total_minutes,
-            COUNT(*) as block_count
-        FROM time_blocks
-        WHERE category_id IS NULL 
+            COALESCE(SUM(total_minutes), 0) as total_minutes,
+            COALESCE(SUM(block_count), 0) as block_count
+        FROM category_daily
+        WHERE category_id = 0 
             AND block_date BETWEEN ? AND ?
     ''', (start_date, end_date))
     
@@ -496,23 +939,23 @@ def analytics():
     # Calculate total
     total_minutes = sum(stat['total_minutes'] for stat in category_stats)
     
-    conn.close()
     return jsonify({
         'start_date': start_date,
         'end_date': end_date,
-        'categories': category_stats,
+        'categories': responses.shaped(category_stats),
         'total_minutes': total_minutes,
         'total_hours': round(total_minutes / 60, 2)
     })
 
-@app.route('/api/analytics/tasks')
+@bp.route('/api/analytics/tasks')
+@conditional('tasks', 'categories', 'time_blocks')
+@cached('tasks', 'categories', 'time_blocks')
 def task_analytics():
     """Get time tracking analytics by task for a date range"""
     conn = get_db()
     cursor = conn.cursor()
     
-    start_date = request.args.get('start_date', date.today().isoformat())
-    end_date = request.args.get('end_date', date.today().isoformat())
+    start_date, end_date = requested_range()
     category_id = request.args.get('category_id')
     
     if category_id:
@@ -522,12 +965,12 @@ def task_analytics():
                 t.name,
                 c.name as category_name,
                 c.color,
-                COALESCE(SUM(tb.duration_minutes), 0) as total_minutes,
-                COUNT(tb.id) as block_count
+                COALESCE(SUM(r.total_minutes), 0) as total_minutes,
+                COALESCE(SUM(r.block_count), 0) as block_count
             FROM tasks t
             LEFT JOIN categories c ON t.category_id = c.id
-            LEFT JOIN time_blocks tb ON t.id = tb.task_id 
-                AND tb.block_date BETWEEN ? AND ?
+            LEFT JOIN task_daily r ON t.id = r.task_id 
+                AND r.block_date BETWEEN ? AND ?
             WHERE t.category_id = ?
             GROUP BY t.id, t.name, c.name, c.color
             ORDER BY total_minutes DESC
@@ -539,12 +982,12 @@ def task_analytics():
                 t.name,
                 c.name as category_name,
                 c.color,
-                COALESCE(SUM(tb.duration_minutes), 0) as total_minutes,
-                COUNT(tb.id) as block_count
+                COALESCE(SUM(r.total_minutes), 0) as total_minutes,
+                COALESCE(SUM(r.block_count), 0) as block_count
             FROM tasks t
             LEFT JOIN categories c ON t.category_id = c.id
-            LEFT JOIN time_blocks tb ON t.id = tb.task_id 
-                AND tb.block_date BETWEEN ? AND ?
+            LEFT JOIN task_daily r ON t.id = r.task_id 
+                AND r.block_date BETWEEN ? AND ?
             GROUP BY t.id, t.name, c.name, c.color
             ORDER BY c.name, total_minutes DESC
         ''', (start_date, end_date))
@@ -564,42 +1007,44 @@ def task_analytics():
     
     total_minutes = sum(stat['total_minutes'] for stat in task_stats)
     
-    conn.close()
     return jsonify({
         'start_date': start_date,
         'end_date': end_date,
-        'tasks': task_stats,
+        'tasks': responses.shaped(task_stats),
         'total_minutes': total_minutes,
         'total_hours': round(total_minutes / 60, 2)
     })
 
-@app.route('/api/analytics/habits')
+@bp.route('/api/analytics/habits')
+@conditional('habits', 'habit_logs')
+@cached('habits', 'habit_logs', 'habit_streaks')
 def habit_analytics():
     """Get habit completion analytics for a date range"""
     conn = get_db()
     cursor = conn.cursor()
     
-    start_date = request.args.get('start_date', date.today().isoformat())
-    end_date = request.args.get('end_date', date.today().isoformat())
+    start_date, end_date = requested_range()
     
-    cursor.execute('''
+    streak, streak_params = streak_columns()
+    cursor.execute(f'''
         SELECT 
             h.id,
             h.name,
             h.habit_type,
             h.target_type,
             h.target_hours,
-            COUNT(hl.id) as log_count,
-            SUM(CASE WHEN hl.completed = 1 THEN 1 ELSE 0 END) as completed_count,
-            AVG(CASE WHEN hl.completion_percentage IS NOT NULL THEN hl.completion_percentage ELSE 
-                CASE WHEN hl.completed = 1 THEN 100 ELSE 0 END END) as avg_completion,
-            SUM(COALESCE(hl.hours_spent, 0)) as total_hours
+            COALESCE(SUM(r.log_count), 0) as log_count,
+            COALESCE(SUM(r.completed_count), 0) as completed_count,
+            SUM(r.completion_sum) * 1.0 / SUM(r.log_count) as avg_completion,
+            SUM(COALESCE(r.total_hours, 0)) as total_hours,
+            {streak}
         FROM habits h
-        LEFT JOIN habit_logs hl ON h.id = hl.habit_id 
-            AND hl.log_date BETWEEN ? AND ?
+        LEFT JOIN habit_daily r ON h.id = r.habit_id 
+            AND r.log_date BETWEEN ? AND ?
+        LEFT JOIN habit_streaks s ON s.habit_id = h.id
         GROUP BY h.id, h.name, h.habit_type, h.target_type, h.target_hours
         ORDER BY h.name
-    ''', (start_date, end_date))
+    ''', streak_params + [start_date, end_date])
     
     habit_stats = []
     for row in cursor.fetchall():
@@ -613,43 +1058,186 @@ def habit_analytics():
             'completed_count': row['completed_count'],
             'avg_completion': round(row['avg_completion'] if row['avg_completion'] else 0, 1),
             'total_hours': round(row['total_hours'], 2),
-            'completion_rate': round((row['completed_count'] / row['log_count'] * 100) if row['log_count'] > 0 else 0, 1)
+            'completion_rate': round((row['completed_count'] / row['log_count'] * 100) if row['log_count'] > 0 else 0, 1),
+            'current_streak': row['current_streak'],
+            'longest_streak': row['longest_streak'],
+            'last_completed_date': row['last_completed_date']
         })
     
-    conn.close()
     return jsonify({
         'start_date': start_date,
         'end_date': end_date,
-        'habits': habit_stats
+        'habits': responses.shaped(habit_stats)
+    })
+
+SERIES_GROUPS = ('category', 'task', 'habit')
+
+@bp.route('/api/analytics/series')
+@conditional('categories', 'tasks', 'habits', 'time_blocks', 'habit_logs')
+@cached('categories', 'tasks', 'habits', 'time_blocks', 'habit_logs')
+def analytics_series():
+    """Get per-day, per-week or per-month totals by category, task or habit"""
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    group = request.args.get('group', 'category')
+    bucket = request.args.get('bucket', 'day')
+    if group not in SERIES_GROUPS:
+        return jsonify({'success': False, 'error': f"group must be one of {', '.join(SERIES_GROUPS)}"}), 400
+    if bucket not in series.BUCKETS:
+        return jsonify({'success': False, 'error': f"bucket must be one of {', '.join(series.BUCKETS)}"}), 400
+    
+    start_date, end_date = requested_range()
+    try:
+        starts = series.bucket_starts(bucket, clock.parse_date(start_date), clock.parse_date(end_date))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    # One grouped pass over the daily rollup, bucketed in SQL
+    if group == 'habit':
+        cursor.execute(f'''
+            SELECT habit_id, {series.bucket_sql(bucket, 'log_date')} as bucket,
+                   SUM(log_count), SUM(completed_count), ROUND(SUM(total_hours), 2)
+            FROM habit_daily
+            WHERE log_date BETWEEN ? AND ?
+            GROUP BY habit_id, bucket
+        ''', (start_date, end_date))
+        values = series.dense(cursor.fetchall(), starts, ('log_count', 'completed_count', 'total_hours'))
+        cursor.execute('SELECT id, name, habit_type FROM habits ORDER BY name')
+        owners = [dict(row) for row in cursor.fetchall()]
+        fields = ('log_count', 'completed_count', 'total_hours')
+    
+    elif group == 'task':
+        category_id = request.args.get('category_id')
+        cursor.execute(f'''
+            SELECT task_id, {series.bucket_sql(bucket, 'block_date')} as bucket,
+                   SUM(total_minutes), SUM(block_count)
+            FROM task_daily
+            WHERE block_date BETWEEN ? AND ? AND task_id != 0
+            GROUP BY task_id, bucket
+        ''', (start_date, end_date))
+        values = series.dense(cursor.fetchall(), starts, ('total_minutes', 'block_count'))
+        # Like /api/analytics/tasks, only tasks with tracked time
+        cursor.execute(f'''
+            SELECT t.id, t.name, c.name as category_name, c.color
+            FROM tasks t
+            LEFT JOIN categories c ON t.category_id = c.id
+            {'WHERE t.category_id = ?' if category_id else ''}
+            ORDER BY c.name, t.name
+        ''', (category_id,) if category_id else ())
+        owners = [dict(row) for row in cursor.fetchall() if row['id'] in values]
+        fields = ('total_minutes', 'block_count')
+    
+    else:
+        cursor.execute(f'''
+            SELECT category_id, {series.bucket_sql(bucket, 'block_date')} as bucket,
+                   SUM(total_minutes), SUM(block_count)
+            FROM category_daily
+            WHERE block_date BETWEEN ? AND ?
+            GROUP BY category_id, bucket
+        ''', (start_date, end_date))
+        values = series.dense(cursor.fetchall(), starts, ('total_minutes', 'block_count'))
+        cursor.execute('SELECT id, name, color FROM categories ORDER BY name')
+        owners = [dict(row) for row in cursor.fetchall()]
+        # Uncategorized time is rolled up under category 0
+        if 0 in values:
+            owners.append({'id': None, 'name': 'Uncategorized', 'color': '#999999'})
+            values[None] = values.pop(0)
+        fields = ('total_minutes', 'block_count')
+    
+    empty = {field: [0] * len(starts) for field in fields}
+    for owner in owners:
+        owner.update(values.get(owner['id'], empty))
+    
+    return jsonify({
+        'start_date': start_date,
+        'end_date': end_date,
+        'group': group,
+        'bucket': bucket,
+        'buckets': [day.isoformat() for day in starts],
+        'labels': [series.label(bucket, day) for day in starts],
+        'series': responses.shaped(owners)
     })
 
-@app.route('/export/timeblocks')
+@bp.route('/api/analytics/cache')
+def analytics_cache():
+    """Get the analytics result cache's size and hit/miss/eviction counters"""
+    return jsonify(cache.get_cache().stats())
+
+@bp.route('/metrics')
+def prometheus_metrics():
+    """Request, SQL and cache metrics in Prometheus text format"""
+    # Totals over every database this process has open, which with tenants is one per active shard
+    stats = cache.total_stats()
+    families = list(metrics.get_metrics().all) + [
+        ('ontrack_analytics_cache_entries', 'Cached analytics results', 'gauge', stats['entries']),
+        ('ontrack_analytics_cache_bytes', 'Size of cached analytics results', 'gauge', stats['size_bytes']),
+        ('ontrack_analytics_cache_hits_total', 'Analytics cache hits', 'counter', stats['hits']),
+        ('ontrack_analytics_cache_misses_total', 'Analytics cache misses', 'counter', stats['misses']),
+        ('ontrack_analytics_cache_evictions_total', 'Analytics cache evictions', 'counter', stats['evictions']),
+        ('ontrack_analytics_cache_invalidations_total', 'Analytics cache invalidations', 'counter',
+         stats['invalidations']),
+        ('ontrack_open_databases', 'Databases with an open connection pool', 'gauge',
+         len(current_app.extensions['ontrack_db'])),
+        ('ontrack_event_streams', 'Open /api/events streams', 'gauge', events.get_broker().streams),
+    ]
+    scheduler = backup.get_scheduler()
+    if scheduler is not None:
+        families += [
+            ('ontrack_backups_total', 'Scheduled backups taken by this process', 'counter', scheduler.backups),
+            ('ontrack_backup_failures_total', 'Scheduled backups that failed', 'counter', scheduler.failures),
+            ('ontrack_backup_last_seconds', 'Duration of the last scheduled backup', 'gauge',
+             scheduler.last['seconds'] if scheduler.last else 0),
+        ]
+    if current_app.config['WRITE_BATCH_SIZE'] > 0:
+        writes = writer.total_stats()
+        families += [
+            ('ontrack_write_jobs_total', 'Writes committed by the writer thread', 'counter', writes['jobs']),
+            ('ontrack_write_batches_total', 'Group commits by the writer thread', 'counter', writes['batches']),
+            ('ontrack_write_failed_commits_total', 'Group commits that failed', 'counter', writes['failed_commits']),
+            ('ontrack_write_queue_length', 'Writes waiting for the writer thread', 'gauge', writes['queued']),
+        ]
+    return Response(metrics.render(families), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/api/admin/backup', methods=['GET', 'POST'])
+def admin_backup():
+    """List the backups of this database or tenant's shard, or take one now; see backup.py"""
+    tenant = g.get('tenant')
+    directory = backup.directory(current_app, tenant)
+    if request.method == 'POST':
+        return jsonify(backup.run(current_app, db.database_path(), tenant))
+    
+    return jsonify({'directory': directory,
+                    'backups': [{'name': os.path.basename(path), 'bytes': os.path.getsize(path)}
+                                for path in reversed(backup.backups(directory))]})
+
+@bp.route('/export/timeblocks')
 def export_timeblocks():
-    """Export time blocks to CSV"""
+    """Stream time blocks as CSV"""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('''
+    where, params = date_range_filter('tb.day')
+    cursor.execute(f'''
         SELECT tb.block_date, tb.start_time, tb.end_time, tb.activity, tb.duration_minutes,
                c.name as category, t.name as task
         FROM time_blocks tb
         LEFT JOIN categories c ON tb.category_id = c.id
         LEFT JOIN tasks t ON tb.task_id = t.id
-        ORDER BY tb.block_date DESC, tb.start_time
-    ''')
-    
-    filename = f'data/timeblocks_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-    
-    with open(filename, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['Date', 'Start Time', 'End Time', 'Activity', 'Duration (minutes)', 'Category', 'Task'])
-        writer.writerows(cursor.fetchall())
+        {where}
+        ORDER BY tb.day DESC, tb.start_minute
+    ''', params)
     
-    conn.close()
-    return send_file(filename, as_attachment=True, download_name='timeblocks_export.csv')
+    return csv_response(cursor, ['Date', 'Start Time', 'End Time', 'Activity', 'Duration (minutes)', 'Category', 'Task'],
+                        'timeblocks_export.csv')
 
-@app.route('/import/habits', methods=['POST'])
-def import_habits():
-    """Import habits from CSV"""
+@bp.route('/export/snapshot')
+def export_snapshot():
+    """Stream every table as a binary snapshot; see snapshot.py"""
+    return Response(stream_with_context(snapshot.dump(get_db())), mimetype='application/octet-stream',
+                    headers={'Content-Disposition': 'attachment; filename=ontrack.snapshot'})
+
+def run_import(import_rows):
+    """Run a CSV or snapshot importer on the uploaded file inside one write"""
     if 'file' not in request.files:
         return jsonify({'success': False, 'error': 'No file provided'}), 400
     
@@ -658,135 +1246,50 @@ def import_habits():
         return jsonify({'success': False, 'error': 'No file selected'}), 400
     
     try:
-        content = file.read().decode('utf-8')
-        reader = csv.DictReader(content.splitlines())
-        
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        imported = 0
-        errors = []
-        
-        for row in reader:
-            try:
-                # First, ensure the habit exists
-                cursor.execute('SELECT id FROM habits WHERE name = ?', (row['Habit Name'],))
-                habit = cursor.fetchone()
-                
-                if not habit:
-                    # Create the habit
-                    habit_type = row.get('Type', 'daily')
-                    target_hours = row.get('Target Hours')
-                    cursor.execute('''
-                        INSERT INTO habits (name, habit_type, target_hours)
-                        VALUES (?, ?, ?)
-                    ''', (row['Habit Name'], habit_type, target_hours if target_hours else None))
-                    habit_id = cursor.lastrowid
-                else:
-                    habit_id = habit['id']
-                
-                # Insert the log
-                log_date = row.get('Date')
-                hours_spent = row.get('Hours Spent')
-                completed = row.get('Completed', '').lower() in ['true', '1', 'yes']
-                notes = row.get('Notes', '')
-                
-                if log_date:
-                    cursor.execute('''
-                        INSERT INTO habit_logs (habit_id, log_date, hours_spent, completed, notes)
-                        VALUES (?, ?, ?, ?, ?)
-                    ''', (habit_id, log_date, hours_spent if hours_spent else None, completed, notes))
-                    imported += 1
-                    
-            except Exception as e:
-                errors.append(f"Row error: {str(e)}")
-        
-        conn.commit()
-        conn.close()
-        
-        return jsonify({
-            'success': True,
-            'imported': imported,
-            'errors': errors
-        })
+        result = writer.run(import_rows, file.stream)
+        return jsonify(result.to_dict())
         
+    except snapshot.InvalidSnapshot as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/import/timeblocks', methods=['POST'])
+@bp.route('/import/habits', methods=['POST'])
+def import_habits():
+    """Import habit logs from CSV"""
+    return run_import(importer.import_habit_logs)
+
+@bp.route('/import/timeblocks', methods=['POST'])
 def import_timeblocks():
     """Import time blocks from CSV"""
-    if 'file' not in request.files:
-        return jsonify({'success': False, 'error': 'No file provided'}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'success': False, 'error': 'No file selected'}), 400
-    
-    try:
-        content = file.read().decode('utf-8')
-        reader = csv.DictReader(content.splitlines())
-        
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        imported = 0
-        errors = []
-        
-        for row in reader:
-            try:
-                block_date = row.get('Date')
-                start_time = row.get('Start Time')
-                end_time = row.get('End Time')
-                activity = row.get('Activity')
-                duration = row.get('Duration (minutes)')
-                category_name = row.get('Category')
-                task_name = row.get('Task')
-                
-                # Get category ID if exists
-                category_id = None
-                if category_name:
-                    cursor.execute('SELECT id FROM categories WHERE name = ?', (category_name,))
-                    cat = cursor.fetchone()
-                    if cat:
-                        category_id = cat['id']
-                
-                # Get task ID if exists
-                task_id = None
-                if task_name:
-                    cursor.execute('SELECT id FROM tasks WHERE name = ?', (task_name,))
-                    task = cursor.fetchone()
-                    if task:
-                        task_id = task['id']
-                
-                if block_date and start_time and end_time and activity:
-                    cursor.execute('''
-                        INSERT INTO time_blocks (block_date, start_time, end_time, activity, duration_minutes, category_id, task_id)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ''', (block_date, start_time, end_time, activity, duration, category_id, task_id))
-                    imported += 1
-                    
-            except Exception as e:
-                errors.append(f"Row error: {str(e)}")
-        
-        conn.commit()
-        conn.close()
-        
-        return jsonify({
-            'success': True,
-            'imported': imported,
-            'errors': errors
-        })
-        
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+    return run_import(importer.import_time_blocks)
+
+@bp.route('/import/snapshot', methods=['POST'])
+def import_snapshot():
+    """Replace every table with the rows of an uploaded snapshot"""
+    return run_import(snapshot.load)
+
+def create_app(config=None):
+    """Build an OnTrack app, optionally overriding settings from the environment"""
+    app = Flask(__name__)
+    if config:
+        app.config.update(config)
+    db.init_app(app)
+    tenants.init_app(app)
+    cache.init_app(app)
+    paging.init_app(app)
+    overlaps.init_app(app)
+    metrics.init_app(app)
+    events.init_app(app)
+    writer.init_app(app)
+    backup.init_app(app)
+    responses.init_app(app)
+    app.register_blueprint(bp)
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
-    # Create data directory if it doesn't exist
-    os.makedirs('data', exist_ok=True)
-    
-    # Initialize database
-    init_db()
-    
-    # Run the app
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Development server; production runs under gunicorn (see gunicorn.conf.py)
+    setup_database(app)
+    app.run(host='0.0.0.0', port=5000, debug=os.environ.get('FLASK_DEBUG', '1') == '1')
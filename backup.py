@@ -0,0 +1,332 @@
+"""Online backups of the database through SQLite's backup API
+
+Copying data/ontrack.db while the app writes to it can catch a half-written
+page or miss what is still in the WAL. backup() instead copies the database
+through sqlite3's Connection.backup, BACKUP_PAGES pages per step with
+BACKUP_SLEEP_MS between steps. A step holds a read transaction only while
+it copies its pages, so requests read and write freely in between.
+
+When another connection writes between two steps SQLite starts the copy
+over from the first page. Under a steady stream of writes that could go on
+for ever, so after BACKUP_MAX_RESTARTS restarts the rest is copied in one
+step instead: in WAL mode that is one long read transaction, which writers
+don't wait for either.
+
+A finished copy must pass PRAGMA quick_check before it is renamed into
+place as ontrack-<UTC time>.db, or gzipped to ontrack-<UTC time>.db.gz
+with BACKUP_COMPRESS. Only the newest BACKUP_KEEP backups are kept.
+
+With BACKUP_INTERVAL set, each worker process runs a scheduler thread
+that wakes once the newest backup is BACKUP_INTERVAL seconds old. A lock
+file in the backup directory lets one process take the backup while the
+others skip it. With tenants every shard is backed up in turn, each into
+BACKUP_DIR/<tenant>.
+"""
+import fcntl
+import glob
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import current_app
+
+import tenants
+
+log = logging.getLogger('ontrack.backup')
+
+PREFIX = 'ontrack-'
+PATTERNS = (PREFIX + '*.db', PREFIX + '*.db.gz')
+LOCK_FILE = '.lock'
+# gzip level 1 is under half the time of level 6 for a file about 7% larger
+COMPRESSION = 1
+
+
+class InvalidBackup(ValueError):
+    """Raised when a file to restore is not a usable SQLite database"""
+
+
+class BackupBusy(RuntimeError):
+    """Raised when another thread or process is already taking a backup"""
+
+
+class _Restarted(Exception):
+    pass
+
+
+def backups(directory):
+    """Paths of the finished backups in a directory, oldest first"""
+    paths = [path for pattern in PATTERNS for path in glob.glob(os.path.join(directory, pattern))]
+    # Names embed the UTC time, so they sort chronologically
+    return sorted(paths, key=os.path.basename)
+
+
+def prune(directory, keep):
+    """Delete all but the newest `keep` backups; returns the deleted paths"""
+    if keep <= 0:
+        return []
+    old = backups(directory)[:-keep]
+    for path in old:
+        os.remove(path)
+    return old
+
+
+def _copy(source, target, pages, sleep, max_restarts):
+    """Copy source into target in steps; returns (steps, restarts, single_step)"""
+    counts = {'steps': 0, 'restarts': 0, 'remaining': None}
+
+    def progress(status, remaining, total):
+        counts['steps'] += 1
+        if counts['remaining'] is not None and remaining > counts['remaining']:
+            counts['restarts'] += 1
+            if counts['restarts'] > max_restarts:
+                raise _Restarted()
+        counts['remaining'] = remaining
+
+    try:
+        source.backup(target, pages=pages, progress=progress, sleep=sleep)
+        return counts['steps'], counts['restarts'], pages <= 0
+    except _Restarted:
+        source.backup(target)
+        return counts['steps'] + 1, counts['restarts'], True
+
+
+def _check(conn):
+    try:
+        result = conn.execute('PRAGMA quick_check').fetchone()[0]
+    except sqlite3.DatabaseError as e:
+        raise InvalidBackup(str(e))
+    if result != 'ok':
+        raise InvalidBackup(f'integrity check failed: {result}')
+
+
+def _lock(directory):
+    """Hold the backup directory's lock file, or raise BackupBusy"""
+    handle = open(os.path.join(directory, LOCK_FILE), 'a')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        handle.close()
+        raise BackupBusy('A backup is already running')
+    return handle
+
+
+def backup(path, directory, pages=1024, sleep=0.01, compress=False, keep=0, max_restarts=3):
+    """Back up the database at `path` into `directory` while it stays in use
+
+    Returns a dict describing the backup. Raises BackupBusy when another
+    backup of the directory is running.
+    """
+    os.makedirs(directory, exist_ok=True)
+    started = time.perf_counter()
+    with _lock(directory):
+        # Leftovers of a backup that died half way; nobody else is writing one while we hold the lock
+        for stale in glob.glob(os.path.join(directory, PREFIX + '*.part')):
+            os.remove(stale)
+        now = datetime.now(timezone.utc)
+        name = f'{PREFIX}{now:%Y%m%dT%H%M%S}{now.microsecond // 1000:03d}Z.db'
+        partial = os.path.join(directory, name + '.part')
+        source = sqlite3.connect(path, timeout=30)
+        try:
+            target = sqlite3.connect(partial)
+            try:
+                steps, restarts, single_step = _copy(source, target, pages, sleep, max_restarts)
+                _check(target)
+                page_count = target.execute('PRAGMA page_count').fetchone()[0]
+                page_size = target.execute('PRAGMA page_size').fetchone()[0]
+            finally:
+                target.close()
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        finally:
+            source.close()
+
+        final = os.path.join(directory, name)
+        if compress:
+            final += '.gz'
+            with open(partial, 'rb') as raw, gzip.open(final + '.part', 'wb', compresslevel=COMPRESSION) as packed:
+                shutil.copyfileobj(raw, packed, 1 << 20)
+            os.remove(partial)
+            partial = final + '.part'
+        os.replace(partial, final)
+        pruned = prune(directory, keep)
+
+    return {
+        'success': True,
+        'path': final,
+        'bytes': os.path.getsize(final),
+        'database_bytes': page_count * page_size,
+        'pages': page_count,
+        'steps': steps,
+        'restarts': restarts,
+        'single_step': single_step,
+        'seconds': round(time.perf_counter() - started, 3),
+        'pruned': [os.path.basename(old) for old in pruned],
+    }
+
+
+def restore(path, source):
+    """Overwrite the database at `path` with a backup, plain or gzipped
+
+    The copy goes through the backup API into the live database, so a
+    server still running sees either the old data or the restored data,
+    never a mix. It should still be restarted afterwards: its caches and
+    change counters describe the data that was replaced.
+    """
+    scratch = None
+    try:
+        if source.endswith('.gz'):
+            handle, scratch = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(os.path.abspath(path)))
+            with os.fdopen(handle, 'wb') as raw, gzip.open(source, 'rb') as packed:
+                try:
+                    shutil.copyfileobj(packed, raw, 1 << 20)
+                except (OSError, EOFError) as e:
+                    raise InvalidBackup(f'cannot decompress {source}: {e}')
+            source = scratch
+        if not os.path.isfile(source):
+            raise InvalidBackup(f'{source} does not exist')
+        backup_conn = sqlite3.connect(source)
+        try:
+            _check(backup_conn)
+            conn = sqlite3.connect(path, timeout=30)
+            try:
+                backup_conn.backup(conn)
+            finally:
+                conn.close()
+        finally:
+            backup_conn.close()
+    finally:
+        if scratch:
+            os.remove(scratch)
+
+
+class Scheduler:
+    """Background thread taking a backup whenever the newest one is `interval` seconds old"""
+
+    def __init__(self, app):
+        self.app = app
+        self.backups = 0
+        self.failures = 0
+        self.last = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ontrack-backup', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def _delay(self):
+        """Seconds until the next backup is due"""
+        config = self.app.config
+        existing = backups(config['BACKUP_DIR'])
+        if config['TENANT_DIR']:
+            existing += [path for tenant, _ in tenants.shards(self.app)
+                         for path in backups(os.path.join(config['BACKUP_DIR'], tenant))[-1:]]
+        try:
+            newest = max(map(os.path.getmtime, existing), default=None)
+        except OSError:
+            return 0
+        if newest is None:
+            return 0
+        return max(0.0, config['BACKUP_INTERVAL'] - (time.time() - newest))
+
+    def _run(self):
+        # A minimum pause keeps a failing backup from being retried in a tight loop
+        while not self._stop.wait(max(self._delay(), 1.0)):
+            if self._delay() > 0:
+                continue
+            try:
+                for result in run_all(self.app):
+                    self.last = result
+                    self.backups += 1
+                    log.info('Backed up the database to %s in %.1f s', result['path'], result['seconds'])
+            except BackupBusy:
+                pass
+            except Exception:
+                self.failures += 1
+                log.exception('Scheduled backup failed')
+                self._stop.wait(60)
+
+
+def directory(app, tenant=None):
+    """Where backups of DATABASE, or of a tenant's shard, are kept"""
+    return os.path.join(app.config['BACKUP_DIR'], tenant) if tenant else app.config['BACKUP_DIR']
+
+
+def run(app, path=None, tenant=None):
+    """Back up DATABASE, or the shard at `path` of `tenant`, with the app's settings"""
+    config = app.config
+    return backup(path or config['DATABASE'], directory(app, tenant),
+                  pages=config['BACKUP_PAGES'],
+                  sleep=config['BACKUP_SLEEP_MS'] / 1000,
+                  compress=config['BACKUP_COMPRESS'],
+                  keep=config['BACKUP_KEEP'],
+                  max_restarts=config['BACKUP_MAX_RESTARTS'])
+
+
+def run_all(app):
+    """Back up DATABASE, or with tenants every shard; returns the results
+
+    Raises BackupBusy when another process is already at it.
+    """
+    if not app.config['TENANT_DIR']:
+        return [run(app)]
+    os.makedirs(app.config['BACKUP_DIR'], exist_ok=True)
+    # One pass at a time, so two processes don't each back up half of the shards
+    with _lock(app.config['BACKUP_DIR']):
+        results = []
+        for tenant, path in tenants.shards(app):
+            try:
+                results.append(run(app, path, tenant))
+            except BackupBusy:
+                # A POST /api/admin/backup for this tenant is running
+                pass
+        return results
+
+
+_scheduler_lock = threading.Lock()
+
+
+def _start_scheduler():
+    """Start this process's scheduler on its first request, after any fork"""
+    app = current_app._get_current_object()
+    schedulers = app.extensions['ontrack_backup']
+    if os.getpid() not in schedulers:
+        with _scheduler_lock:
+            if os.getpid() not in schedulers:
+                schedulers[os.getpid()] = Scheduler(app)
+
+
+def get_scheduler():
+    """This process's scheduler, or None before its first request or without an interval"""
+    return current_app.extensions['ontrack_backup'].get(os.getpid())
+
+
+def stop_schedulers(app):
+    """Stop every scheduler thread the app started"""
+    for scheduler in app.extensions.get('ontrack_backup', {}).values():
+        scheduler.stop()
+    app.extensions['ontrack_backup'] = {}
+
+
+def init_app(app):
+    """Register the backup settings and, with an interval set, the scheduler"""
+    default_dir = os.path.join(os.path.dirname(app.config['DATABASE']) or '.', 'backups')
+    app.config.setdefault('BACKUP_DIR', os.environ.get('ONTRACK_BACKUP_DIR', default_dir))
+    app.config.setdefault('BACKUP_INTERVAL', float(os.environ.get('ONTRACK_BACKUP_INTERVAL', 0)))
+    app.config.setdefault('BACKUP_KEEP', int(os.environ.get('ONTRACK_BACKUP_KEEP', 7)))
+    app.config.setdefault('BACKUP_COMPRESS', os.environ.get('ONTRACK_BACKUP_COMPRESS', '0') == '1')
+    app.config.setdefault('BACKUP_PAGES', int(os.environ.get('ONTRACK_BACKUP_PAGES', 1024)))
+    app.config.setdefault('BACKUP_SLEEP_MS', float(os.environ.get('ONTRACK_BACKUP_SLEEP_MS', 10)))
+    app.config.setdefault('BACKUP_MAX_RESTARTS', int(os.environ.get('ONTRACK_BACKUP_MAX_RESTARTS', 3)))
+    app.extensions['ontrack_backup'] = {}
+    if app.config['BACKUP_INTERVAL'] > 0:
+        app.before_request(_start_scheduler)
@@ -0,0 +1,211 @@
+"""Batch inserts of time blocks and habit logs from JSON
+
+Every item in a batch is validated and inserted inside the caller's
+transaction, and gets its own result: the new row id, or an error message.
+Each item runs in a savepoint, so one that fails leaves nothing behind,
+not even the categories, tasks or habits it created.
+Categories, tasks and habits can be referenced by id or by name; names that
+do not exist yet are created, so a client can push a day's data in one
+round trip.
+"""
+import sqlite3
+
+import clock
+import importer
+import overlaps
+
+MAX_ITEMS = 1000
+
+
+class BatchResult:
+    """Per-item ids and errors for one batch, in request order"""
+
+    def __init__(self):
+        self.results = []
+        self.error_count = 0
+        self.rolled_back = False
+
+    def ok(self, row_id, **extra):
+        self.results.append(dict(extra, id=row_id))
+
+    def error(self, message):
+        self.results.append({'error': message})
+        self.error_count += 1
+
+    def rollback(self):
+        """Record that the whole batch was undone: no item keeps its ids"""
+        self.rolled_back = True
+        self.results = [result if 'error' in result else {'rolled_back': True} for result in self.results]
+
+    def to_dict(self):
+        return {
+            'success': self.error_count == 0,
+            'inserted': 0 if self.rolled_back else len(self.results) - self.error_count,
+            'error_count': self.error_count,
+            'rolled_back': self.rolled_back,
+            'results': self.results
+        }
+
+
+class _Names:
+    """Resolves names to ids for one table, creating missing rows on demand"""
+
+    def __init__(self, cursor, table):
+        self.cursor = cursor
+        self.table = table
+        self.ids = None
+        self.created = []
+
+    def resolve(self, name, insert_sql, params):
+        if self.ids is None:
+            self.ids = importer.name_map(self.cursor, self.table)
+        row_id = self.ids.get(name)
+        if row_id is None:
+            self.cursor.execute(insert_sql, params)
+            row_id = self.ids[name] = self.cursor.lastrowid
+            self.created.append(name)
+        return row_id
+
+    def forget_created(self):
+        """Drop the names created since the last call; their rows were rolled back"""
+        for name in self.created:
+            del self.ids[name]
+        self.created = []
+
+
+def _savepoint(cursor, names, insert):
+    """Run one item's writes in a savepoint, undoing all of them if it fails"""
+    for table in names:
+        table.created = []
+    cursor.execute('SAVEPOINT item')
+    try:
+        value = insert()
+    except BaseException:
+        cursor.execute('ROLLBACK TO item')
+        cursor.execute('RELEASE item')
+        for table in names:
+            table.forget_created()
+        raise
+    cursor.execute('RELEASE item')
+    return value
+
+
+def insert_time_blocks(conn, items, overlap='reject'):
+    """Insert time blocks, resolving `category` and `task` names to ids
+
+    Items take the fields of POST /api/time-blocks. Instead of category_id
+    and task_id they may give `category` (with an optional `category_color`
+    used if it has to be created) and `task`, created under the item's
+    category when missing. Overlaps with existing blocks and with earlier
+    items are handled by the `overlap` mode unless an item sets its own.
+    """
+    cursor = conn.cursor()
+    result = BatchResult()
+    categories = _Names(cursor, 'categories')
+    tasks = _Names(cursor, 'tasks')
+
+    for item in items:
+        if not isinstance(item, dict):
+            result.error('expected an object')
+            continue
+        missing = [field for field in ('block_date', 'start_time', 'end_time', 'activity') if not item.get(field)]
+        if missing:
+            result.error(f"missing {', '.join(missing)}")
+            continue
+        mode = item.get('overlap', overlap)
+        if mode not in overlaps.MODES:
+            result.error(f"overlap must be one of {', '.join(overlaps.MODES)}")
+            continue
+        try:
+            day = clock.day(item['block_date'])
+            start_minute, end_minute = clock.span(item['start_time'], item['end_time'])
+        except clock.InvalidDate as e:
+            result.error(str(e))
+            continue
+
+        def insert():
+            category_id = item.get('category_id')
+            if category_id is None and item.get('category'):
+                category_id = categories.resolve(item['category'], '''
+                    INSERT INTO categories (name, color) VALUES (?, ?)
+                ''', (item['category'], item.get('category_color', '#667eea')))
+            task_id = item.get('task_id')
+            if task_id is None and item.get('task'):
+                task_id = tasks.resolve(item['task'], '''
+                    INSERT INTO tasks (name, category_id) VALUES (?, ?)
+                ''', (item['task'], category_id))
+
+            pieces, merged = overlaps.place(cursor, mode, day, start_minute, end_minute)
+            ids = []
+            for piece in pieces:
+                cursor.execute('''
+                    INSERT INTO time_blocks (day, start_minute, end_minute, activity, category_id, task_id)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', piece + (item['activity'], category_id, task_id))
+                ids.append(cursor.lastrowid)
+            return ids, merged
+
+        try:
+            ids, merged = _savepoint(cursor, (categories, tasks), insert)
+        except (sqlite3.Error, overlaps.OverlapError) as e:
+            result.error(str(e))
+            continue
+        if len(ids) > 1 or merged:
+            result.ok(ids[0], ids=ids, merged=merged)
+        else:
+            result.ok(ids[0])
+
+    return result
+
+
+def insert_habit_logs(conn, items):
+    """Insert habit logs, resolving `habit` names to ids
+
+    Items take the fields of POST /api/habit-logs. Instead of habit_id they
+    may give `habit`; unknown habits are created with the item's
+    `habit_type` (daily by default), like the CSV import does.
+    """
+    cursor = conn.cursor()
+    result = BatchResult()
+    habits = _Names(cursor, 'habits')
+
+    for item in items:
+        if not isinstance(item, dict):
+            result.error('expected an object')
+            continue
+        if not item.get('log_date'):
+            result.error('missing log_date')
+            continue
+        if item.get('habit_id') is None and not item.get('habit'):
+            result.error('missing habit_id or habit')
+            continue
+        try:
+            day = clock.day(item['log_date'])
+        except clock.InvalidDate as e:
+            result.error(str(e))
+            continue
+
+        def insert():
+            habit_id = item.get('habit_id')
+            if habit_id is None:
+                habit_id = habits.resolve(item['habit'], '''
+                    INSERT INTO habits (name, habit_type, target_hours)
+                    VALUES (?, ?, ?)
+                ''', (item['habit'], item.get('habit_type', 'daily'), item.get('target_hours')))
+
+            cursor.execute('''
+                INSERT INTO habit_logs (habit_id, day, hours_spent, value, completed, completion_percentage, notes)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (habit_id, day, item.get('hours_spent'),
+                  item.get('value'), item.get('completed', False),
+                  item.get('completion_percentage'), item.get('notes', '')))
+            return cursor.lastrowid
+
+        try:
+            row_id = _savepoint(cursor, (habits,), insert)
+        except sqlite3.Error as e:
+            result.error(str(e))
+            continue
+        result.ok(row_id)
+
+    return result
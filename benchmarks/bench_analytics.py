@@ -0,0 +1,120 @@
+"""Compare the analytics endpoints on rollups against re-aggregating raw rows
+
+Builds a synthetic multi-year database, checks that the rollup queries
+return the same totals as the raw-table SQL the endpoints used before,
+then times both over one-week, one-year and full-history ranges.
+
+    python benchmarks/bench_analytics.py --years 5 --blocks-per-day 8 16 --repeat 20
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as ontrack  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+# (raw SQL the endpoints used before the rollups, SQL they run now)
+QUERIES = {
+    'categories': ('''
+        SELECT c.id, COALESCE(SUM(tb.duration_minutes), 0), COUNT(tb.id)
+        FROM categories c
+        LEFT JOIN time_blocks tb ON c.id = tb.category_id AND tb.day BETWEEN julianday(?) - 2440587.5 AND julianday(?) - 2440587.5
+        GROUP BY c.id
+        ORDER BY c.id
+    ''', '''
+        SELECT c.id, COALESCE(SUM(r.total_minutes), 0), COALESCE(SUM(r.block_count), 0)
+        FROM categories c
+        LEFT JOIN category_daily r ON c.id = r.category_id AND r.block_date BETWEEN ? AND ?
+        GROUP BY c.id
+        ORDER BY c.id
+    '''),
+    'tasks': ('''
+        SELECT t.id, COALESCE(SUM(tb.duration_minutes), 0), COUNT(tb.id)
+        FROM tasks t
+        LEFT JOIN time_blocks tb ON t.id = tb.task_id AND tb.day BETWEEN julianday(?) - 2440587.5 AND julianday(?) - 2440587.5
+        GROUP BY t.id
+        ORDER BY t.id
+    ''', '''
+        SELECT t.id, COALESCE(SUM(r.total_minutes), 0), COALESCE(SUM(r.block_count), 0)
+        FROM tasks t
+        LEFT JOIN task_daily r ON t.id = r.task_id AND r.block_date BETWEEN ? AND ?
+        GROUP BY t.id
+        ORDER BY t.id
+    '''),
+    'habits': ('''
+        SELECT h.id, COUNT(hl.id),
+               SUM(CASE WHEN hl.completed = 1 THEN 1 ELSE 0 END),
+               ROUND(SUM(COALESCE(hl.hours_spent, 0)), 2)
+        FROM habits h
+        LEFT JOIN habit_logs hl ON h.id = hl.habit_id AND hl.day BETWEEN julianday(?) - 2440587.5 AND julianday(?) - 2440587.5
+        GROUP BY h.id
+        ORDER BY h.id
+    ''', '''
+        SELECT h.id, COALESCE(SUM(r.log_count), 0), COALESCE(SUM(r.completed_count), 0),
+               ROUND(SUM(COALESCE(r.total_hours, 0)), 2)
+        FROM habits h
+        LEFT JOIN habit_daily r ON h.id = r.habit_id AND r.log_date BETWEEN ? AND ?
+        GROUP BY h.id
+        ORDER BY h.id
+    '''),
+}
+
+
+def timed(func, repeat):
+    """Return the median wall time of func in milliseconds"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return round(samples[len(samples) // 2], 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--blocks-per-day', type=int, nargs=2, default=(8, 16))
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = ontrack.app
+        app.config['DATABASE'] = os.path.join(tmp, 'bench.db')
+        app.extensions['ontrack_db'] = {}
+        with app.app_context():
+            ontrack.init_db()
+            counts = generate(ontrack.get_db(), years=args.years,
+                              blocks_per_day=tuple(args.blocks_per_day))
+        print(json.dumps({'dataset': counts}))
+
+        end = date.fromisoformat(counts['end_date'])
+        ranges = {
+            'week': (end - timedelta(days=6), end),
+            'year': (end - timedelta(days=364), end),
+            'all': (date.fromisoformat(counts['start_date']), end),
+        }
+        conn = ontrack.db.connect(app.config['DATABASE'])
+
+        for name, (raw_sql, rollup_sql) in QUERIES.items():
+            for label, (start_date, end_date) in ranges.items():
+                params = (start_date.isoformat(), end_date.isoformat())
+                raw = conn.execute(raw_sql, params).fetchall()
+                rolled = conn.execute(rollup_sql, params).fetchall()
+                assert [tuple(r) for r in raw] == [tuple(r) for r in rolled], f'{name} totals differ'
+                raw_ms = timed(lambda: conn.execute(raw_sql, params).fetchall(), args.repeat)
+                rollup_ms = timed(lambda: conn.execute(rollup_sql, params).fetchall(), args.repeat)
+                print(json.dumps({'query': name, 'range': label, 'raw_ms': raw_ms,
+                                  'rollup_ms': rollup_ms, 'speedup': round(raw_ms / rollup_ms, 1)}))
+        conn.close()
+        ontrack.db.close_pools(app)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Backup duration and its effect on the latency of concurrent requests
+
+Starts gunicorn with gunicorn.conf.py on a synthetic database for each
+backup mode and drives it from separate client processes mixing reads
+(a day's time blocks, the habit list) with habit log writes. Meanwhile
+the benchmark takes backups back to back through POST /api/admin/backup
+with that mode's settings; `none` takes no backups and is the baseline.
+Reports request throughput and latency percentiles next to the backups'
+duration, size and how often writes restarted them.
+
+    python benchmarks/bench_backup.py --years 10 --clients 8 --seconds 10
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import app as ontrack  # noqa: E402
+from bench_routes import percentile  # noqa: E402
+from bench_workers import free_port, wait_for  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+# Mode -> environment for gunicorn; None takes no backups
+MODES = {
+    'none': None,
+    'one_step': {'ONTRACK_BACKUP_PAGES': '-1'},
+    'steps_1024': {'ONTRACK_BACKUP_PAGES': '1024', 'ONTRACK_BACKUP_SLEEP_MS': '10'},
+    'steps_64': {'ONTRACK_BACKUP_PAGES': '64', 'ONTRACK_BACKUP_SLEEP_MS': '1'},
+    'compressed': {'ONTRACK_BACKUP_PAGES': '1024', 'ONTRACK_BACKUP_SLEEP_MS': '10', 'ONTRACK_BACKUP_COMPRESS': '1'},
+}
+
+
+def client(port, number, day, habits, deadline, results):
+    """Read and write until the deadline and report (latencies in ms, errors)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'Content-Type': 'application/json'}
+    latencies, errors, done = [], 0, 0
+    while time.perf_counter() < deadline:
+        kind = (number + done) % 4
+        if kind == 0:
+            body = {'habit_id': done % habits + 1, 'log_date': day, 'hours_spent': 0.5, 'completed': True}
+            method, path, payload = 'POST', '/api/habit-logs', json.dumps(body)
+        elif kind == 1:
+            method, path, payload = 'GET', '/api/habits', None
+        else:
+            method, path, payload = 'GET', f'/api/time-blocks?date={day}', None
+        started = time.perf_counter()
+        conn.request(method, path, payload, headers)
+        response = conn.getresponse()
+        response.read()
+        latencies.append((time.perf_counter() - started) * 1000)
+        if response.status != 200:
+            errors += 1
+        done += 1
+    conn.close()
+    results.put((latencies, errors))
+
+
+def run(mode, workers, threads, path, day, habits, clients, seconds, backup_dir):
+    port = free_port()
+    env = dict(os.environ, ONTRACK_DATABASE=path, ONTRACK_WORKERS=str(workers),
+               ONTRACK_THREADS=str(threads), ONTRACK_BIND=f'127.0.0.1:{port}',
+               ONTRACK_BACKUP_DIR=backup_dir, ONTRACK_BACKUP_KEEP='1', **(MODES[mode] or {}))
+    server = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py'], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    backups = []
+    try:
+        wait_for(port)
+        results = multiprocessing.Queue()
+        deadline = time.perf_counter() + seconds
+        procs = [multiprocessing.Process(target=client, args=(port, i, day, habits, deadline, results))
+                 for i in range(clients)]
+        for proc in procs:
+            proc.start()
+        if MODES[mode] is not None:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+            while time.perf_counter() < deadline:
+                conn.request('POST', '/api/admin/backup')
+                response = conn.getresponse()
+                body = json.loads(response.read())
+                if response.status == 200:
+                    backups.append(body)
+            conn.close()
+        counts = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+    finally:
+        server.terminate()
+        server.wait()
+    latencies = sorted(ms for values, _ in counts for ms in values)
+    durations = sorted(result['seconds'] for result in backups)
+    return {'mode': mode, 'requests_per_sec': round(len(latencies) / seconds, 1),
+            'errors': sum(errors for _, errors in counts),
+            'p50_ms': round(percentile(latencies, 50), 3), 'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3), 'max_ms': round(latencies[-1], 3) if latencies else None,
+            'backups': len(backups),
+            'backup_median_s': durations[len(durations) // 2] if durations else None,
+            'backup_max_s': durations[-1] if durations else None,
+            'restarts': sum(result['restarts'] for result in backups),
+            'single_step': sum(result['single_step'] for result in backups),
+            'backup_bytes': backups[-1]['bytes'] if backups else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--years', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=8, help='client processes')
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        app = ontrack.create_app({'DATABASE': path})
+        ontrack.setup_database(app)
+        with app.app_context():
+            counts = generate(ontrack.get_db(), years=args.years)
+        ontrack.db.close_pools(app)
+        print(json.dumps({'dataset': counts, 'database_bytes': os.path.getsize(path), 'cpus': os.cpu_count()}))
+
+        for mode in args.modes:
+            print(json.dumps(run(mode, args.workers, args.threads, path, counts['end_date'], counts['habits'],
+                                 args.clients, args.seconds, os.path.join(tmp, 'backups'))))
+
+
+if __name__ == '__main__':
+    main()
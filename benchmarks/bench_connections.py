@@ -0,0 +1,99 @@
+"""Compare request throughput of connect-per-request against the pooled WAL layer
+
+Runs the app on a threaded local server and drives it with concurrent
+keep-alive clients issuing a read-heavy mix of day views and inserts.
+
+    python benchmarks/bench_connections.py --clients 16 --seconds 10
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from werkzeug.serving import make_server  # noqa: E402
+
+import app as ontrack  # noqa: E402
+
+MODES = {
+    # What get_db() did before the pool: a fresh rollback-journal connection per request
+    'legacy': {'DB_POOL_SIZE': 0, 'DB_PRAGMAS': (('journal_mode', 'DELETE'),)},
+    'pooled': {'DB_POOL_SIZE': 8},
+}
+
+
+def serve(mode, path):
+    """Start the app on an ephemeral port using the given connection mode"""
+    app = ontrack.app
+    app.config.update(DATABASE=path, DB_POOL_SIZE=8, DB_PRAGMAS=ontrack.db.PRAGMAS)
+    app.config.update(MODES[mode])
+    app.extensions['ontrack_db'] = {}
+    with app.app_context():
+        ontrack.init_db()
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def client(port, deadline, write_every, results):
+    """Issue requests until the deadline, recording the number completed"""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'Content-Type': 'application/json'}
+    # Every client writes the same slot, so let the blocks overlap
+    body = json.dumps({'block_date': '2024-01-01', 'start_time': '09:00',
+                       'end_time': '10:00', 'activity': 'bench', 'overlap': 'allow'})
+    done = errors = 0
+    while time.perf_counter() < deadline:
+        if write_every and done % write_every == 0:
+            conn.request('POST', '/api/time-blocks', body, headers)
+        else:
+            conn.request('GET', '/api/time-blocks?date=2024-01-01')
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            errors += 1
+        done += 1
+    conn.close()
+    results.append((done, errors))
+
+
+def run(mode, clients, seconds, write_every):
+    with tempfile.TemporaryDirectory() as tmp:
+        server = serve(mode, os.path.join(tmp, 'bench.db'))
+        results = []
+        deadline = time.perf_counter() + seconds
+        threads = [threading.Thread(target=client, args=(server.port, deadline, write_every, results))
+                   for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        server.shutdown()
+        ontrack.db.close_pools(ontrack.app)
+    total = sum(done for done, _ in results)
+    errors = sum(err for _, err in results)
+    return {'mode': mode, 'requests': total, 'errors': errors,
+            'req_per_sec': round(total / seconds, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--write-every', type=int, default=10,
+                        help='make every Nth request a POST (0 for read-only)')
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    for mode in MODES:
+        print(json.dumps(run(mode, args.clients, args.seconds, args.write_every)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Time the CSV importers on large generated files
+
+Writes a time-block CSV and a habit-log CSV of --rows rows each to a temp
+directory, uploads them through /import/timeblocks and /import/habits, and
+reports rows/s plus the process's peak RSS growth.
+
+    python benchmarks/bench_import.py --rows 1000000
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as ontrack  # noqa: E402
+from synthetic import ACTIVITIES  # noqa: E402
+
+
+def write_files(directory, rows, seed=42):
+    """Write matching time-block and habit-log CSVs, returning their paths"""
+    rng = random.Random(seed)
+    start = date(2000, 1, 1)
+    blocks_path = os.path.join(directory, 'timeblocks.csv')
+    habits_path = os.path.join(directory, 'habits.csv')
+
+    with open(blocks_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Date', 'Start Time', 'End Time', 'Activity', 'Duration (minutes)', 'Category', 'Task'])
+        for i in range(rows):
+            day = (start + timedelta(days=i // 16)).isoformat()
+            hour = i % 16 + 6
+            writer.writerow([day, f'{hour:02d}:00', f'{hour:02d}:45', rng.choice(ACTIVITIES), 45,
+                             f'Category {rng.randint(1, 8)}', f'Task {rng.randint(1, 40)}'])
+
+    with open(habits_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Habit Name', 'Type', 'Target Hours', 'Date', 'Hours Spent', 'Completed', 'Notes'])
+        for i in range(rows):
+            day = (start + timedelta(days=i // 20)).isoformat()
+            writer.writerow([f'Habit {i % 20 + 1}', 'daily', '', day, '', rng.choice(('1', '0')), ''])
+
+    return blocks_path, habits_path
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = ontrack.app
+        app.config['DATABASE'] = os.path.join(tmp, 'bench.db')
+        app.extensions['ontrack_db'] = {}
+        with app.app_context():
+            ontrack.init_db()
+            conn = ontrack.get_db()
+            for i in range(1, 9):
+                conn.execute('INSERT INTO categories (name) VALUES (?)', (f'Category {i}',))
+            for i in range(1, 41):
+                conn.execute('INSERT INTO tasks (name, category_id) VALUES (?, ?)', (f'Task {i}', i % 8 + 1))
+            conn.commit()
+
+        files = write_files(tmp, args.rows)
+        client = app.test_client()
+        for url, path in zip(('/import/timeblocks', '/import/habits'), files):
+            rss_before = peak_rss_mb()
+            started = time.perf_counter()
+            with open(path, 'rb') as f:
+                result = client.post(url, data={'file': (f, os.path.basename(path))},
+                                     content_type='multipart/form-data').get_json()
+            elapsed = time.perf_counter() - started
+            print(json.dumps({'endpoint': url, 'rows': args.rows, 'imported': result['imported'],
+                              'seconds': round(elapsed, 2), 'rows_per_sec': round(args.rows / elapsed),
+                              'file_mb': round(os.path.getsize(path) / 2 ** 20, 1),
+                              'peak_rss_growth_mb': round(peak_rss_mb() - rss_before, 1)}))
+        ontrack.db.close_pools(app)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Bytes on the wire and encoding CPU of the large JSON responses
+
+Seeds a synthetic history and requests the biggest read endpoints (a page
+of 1000 time blocks, a day of time blocks, the daily category series over
+the whole history and the habit report) through the test client under
+each configuration, from Flask's stock JSON encoding with no compression
+to orjson, gzip and ?shape=columns. For each it reports the body size as
+sent, the CPU time of the whole request and, separately, of turning the
+payload into JSON and of gzipping it. The analytics cache is off so every
+request does its queries.
+
+    python benchmarks/bench_responses.py --years 5 --repeat 20
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as ontrack  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+# Name -> (settings, query string added to every URL, Accept-Encoding)
+CONFIGS = {
+    'stock': ({'FAST_JSON': False, 'COMPRESS_MIN_BYTES': 0}, '', None),
+    'fast_json': ({'COMPRESS_MIN_BYTES': 0}, '', None),
+    'gzip_1': ({'COMPRESS_LEVEL': 1}, '', 'gzip'),
+    'gzip_5': ({'COMPRESS_LEVEL': 5}, '', 'gzip'),
+    'gzip_9': ({'COMPRESS_LEVEL': 9}, '', 'gzip'),
+    'columns': ({'COMPRESS_MIN_BYTES': 0}, 'shape=columns', None),
+    'columns_gzip_5': ({'COMPRESS_LEVEL': 5}, 'shape=columns', 'gzip'),
+}
+
+
+def endpoints(counts):
+    start, end = counts['start_date'], counts['end_date']
+    return {
+        'time_blocks_page': f'/api/time-blocks?start_date={start}&end_date={end}&limit=1000',
+        'time_blocks_day': f'/api/time-blocks?date={end}',
+        'category_series': f'/api/analytics/series?start_date={start}&end_date={end}',
+        'habit_report': f'/api/analytics/habits?start_date={start}&end_date={end}',
+    }
+
+
+def measure(app, url, extra, encoding, repeat):
+    client = app.test_client()
+    url += ('&' if '?' in url else '?') + extra if extra else ''
+    headers = {'Accept-Encoding': encoding} if encoding else {}
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200, response.data
+    started = time.process_time()
+    for _ in range(repeat):
+        client.get(url, headers=headers)
+    request_ms = (time.process_time() - started) * 1000 / repeat
+
+    payload = client.get(url).get_json()
+    with app.app_context():
+        started = time.process_time()
+        for _ in range(repeat):
+            body = app.json.response(payload).get_data()
+        encode_ms = (time.process_time() - started) * 1000 / repeat
+    gzip_ms = 0.0
+    if response.headers.get('Content-Encoding') == 'gzip':
+        started = time.process_time()
+        for _ in range(repeat):
+            zlib.compress(body, app.config['COMPRESS_LEVEL'], wbits=31)
+        gzip_ms = (time.process_time() - started) * 1000 / repeat
+    return {'bytes': len(response.data), 'request_cpu_ms': round(request_ms, 3),
+            'encode_cpu_ms': round(encode_ms, 3), 'gzip_cpu_ms': round(gzip_ms, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--configs', nargs='+', choices=CONFIGS, default=list(CONFIGS))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        app = ontrack.create_app({'DATABASE': path})
+        ontrack.setup_database(app)
+        with app.app_context():
+            counts = generate(ontrack.get_db(), years=args.years)
+        ontrack.db.close_pools(app)
+        print(json.dumps({'dataset': counts}))
+
+        urls = endpoints(counts)
+        baseline = {}
+        for name in args.configs:
+            settings, extra, encoding = CONFIGS[name]
+            app = ontrack.create_app(dict(settings, DATABASE=path, ANALYTICS_CACHE_BYTES=0))
+            for endpoint, url in urls.items():
+                result = measure(app, url, extra, encoding, args.repeat)
+                baseline.setdefault(endpoint, result)
+                print(json.dumps({'config': name, 'endpoint': endpoint, **result,
+                                  'bytes_vs_first': round(result['bytes'] / baseline[endpoint]['bytes'], 3)}))
+            ontrack.db.close_pools(app)
+
+
+if __name__ == '__main__':
+    main()
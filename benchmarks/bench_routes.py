@@ -0,0 +1,348 @@
+"""Latency percentiles for every API route on a seeded synthetic database
+
+Seeds a database with benchmarks/synthetic.py, then runs one scenario per
+route (page, CRUD, day views, ranges and pages, batches, analytics, export
+and import) through Flask's test client, which measures the app alone, and
+through gunicorn over HTTP, which adds the server and the network stack.
+Each scenario reports p50/p95/p99 latency in milliseconds as one JSON line;
+--output also writes the whole run, tagged with the git commit, to a file
+that a later run can --compare against.
+
+    python benchmarks/bench_routes.py --years 3 --repeat 200 --output before.json
+    python benchmarks/bench_routes.py --years 3 --repeat 200 --compare before.json
+"""
+import argparse
+import csv
+import http.client
+import io
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import app as ontrack  # noqa: E402
+from bench_workers import free_port, wait_for  # noqa: E402
+from synthetic import ACTIVITIES, generate  # noqa: E402
+
+# path and body may be callables of (i, state); setup(send, n) returns that state
+Scenario = namedtuple('Scenario', 'name method path body setup max_repeat', defaults=(None, None, None, None))
+
+BOUNDARY = 'ontrack-bench-boundary'
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of sorted samples"""
+    rank = max(1, -(-len(samples) * pct // 100))
+    return samples[int(rank) - 1]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'p50_ms': round(percentile(samples, 50), 3),
+        'p95_ms': round(percentile(samples, 95), 3),
+        'p99_ms': round(percentile(samples, 99), 3),
+        'mean_ms': round(sum(samples) / len(samples), 3),
+        'max_ms': round(samples[-1], 3),
+    }
+
+
+def upload(filename, rows, header):
+    """multipart/form-data body holding rows as a CSV file field"""
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: text/csv\r\n\r\n{text.getvalue()}\r\n--{BOUNDARY}--\r\n').encode()
+
+
+def created(send, n, path, body):
+    """Create n rows through the API, returning their ids"""
+    return [json.loads(send('POST', path, json.dumps(body(i)).encode(), 'application/json')[1])['id']
+            for i in range(n)]
+
+
+def scenarios(dataset, import_rows):
+    """The scenarios, reads first so the writes don't shift what they measure"""
+    end = date.fromisoformat(dataset['end_date'])
+    days = (end - date.fromisoformat(dataset['start_date'])).days + 1
+    habits, categories = dataset['habits'], dataset['categories']
+    # Every seeded row got one change log entry, in order
+    synced = sum(dataset[table] for table in ('categories', 'tasks', 'habits', 'time_blocks', 'habit_logs'))
+
+    def day(i):
+        return (end - timedelta(days=i % days)).isoformat()
+
+    def month(i):
+        return f'start_date={day(i + 30)}&end_date={day(i)}'
+
+    def year(i):
+        return f'start_date={day(i + 364)}&end_date={day(i)}'
+
+    def block(i, slot=0):
+        # Days after the seeded history, one hour per scenario, so no write overlaps another
+        return {'block_date': (end + timedelta(days=1 + i)).isoformat(), 'start_time': f'{slot:02d}:00',
+                'end_time': f'{slot:02d}:30', 'activity': 'bench', 'category_id': i % categories + 1}
+
+    def log(i):
+        return {'habit_id': i % habits + 1, 'log_date': day(i), 'completed': i % 3 != 0}
+
+    def block_rows(i):
+        return [[day(i * import_rows + j), '23:30', '23:45', ACTIVITIES[j % len(ACTIVITIES)], 15,
+                 f'Category {j % categories + 1}', ''] for j in range(import_rows)]
+
+    def log_rows(i):
+        return [[f'Habit {j % habits + 1}', '', '', day(i * import_rows + j), '', '1', 'bench']
+                for j in range(import_rows)]
+
+    return [
+        Scenario('index', 'GET', '/'),
+        Scenario('habits_list', 'GET', '/api/habits'),
+        Scenario('habits_page', 'GET', '/api/habits?limit=10'),
+        Scenario('habit_progress', 'GET', lambda i, _: f'/api/habit-progress/{i % habits + 1}'),
+        Scenario('habit_logs_day', 'GET', lambda i, _: f'/api/habit-logs?date={day(i)}'),
+        Scenario('habit_logs_range_page', 'GET', lambda i, _: f'/api/habit-logs?{month(i)}&limit=100'),
+        Scenario('categories_list', 'GET', '/api/categories'),
+        Scenario('tasks_list', 'GET', '/api/tasks'),
+        Scenario('tasks_page', 'GET', '/api/tasks?limit=20'),
+        Scenario('time_blocks_day', 'GET', lambda i, _: f'/api/time-blocks?date={day(i)}'),
+        Scenario('time_blocks_range_page', 'GET', lambda i, _: f'/api/time-blocks?{month(i)}&limit=100'),
+        # Single rows, what live updates fetch instead of whole lists
+        Scenario('habit_get', 'GET', lambda i, _: f'/api/habits/{i % habits + 1}'),
+        Scenario('habit_log_get', 'GET', lambda i, _: f"/api/habit-logs/{i % dataset['habit_logs'] + 1}"),
+        Scenario('category_get', 'GET', lambda i, _: f'/api/categories/{i % categories + 1}'),
+        Scenario('task_get', 'GET', lambda i, _: f"/api/tasks/{i % dataset['tasks'] + 1}"),
+        Scenario('time_block_get', 'GET', lambda i, _: f"/api/time-blocks/{i % dataset['time_blocks'] + 1}"),
+        Scenario('sync_full_page', 'GET', '/api/sync?limit=500'),
+        Scenario('sync_delta_50', 'GET', f'/api/sync?since={max(synced - 50, 0)}'),
+        Scenario('search_word', 'GET', '/api/search?q=reading'),
+        Scenario('search_prefix_year', 'GET', lambda i, _: f'/api/search?q=wor&{year(i)}'),
+        # A fresh range per request misses the result cache; a repeated one hits it
+        Scenario('analytics_year', 'GET', lambda i, _: f'/api/analytics?{year(i)}'),
+        Scenario('analytics_cached', 'GET', lambda i, _: f'/api/analytics?{year(0)}'),
+        Scenario('analytics_tasks_year', 'GET', lambda i, _: f'/api/analytics/tasks?{year(i)}'),
+        Scenario('analytics_habits_year', 'GET', lambda i, _: f'/api/analytics/habits?{year(i)}'),
+        Scenario('analytics_series_week', 'GET', lambda i, _: f'/api/analytics/series?bucket=week&{year(i)}'),
+        Scenario('analytics_cache_stats', 'GET', '/api/analytics/cache'),
+        Scenario('metrics', 'GET', '/metrics'),
+        Scenario('export_timeblocks_month', 'GET', lambda i, _: f'/export/timeblocks?{month(i)}'),
+        Scenario('export_habits_month', 'GET', lambda i, _: f'/export/habits?{month(i)}'),
+        Scenario('export_timeblocks_all', 'GET', '/export/timeblocks', max_repeat=5),
+        Scenario('export_habits_all', 'GET', '/export/habits', max_repeat=5),
+
+        Scenario('habits_create', 'POST', '/api/habits',
+                 lambda i, _: {'name': f'Bench habit {i}', 'habit_type': 'daily'}),
+        Scenario('categories_create', 'POST', '/api/categories', lambda i, _: {'name': f'Bench category {i}'}),
+        Scenario('tasks_create', 'POST', '/api/tasks',
+                 lambda i, _: {'name': f'Bench task {i}', 'category_id': i % categories + 1}),
+        Scenario('time_blocks_create', 'POST', '/api/time-blocks', lambda i, _: block(i)),
+        Scenario('habit_logs_create', 'POST', '/api/habit-logs', lambda i, _: log(i)),
+        Scenario('time_blocks_batch_16', 'POST', '/api/time-blocks/batch',
+                 lambda i, _: {'blocks': [block(i * 16 + j, 1) for j in range(16)]}),
+        Scenario('habit_logs_batch_16', 'POST', '/api/habit-logs/batch',
+                 lambda i, _: {'logs': [log(i * 16 + j) for j in range(16)]}),
+        Scenario('categories_update', 'PUT', lambda i, ids: f'/api/categories/{ids[i]}',
+                 lambda i, _: {'name': f'Renamed category {i}'},
+                 lambda send, n: created(send, n, '/api/categories', lambda i: {'name': f'Edit category {i}'})),
+        Scenario('tasks_update', 'PUT', lambda i, ids: f'/api/tasks/{ids[i]}',
+                 lambda i, _: {'name': f'Renamed task {i}', 'category_id': 1},
+                 lambda send, n: created(send, n, '/api/tasks', lambda i: {'name': f'Edit task {i}'})),
+        Scenario('time_blocks_update', 'PUT', lambda i, ids: f'/api/time-blocks/{ids[i]}',
+                 lambda i, _: dict(block(i, 2), activity='edited'),
+                 lambda send, n: created(send, n, '/api/time-blocks', lambda i: block(i, 2))),
+        Scenario('habit_logs_update', 'PUT', lambda i, ids: f'/api/habit-logs/{ids[i]}',
+                 lambda i, _: {'completed': i % 2 == 0, 'notes': 'edited'},
+                 lambda send, n: created(send, n, '/api/habit-logs', log)),
+        Scenario('time_blocks_delete', 'DELETE', lambda i, ids: f'/api/time-blocks/{ids[i]}',
+                 setup=lambda send, n: created(send, n, '/api/time-blocks', lambda i: block(i, 3))),
+        Scenario('habit_logs_delete', 'DELETE', lambda i, ids: f'/api/habit-logs/{ids[i]}',
+                 setup=lambda send, n: created(send, n, '/api/habit-logs', log)),
+        Scenario('tasks_delete', 'DELETE', lambda i, ids: f'/api/tasks/{ids[i]}',
+                 setup=lambda send, n: created(send, n, '/api/tasks', lambda i: {'name': f'Gone task {i}'})),
+        Scenario('categories_delete', 'DELETE', lambda i, ids: f'/api/categories/{ids[i]}',
+                 setup=lambda send, n: created(send, n, '/api/categories',
+                                               lambda i: {'name': f'Gone category {i}'})),
+        Scenario('habits_delete', 'DELETE', lambda i, ids: f'/api/habits/{ids[i]}',
+                 setup=lambda send, n: created(send, n, '/api/habits',
+                                               lambda i: {'name': f'Gone habit {i}', 'habit_type': 'daily'})),
+        Scenario('import_timeblocks', 'POST', '/import/timeblocks',
+                 lambda i, _: upload('timeblocks.csv', block_rows(i), ['Date', 'Start Time', 'End Time', 'Activity',
+                                                                      'Duration (minutes)', 'Category', 'Task']),
+                 max_repeat=20),
+        Scenario('import_habits', 'POST', '/import/habits',
+                 lambda i, _: upload('habits.csv', log_rows(i), ['Habit Name', 'Type', 'Target Hours', 'Date',
+                                                                'Hours Spent', 'Completed', 'Notes']),
+                 max_repeat=20),
+    ]
+
+
+def encode(body):
+    """Request body and content type for a scenario body"""
+    if body is None:
+        return None, None
+    if isinstance(body, bytes):
+        return body, f'multipart/form-data; boundary={BOUNDARY}'
+    return json.dumps(body).encode(), 'application/json'
+
+
+def test_client_sender(app):
+    client = app.test_client()
+
+    def send(method, path, body=None, content_type=None):
+        response = client.open(path, method=method, data=body, content_type=content_type)
+        return response.status_code, response.get_data()
+    return send, lambda: None
+
+
+def http_sender(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+
+    def send(method, path, body=None, content_type=None):
+        conn.request(method, path, body, {'Content-Type': content_type} if content_type else {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    return send, conn.close
+
+
+def run(target, send, scenario_list, repeat):
+    """Run every scenario, returning one result dict per scenario"""
+    results = []
+    for scenario in scenario_list:
+        n = min(repeat, scenario.max_repeat or repeat)
+        state = scenario.setup(send, n) if scenario.setup else None
+        samples, errors = [], 0
+        for i in range(n):
+            path = scenario.path(i, state) if callable(scenario.path) else scenario.path
+            body, content_type = encode(scenario.body(i, state) if scenario.body else None)
+            started = time.perf_counter()
+            status, _ = send(scenario.method, path, body, content_type)
+            samples.append((time.perf_counter() - started) * 1000)
+            if status >= 400:
+                errors += 1
+        result = dict({'target': target, 'scenario': scenario.name, 'requests': n, 'errors': errors},
+                      **summarize(samples))
+        print(json.dumps(result), flush=True)
+        results.append(result)
+    return results
+
+
+def seed(path, args):
+    # The bulk inserts are expected to be slow; keep them out of the slow query log
+    app = ontrack.create_app({'DATABASE': path, 'SLOW_QUERY_MS': 0})
+    ontrack.setup_database(app)
+    with app.app_context():
+        dataset = generate(ontrack.get_db(), years=args.years, categories=args.categories,
+                           tasks_per_category=args.tasks_per_category, habits=args.habits, seed=args.seed)
+    ontrack.db.close_pools(app)
+    return dataset
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline_path, results, threshold):
+    """Print p50/p95 ratios against a baseline run; return the regressed scenarios"""
+    with open(baseline_path) as f:
+        baseline = {(r['target'], r['scenario']): r for r in json.load(f)['results']}
+    regressed = []
+    for result in results:
+        before = baseline.get((result['target'], result['scenario']))
+        if before is None:
+            continue
+        ratios = {key: round(result[key] / before[key], 2) if before[key] else None
+                  for key in ('p50_ms', 'p95_ms')}
+        slower = any(ratio is not None and ratio > threshold for ratio in ratios.values())
+        if slower:
+            regressed.append(result['scenario'])
+        print(json.dumps({'compare': result['scenario'], 'target': result['target'],
+                          'p50_ratio': ratios['p50_ms'], 'p95_ratio': ratios['p95_ms'], 'regressed': slower}))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--habits', type=int, default=20)
+    parser.add_argument('--categories', type=int, default=8)
+    parser.add_argument('--tasks-per-category', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=100, help='requests per scenario')
+    parser.add_argument('--import-rows', type=int, default=500, help='CSV rows per import request')
+    parser.add_argument('--targets', nargs='+', choices=('client', 'http'), default=['client', 'http'])
+    parser.add_argument('--only', nargs='+', metavar='SCENARIO', help='run only these scenarios')
+    parser.add_argument('--output', help='write the run as one JSON document')
+    parser.add_argument('--compare', metavar='BASELINE', help='a previous --output file to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='p50 or p95 ratio above which --compare reports a regression')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        seeded = os.path.join(tmp, 'seed.db')
+        dataset = seed(seeded, args)
+        meta = {'commit': git_commit(), 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                'cpus': os.cpu_count(), 'repeat': args.repeat, 'dataset': dataset}
+        print(json.dumps(meta))
+
+        scenario_list = scenarios(dataset, args.import_rows)
+        if args.only:
+            scenario_list = [s for s in scenario_list if s.name in args.only]
+
+        results = []
+        for target in args.targets:
+            # Every target starts from an identical copy of the seeded database
+            path = os.path.join(tmp, f'{target}.db')
+            source = sqlite3.connect(seeded)
+            with sqlite3.connect(path) as dest:
+                source.backup(dest)
+            source.close()
+
+            if target == 'client':
+                app = ontrack.create_app({'DATABASE': path})
+                send, close = test_client_sender(app)
+                try:
+                    results += run(target, send, scenario_list, args.repeat)
+                finally:
+                    close()
+                    ontrack.db.close_pools(app)
+                continue
+
+            port = free_port()
+            env = dict(os.environ, ONTRACK_DATABASE=path, ONTRACK_WORKERS='1',
+                       ONTRACK_BIND=f'127.0.0.1:{port}')
+            server = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py'], cwd=ROOT, env=env,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_for(port)
+                send, close = http_sender(port)
+                try:
+                    results += run(target, send, scenario_list, args.repeat)
+                finally:
+                    close()
+            finally:
+                server.terminate()
+                server.wait()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+    if args.compare and compare(args.compare, results, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""Time /api/search on a large text history against LIKE scans
+
+Seeds categories, tasks and habits with benchmarks/synthetic.py, then adds
+--rows time blocks and habit logs (three quarters blocks) whose activities
+and notes are drawn from a Zipf-distributed vocabulary, so some words are
+in a large share of rows and most are rare. Reports how long loading took
+with the search triggers and, on a sample, without them, then times
+searches for common, mid-frequency and rare words, prefixes, multi-word
+queries and filtered queries through the endpoint, next to the
+`LIKE '%word%'` scans the same question needs without the index: one that
+stops at the newest matches and one that reads every match, as ranking
+must.
+
+    python benchmarks/bench_search.py --rows 1000000 --repeat 10
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as ontrack  # noqa: E402
+import clock  # noqa: E402
+import search  # noqa: E402
+from bench_analytics import timed  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ren', 'ta', 'vo', 'shi', 'pe', 'dar', 'nu', 'gel', 'co', 'bri', 'sa', 'fen', 'tu')
+BATCH = 10000
+
+
+def vocabulary(size, rng):
+    """`size` distinct made-up words, most frequent first"""
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words, key=lambda word: (len(word), word))
+
+
+def texts(count, words, rng, length=(2, 6)):
+    """Random phrases with Zipf word frequencies"""
+    weights = [0] * len(words)
+    total = 0
+    for rank in range(len(words)):
+        total += 1 / (rank + 1)
+        weights[rank] = total
+    for _ in range(count):
+        yield ' '.join(rng.choices(words, cum_weights=weights, k=rng.randint(*length)))
+
+
+def load(conn, rows, counts, words, rng):
+    """Insert the text-bearing blocks and logs; returns rows per second"""
+    start_day = clock.day(counts['start_date'])
+    days = clock.day(counts['end_date']) - start_day + 1
+    block_count = rows * 3 // 4
+    started = time.perf_counter()
+    phrases = texts(rows, words, rng)
+    for offset in range(0, rows, BATCH):
+        size = min(BATCH, rows - offset)
+        if offset < block_count:
+            size = min(size, block_count - offset)
+            batch = [(start_day + rng.randrange(days), 540, 600, next(phrases),
+                      rng.randint(1, counts['categories']), None) for _ in range(size)]
+            conn.executemany('''
+                INSERT INTO time_blocks (day, start_minute, end_minute, activity, category_id, task_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', batch)
+        else:
+            batch = [(rng.randint(1, counts['habits']), start_day + rng.randrange(days), next(phrases))
+                     for _ in range(size)]
+            conn.executemany('INSERT INTO habit_logs (habit_id, day, completed, notes) VALUES (?, ?, 1, ?)', batch)
+        conn.commit()
+    return round(rows / (time.perf_counter() - started))
+
+
+def like_scan(conn, word, limit, start_date=None, end_date=None, category_id=None):
+    """The same question without the index: substring scans of both tables
+
+    With a limit the newest matches come back as soon as `limit` are found,
+    which is quick for common words; ranking them needs every match, so
+    limit=None reads them all.
+    """
+    conditions, params = ['activity LIKE ?'], [f'%{word}%']
+    if start_date:
+        conditions.append('day BETWEEN ? AND ?')
+        params += [clock.day(start_date), clock.day(end_date)]
+    if category_id:
+        conditions.append('category_id = ?')
+        params.append(category_id)
+    order = 'ORDER BY day DESC LIMIT ?' if limit else ''
+    tail = [limit] if limit else []
+    rows = conn.execute(f"SELECT id FROM time_blocks WHERE {' AND '.join(conditions)} {order}",
+                        params + tail).fetchall()
+    if not category_id:
+        conditions[0], params[0] = 'notes LIKE ?', f'%{word}%'
+        rows += conn.execute(f"SELECT id FROM habit_logs WHERE {' AND '.join(conditions)} {order}",
+                             params + tail).fetchall()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000, help='time blocks and habit logs with text')
+    parser.add_argument('--words', type=int, default=20000, help='vocabulary size')
+    parser.add_argument('--sample', type=int, default=50000, help='rows loaded to time the triggers')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = ontrack.create_app({'DATABASE': os.path.join(tmp, 'bench.db')})
+        ontrack.setup_database(app)
+        with app.app_context():
+            counts = generate(ontrack.get_db(), years=1, blocks_per_day=(0, 0), log_probability=0)
+        words = vocabulary(args.words, rng)
+        conn = ontrack.db.connect(app.config['DATABASE'])
+
+        # Write cost of the index: a sample loaded without its triggers, then thrown away
+        search.drop_triggers(conn)
+        conn.commit()
+        without = load(conn, args.sample, counts, words, random.Random(args.seed))
+        conn.execute('DELETE FROM time_blocks')
+        conn.execute('DELETE FROM habit_logs')
+        search.create_triggers(conn)
+        conn.commit()
+        with_index = load(conn, args.rows, counts, words, rng)
+        conn.execute('ANALYZE')
+        size = conn.execute('''
+            SELECT SUM(pgsize) FROM dbstat WHERE name LIKE 'time_blocks_fts%' OR name LIKE 'habit_logs_fts%'
+        ''').fetchone()[0] if conn.execute("SELECT 1 FROM pragma_module_list WHERE name = 'dbstat'").fetchone() else None
+        print(json.dumps({'rows': args.rows, 'words': args.words,
+                          'load_rows_per_s_with_index': with_index,
+                          'load_rows_per_s_without_index_sample': without,
+                          'index_bytes': size}))
+
+        end = counts['end_date']
+        month_start = date.fromordinal(date.fromisoformat(end).toordinal() - 30).isoformat()
+        client = app.test_client()
+        queries = {
+            'common_word': (words[0], {}),
+            'mid_word': (words[len(words) // 100], {}),
+            'rare_word': (words[len(words) // 2], {}),
+            'prefix_3': (words[len(words) // 100][:3], {}),
+            'two_words': (f'{words[1]} {words[len(words) // 100]}', {}),
+            'common_last_month': (words[0], {'start_date': month_start, 'end_date': end}),
+            'common_category': (words[0], {'category_id': 1}),
+        }
+        for name, (text, filters) in queries.items():
+            query = '&'.join(f'{key}={value}' for key, value in filters.items())
+            url = f'/api/search?q={text}&limit={args.limit}' + (f'&{query}' if query else '')
+            response = client.get(url)
+            assert response.status_code == 200, response.get_json()
+            word = text.split()[-1]
+            scan = (filters.get('start_date'), filters.get('end_date'), filters.get('category_id'))
+            matches = conn.execute("SELECT COUNT(*) FROM time_blocks_fts WHERE time_blocks_fts MATCH ?",
+                                   (search.match_expression(text),)).fetchone()[0]
+            print(json.dumps({
+                'query': name, 'q': text, 'filters': filters,
+                'time_block_matches': matches,
+                'search_ms': timed(lambda: client.get(url), args.repeat),
+                'like_newest_ms': timed(lambda: like_scan(conn, word, args.limit, *scan), max(1, args.repeat // 5)),
+                'like_all_ms': timed(lambda: like_scan(conn, word, None, *scan), max(1, args.repeat // 5)),
+            }))
+        conn.close()
+        ontrack.db.close_pools(app)
+
+
+if __name__ == '__main__':
+    main()
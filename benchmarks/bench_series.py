@@ -0,0 +1,95 @@
+"""Time the time-series analytics endpoint on multi-year data
+
+For each bucket size compares /api/analytics/series (one grouped pass over
+the daily rollups) with the client-side alternative of one /api/analytics
+request per bucket, with the result cache disabled so every request does
+its full work. The series SQL alone is also timed against the same grouping
+done in one pass over the raw time_blocks rows.
+
+    python benchmarks/bench_series.py --years 5 --repeat 5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as ontrack  # noqa: E402
+import series  # noqa: E402
+from bench_analytics import timed  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+
+def raw_series(conn, bucket, start_date, end_date):
+    """The category series aggregated straight from time_blocks"""
+    return conn.execute(f'''
+        SELECT COALESCE(category_id, 0), {series.bucket_sql(bucket, 'block_date')} as bucket,
+               SUM(COALESCE(duration_minutes, 0)), COUNT(*)
+        FROM time_blocks
+        WHERE day BETWEEN julianday(?) - 2440587.5 AND julianday(?) - 2440587.5
+        GROUP BY COALESCE(category_id, 0), bucket
+    ''', (start_date, end_date)).fetchall()
+
+
+def rollup_series(conn, bucket, start_date, end_date):
+    """The category series from category_daily, as the endpoint queries it"""
+    return conn.execute(f'''
+        SELECT category_id, {series.bucket_sql(bucket, 'block_date')} as bucket,
+               SUM(total_minutes), SUM(block_count)
+        FROM category_daily
+        WHERE block_date BETWEEN ? AND ?
+        GROUP BY category_id, bucket
+    ''', (start_date, end_date)).fetchall()
+
+
+def per_bucket(client, starts, bucket, end_date):
+    """One /api/analytics request per bucket, as a chart would do without the series API"""
+    for i, start in enumerate(starts):
+        last = starts[i + 1] - timedelta(days=1) if i + 1 < len(starts) else end_date
+        client.get(f'/api/analytics?start_date={start}&end_date={min(last, end_date)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--years', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = ontrack.create_app({'DATABASE': os.path.join(tmp, 'bench.db'), 'ANALYTICS_CACHE_BYTES': 0})
+        ontrack.setup_database(app)
+        with app.app_context():
+            counts = generate(ontrack.get_db(), years=args.years)
+        print(json.dumps({'dataset': counts}))
+
+        start_date, end_date = counts['start_date'], counts['end_date']
+        client = app.test_client()
+        conn = ontrack.db.connect(app.config['DATABASE'])
+        for bucket in series.BUCKETS:
+            starts = series.bucket_starts(bucket, date.fromisoformat(start_date), date.fromisoformat(end_date))
+            url = f'/api/analytics/series?bucket={bucket}&start_date={start_date}&end_date={end_date}'
+            response = client.get(url).get_json()
+            assert sum(sum(s['total_minutes']) for s in response['series']) == \
+                sum(row[2] for row in raw_series(conn, bucket, start_date, end_date)), 'totals differ'
+
+            result = {
+                'bucket': bucket,
+                'buckets': len(starts),
+                'series_ms': timed(lambda: client.get(url), args.repeat),
+                'rollup_sql_ms': timed(lambda: rollup_series(conn, bucket, start_date, end_date), args.repeat),
+                'raw_sql_ms': timed(lambda: raw_series(conn, bucket, start_date, end_date), args.repeat),
+            }
+            # The per-bucket loop is slow for day buckets; one run is enough
+            result['per_bucket_ms'] = timed(lambda: per_bucket(client, starts, bucket, date.fromisoformat(end_date)),
+                                            1 if bucket == 'day' else args.repeat)
+            result['speedup_vs_per_bucket'] = round(result['per_bucket_ms'] / result['series_ms'], 1)
+            print(json.dumps(result))
+        conn.close()
+        ontrack.db.close_pools(app)
+
+
+if __name__ == '__main__':
+    main()
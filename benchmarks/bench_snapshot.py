@@ -0,0 +1,101 @@
+"""Compare binary snapshots with the CSV exports on size, export and load time
+
+Seeds a synthetic history, exports it through /export/habits plus
+/export/timeblocks (plain and gzipped) and through /export/snapshot, then
+loads each into a fresh database through /import/habits plus
+/import/timeblocks and /import/snapshot. Checks that the snapshot round
+trip reproduces every stored column of every table.
+
+    python benchmarks/bench_snapshot.py --years 50
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as ontrack  # noqa: E402
+import snapshot  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+
+def fresh_app(path):
+    app = ontrack.create_app({'DATABASE': path})
+    ontrack.setup_database(app)
+    return app
+
+
+def timed_get(client, url):
+    started = time.perf_counter()
+    body = client.get(url).data
+    return body, time.perf_counter() - started
+
+
+def timed_upload(client, url, body):
+    started = time.perf_counter()
+    response = client.post(url, data={'file': (io.BytesIO(body), 'upload')}, content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_json()
+    return response.get_json(), time.perf_counter() - started
+
+
+def digest(path):
+    """Hash of every stored column of every table, in id order"""
+    conn = sqlite3.connect(path)
+    hashed = hashlib.sha256()
+    for table in snapshot.TABLES:
+        columns = snapshot.stored_columns(conn.cursor(), table)
+        for row in conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY id"):
+            hashed.update(repr(row).encode())
+    conn.close()
+    return hashed.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--years', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'source.db')
+        app = fresh_app(source)
+        with app.app_context():
+            counts = generate(ontrack.get_db(), years=args.years)
+        rows = sum(counts[table] for table in snapshot.TABLES)
+        print(json.dumps({'dataset': counts, 'rows': rows}))
+        client = app.test_client()
+
+        habits_csv, habits_s = timed_get(client, '/export/habits')
+        blocks_csv, blocks_s = timed_get(client, '/export/timeblocks')
+        gzipped = len(client.get('/export/habits?gzip=1').data) + len(client.get('/export/timeblocks?gzip=1').data)
+        body, snapshot_s = timed_get(client, '/export/snapshot')
+        csv_bytes = len(habits_csv) + len(blocks_csv)
+        print(json.dumps({'export': 'csv', 'bytes': csv_bytes, 'gzip_bytes': gzipped,
+                          'seconds': round(habits_s + blocks_s, 3)}))
+        print(json.dumps({'export': 'snapshot', 'bytes': len(body), 'seconds': round(snapshot_s, 3),
+                          'csv_over_snapshot': round(csv_bytes / len(body), 1),
+                          'csv_gzip_over_snapshot': round(gzipped / len(body), 1)}))
+
+        csv_client = fresh_app(os.path.join(tmp, 'csv.db')).test_client()
+        habits_result, habits_load_s = timed_upload(csv_client, '/import/habits', habits_csv)
+        blocks_result, blocks_load_s = timed_upload(csv_client, '/import/timeblocks', blocks_csv)
+        csv_rows = habits_result['imported'] + blocks_result['imported']
+        csv_load_s = habits_load_s + blocks_load_s
+        print(json.dumps({'load': 'csv', 'rows': csv_rows, 'seconds': round(csv_load_s, 3),
+                          'rows_per_sec': round(csv_rows / csv_load_s)}))
+
+        target = os.path.join(tmp, 'snapshot.db')
+        result, load_s = timed_upload(fresh_app(target).test_client(), '/import/snapshot', body)
+        print(json.dumps({'load': 'snapshot', 'rows': result['imported'], 'seconds': round(load_s, 3),
+                          'rows_per_sec': round(result['imported'] / load_s),
+                          'csv_time_over_snapshot': round(csv_load_s / load_s, 1),
+                          'round_trip_identical': digest(source) == digest(target)}))
+
+
+if __name__ == '__main__':
+    main()
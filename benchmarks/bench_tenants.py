@@ -0,0 +1,127 @@
+"""Write throughput with every client on one tenant's shard or on shards of their own
+
+Starts gunicorn with gunicorn.conf.py and ONTRACK_TENANT_DIR set, and
+drives it from separate client processes that only write time blocks and
+habit logs, as bench_writes.py does. `shared` sends every client's writes
+to one tenant, so they all meet at one SQLite write lock as on a single
+database; `own` gives each client a tenant of its own; `churn` spreads
+the clients over four times as many tenants as ONTRACK_MAX_OPEN_SHARDS
+allows open, so shards are evicted and reopened all along. Reports writes
+per second, latency percentiles and failed requests.
+
+    python benchmarks/bench_tenants.py --workers 2 --threads 8 --clients 16 --seconds 10
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from bench_routes import percentile  # noqa: E402
+from bench_workers import free_port, wait_for  # noqa: E402
+
+DAY = '2025-01-15'
+MAX_OPEN = 4
+
+
+def tenants_for(mode, clients):
+    """Each client's list of tenants to write to in turn"""
+    if mode == 'shared':
+        return [['shared']] * clients
+    if mode == 'own':
+        return [[f'client{i}'] for i in range(clients)]
+    pool = [f'churn{i}' for i in range(MAX_OPEN * 4)]
+    return [pool[i % len(pool):] + pool[:i % len(pool)] for i in range(clients)]
+
+
+def client(port, number, names, deadline, results):
+    """Write until the deadline and report (latencies in ms, errors)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'Content-Type': 'application/json'}
+    latencies, errors, done = [], 0, 0
+    while time.perf_counter() < deadline:
+        tenant = names[done % len(names)]
+        if done % 2 == 0:
+            minute = (number * 7 + done) % 1440
+            body = {'block_date': DAY, 'start_time': f'{minute // 60:02d}:{minute % 60:02d}',
+                    'end_time': '23:59', 'activity': 'Stopwatch', 'overlap': 'allow'}
+            path = f'/t/{tenant}/api/time-blocks'
+        else:
+            body = {'habit_id': 1, 'log_date': DAY, 'hours_spent': 0.5, 'completed': True}
+            path = f'/t/{tenant}/api/habit-logs'
+        started = time.perf_counter()
+        conn.request('POST', path, json.dumps(body), headers)
+        response = conn.getresponse()
+        response.read()
+        latencies.append((time.perf_counter() - started) * 1000)
+        if response.status != 200:
+            errors += 1
+        done += 1
+    conn.close()
+    results.put((latencies, errors))
+
+
+def run(mode, workers, threads, clients, seconds, tmp):
+    port = free_port()
+    tenant_dir = os.path.join(tmp, mode)
+    env = dict(os.environ, ONTRACK_DATABASE=os.path.join(tmp, 'main.db'), ONTRACK_TENANT_DIR=tenant_dir,
+               ONTRACK_MAX_OPEN_SHARDS=str(MAX_OPEN if mode == 'churn' else clients), ONTRACK_WORKERS=str(workers),
+               ONTRACK_THREADS=str(threads), ONTRACK_BIND=f'127.0.0.1:{port}')
+    server = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py'], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    assignments = tenants_for(mode, clients)
+    try:
+        wait_for(port)
+        # Create the shards and their habit first, so migrations aren't timed
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        for tenant in sorted({name for names in assignments for name in names}):
+            conn.request('POST', f'/t/{tenant}/api/habits', json.dumps({'name': 'Read', 'habit_type': 'daily'}),
+                         {'Content-Type': 'application/json'})
+            conn.getresponse().read()
+        conn.close()
+
+        results = multiprocessing.Queue()
+        deadline = time.perf_counter() + seconds
+        procs = [multiprocessing.Process(target=client, args=(port, i, names, deadline, results))
+                 for i, names in enumerate(assignments)]
+        for proc in procs:
+            proc.start()
+        counts = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+    finally:
+        server.terminate()
+        server.wait()
+    latencies = sorted(ms for values, _ in counts for ms in values)
+    return {'mode': mode, 'tenants': len({name for names in assignments for name in names}),
+            'workers': workers, 'threads': threads, 'clients': clients,
+            'writes': len(latencies), 'errors': sum(errors for _, errors in counts),
+            'writes_per_sec': round(len(latencies) / seconds, 1),
+            'p50_ms': round(percentile(latencies, 50), 3), 'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3), 'max_ms': round(latencies[-1], 3) if latencies else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', choices=('shared', 'own', 'churn'), default=['shared', 'own', 'churn'])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--clients', type=int, default=16, help='client processes')
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    print(json.dumps({'cpus': os.cpu_count()}))
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in args.modes:
+            print(json.dumps(run(mode, args.workers, args.threads, args.clients, args.seconds, tmp)))
+
+
+if __name__ == '__main__':
+    main()
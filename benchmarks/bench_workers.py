@@ -0,0 +1,122 @@
+"""Measure request throughput under gunicorn as the worker count grows
+
+Seeds a synthetic database, then for each worker count starts gunicorn with
+gunicorn.conf.py and drives it from separate client processes (so the load
+generator is not limited by one GIL) with a read-heavy mix of day views,
+analytics and inserts. Throughput should scale with workers up to the
+number of cores.
+
+    python benchmarks/bench_workers.py --workers 1 2 4 8 --clients 32 --seconds 10
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import app as ontrack  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'gunicorn did not start listening on port {port}')
+
+
+def client(port, day, deadline, write_every, results):
+    """Issue requests until the deadline and report (completed, errors)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    paths = [f'/api/time-blocks?date={day}', f'/api/habit-logs?date={day}',
+             f'/api/analytics?start_date={day[:4]}-01-01&end_date={day}', '/api/habits']
+    headers = {'Content-Type': 'application/json'}
+    # Every client writes the same slot, so let the blocks overlap
+    body = json.dumps({'block_date': day, 'start_time': '09:00', 'end_time': '10:00', 'activity': 'bench',
+                       'overlap': 'allow'})
+    done = errors = 0
+    while time.perf_counter() < deadline:
+        if write_every and done % write_every == write_every - 1:
+            conn.request('POST', '/api/time-blocks', body, headers)
+        else:
+            conn.request('GET', paths[done % len(paths)])
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            errors += 1
+        done += 1
+    conn.close()
+    results.put((done, errors))
+
+
+def run(workers, threads, path, day, clients, seconds, write_every):
+    port = free_port()
+    env = dict(os.environ, ONTRACK_DATABASE=path, ONTRACK_WORKERS=str(workers),
+               ONTRACK_THREADS=str(threads), ONTRACK_BIND=f'127.0.0.1:{port}')
+    server = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py'], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(port)
+        results = multiprocessing.Queue()
+        deadline = time.perf_counter() + seconds
+        procs = [multiprocessing.Process(target=client, args=(port, day, deadline, write_every, results))
+                 for _ in range(clients)]
+        for proc in procs:
+            proc.start()
+        counts = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+    finally:
+        server.terminate()
+        server.wait()
+    total = sum(done for done, _ in counts)
+    return {'workers': workers, 'threads': threads, 'requests': total,
+            'errors': sum(err for _, err in counts), 'req_per_sec': round(total / seconds, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, os.cpu_count() or 1}))
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=16, help='client processes')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--write-every', type=int, default=20,
+                        help='make every Nth request a POST (0 for read-only)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        app = ontrack.create_app({'DATABASE': path})
+        ontrack.setup_database(app)
+        with app.app_context():
+            counts = generate(ontrack.get_db(), years=args.years)
+        ontrack.db.close_pools(app)
+        print(json.dumps({'dataset': counts, 'cpus': os.cpu_count()}))
+
+        for workers in args.workers:
+            print(json.dumps(run(workers, args.threads, path, counts['end_date'],
+                                 args.clients, args.seconds, args.write_every)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Write throughput and latency under contention, with and without the write queue
+
+Starts gunicorn with gunicorn.conf.py on a synthetic database for each
+write mode and drives it from separate client processes that only write:
+time blocks (as the stopwatch saves them), habit logs and habit log
+edits. `direct` commits every request on its own connection, as before
+the write queue; the `queue_*` modes group-commit through writer.py with
+the given flush window. Reports writes per second, latency percentiles
+and failed requests, which include "database is locked" errors.
+
+    python benchmarks/bench_writes.py --workers 2 --threads 8 --clients 32 --seconds 10
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import app as ontrack  # noqa: E402
+from bench_routes import percentile  # noqa: E402
+from bench_workers import free_port, wait_for  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+# Mode -> environment for gunicorn
+MODES = {
+    'direct': {'ONTRACK_WRITE_BATCH_SIZE': '0'},
+    'queue_0ms': {'ONTRACK_WRITE_FLUSH_MS': '0'},
+    'queue_2ms': {'ONTRACK_WRITE_FLUSH_MS': '2'},
+}
+
+
+def client(port, number, day, habits, deadline, results):
+    """Write until the deadline and report (latencies in ms, errors)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'Content-Type': 'application/json'}
+    latencies, errors, log_id = [], 0, None
+    done = 0
+    while time.perf_counter() < deadline:
+        kind = done % 3
+        if kind == 0:
+            minute = (number * 7 + done) % 1440
+            body = {'block_date': day, 'start_time': f'{minute // 60:02d}:{minute % 60:02d}',
+                    'end_time': '23:59', 'activity': 'Stopwatch', 'overlap': 'allow'}
+            method, path = 'POST', '/api/time-blocks'
+        elif kind == 1 or log_id is None:
+            body = {'habit_id': done % habits + 1, 'log_date': day, 'hours_spent': 0.5, 'completed': True}
+            method, path = 'POST', '/api/habit-logs'
+        else:
+            body = {'hours_spent': 1.0, 'completed': True, 'notes': f'edit {done}'}
+            method, path = 'PUT', f'/api/habit-logs/{log_id}'
+        started = time.perf_counter()
+        conn.request(method, path, json.dumps(body), headers)
+        response = conn.getresponse()
+        payload = response.read()
+        latencies.append((time.perf_counter() - started) * 1000)
+        if response.status != 200:
+            errors += 1
+        elif path == '/api/habit-logs':
+            log_id = json.loads(payload)['id']
+        done += 1
+    conn.close()
+    results.put((latencies, errors))
+
+
+def run(mode, workers, threads, path, day, habits, clients, seconds):
+    port = free_port()
+    env = dict(os.environ, ONTRACK_DATABASE=path, ONTRACK_WORKERS=str(workers),
+               ONTRACK_THREADS=str(threads), ONTRACK_BIND=f'127.0.0.1:{port}', **MODES[mode])
+    server = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py'], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(port)
+        results = multiprocessing.Queue()
+        deadline = time.perf_counter() + seconds
+        procs = [multiprocessing.Process(target=client, args=(port, i, day, habits, deadline, results))
+                 for i in range(clients)]
+        for proc in procs:
+            proc.start()
+        counts = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+    finally:
+        server.terminate()
+        server.wait()
+    latencies = sorted(ms for values, _ in counts for ms in values)
+    return {'mode': mode, 'workers': workers, 'threads': threads, 'clients': clients,
+            'writes': len(latencies), 'errors': sum(errors for _, errors in counts),
+            'writes_per_sec': round(len(latencies) / seconds, 1),
+            'p50_ms': round(percentile(latencies, 50), 3), 'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3), 'max_ms': round(latencies[-1], 3) if latencies else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--clients', type=int, default=32, help='client processes')
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        app = ontrack.create_app({'DATABASE': path})
+        ontrack.setup_database(app)
+        with app.app_context():
+            counts = generate(ontrack.get_db(), years=1)
+        ontrack.db.close_pools(app)
+        print(json.dumps({'dataset': counts, 'cpus': os.cpu_count()}))
+
+        for mode in args.modes:
+            print(json.dumps(run(mode, args.workers, args.threads, path, counts['end_date'],
+                                 counts['habits'], args.clients, args.seconds)))
+
+
+if __name__ == '__main__':
+    main()
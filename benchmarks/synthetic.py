@@ -0,0 +1,88 @@
+"""Seeded synthetic data for the OnTrack benchmarks"""
+import random
+from datetime import date, timedelta
+
+COLORS = ('#667eea', '#f56565', '#48bb78', '#ed8936', '#4299e1', '#9f7aea', '#38b2ac', '#ecc94b')
+EPOCH = date(1970, 1, 1)
+ACTIVITIES = ('Deep work', 'Reading', 'Email', 'Meeting', 'Workout', 'Cooking', 'Commute',
+              'Study session', 'Code review', 'Planning', 'Walk', 'Sleep')
+
+
+def generate(conn, years=3, categories=8, tasks_per_category=5, habits=20,
+             blocks_per_day=(8, 16), log_probability=0.8, end=date(2025, 12, 31), seed=42):
+    """Fill an empty, migrated database with a reproducible history
+
+    Returns a dict of row counts per table.
+    """
+    rng = random.Random(seed)
+    cursor = conn.cursor()
+
+    category_ids = []
+    for i in range(categories):
+        cursor.execute('INSERT INTO categories (name, color) VALUES (?, ?)',
+                       (f'Category {i + 1}', COLORS[i % len(COLORS)]))
+        category_ids.append(cursor.lastrowid)
+
+    tasks_by_category = {}
+    for category_id in category_ids:
+        for j in range(tasks_per_category):
+            cursor.execute('INSERT INTO tasks (name, category_id) VALUES (?, ?)',
+                           (f'Task {category_id}.{j + 1}', category_id))
+            tasks_by_category.setdefault(category_id, []).append(cursor.lastrowid)
+
+    habit_rows = []
+    for i in range(habits):
+        habit_type = rng.choice(('daily', 'daily', 'project'))
+        target_type = rng.choice(('binary', 'percentage')) if habit_type == 'daily' else 'binary'
+        target_hours = rng.choice((50, 100, 180)) if habit_type == 'project' else None
+        cursor.execute('''
+            INSERT INTO habits (name, habit_type, target_hours, target_type)
+            VALUES (?, ?, ?, ?)
+        ''', (f'Habit {i + 1}', habit_type, target_hours, target_type))
+        habit_rows.append((cursor.lastrowid, habit_type, target_type))
+
+    start = end - timedelta(days=365 * years - 1)
+    blocks = []
+    logs = []
+    day = start
+    while day <= end:
+        number = (day - EPOCH).days
+
+        # A contiguous schedule of blocks starting at midnight
+        minute = 0
+        for _ in range(rng.randint(*blocks_per_day)):
+            length = rng.choice((15, 30, 45, 60, 90, 120))
+            if minute + length > 24 * 60 - 1:
+                break
+            category_id = rng.choice(category_ids) if rng.random() > 0.1 else None
+            task_id = None
+            if category_id and rng.random() < 0.7:
+                task_id = rng.choice(tasks_by_category[category_id])
+            blocks.append((number, minute, minute + length, rng.choice(ACTIVITIES), category_id, task_id))
+            minute += length
+
+        for habit_id, habit_type, target_type in habit_rows:
+            if rng.random() > log_probability:
+                continue
+            if habit_type == 'project':
+                logs.append((habit_id, number, rng.choice((0.5, 1, 1.5, 2, 3)), None, False, None, ''))
+            elif target_type == 'percentage':
+                pct = rng.randint(0, 100)
+                logs.append((habit_id, number, None, None, pct >= 100, pct, ''))
+            else:
+                logs.append((habit_id, number, None, None, rng.random() < 0.7, None, ''))
+        day += timedelta(days=1)
+
+    cursor.executemany('''
+        INSERT INTO time_blocks (day, start_minute, end_minute, activity, category_id, task_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', blocks)
+    cursor.executemany('''
+        INSERT INTO habit_logs (habit_id, day, hours_spent, value, completed, completion_percentage, notes)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', logs)
+    conn.commit()
+
+    return {'categories': len(category_ids), 'tasks': sum(len(t) for t in tasks_by_category.values()),
+            'habits': len(habit_rows), 'time_blocks': len(blocks), 'habit_logs': len(logs),
+            'start_date': start.isoformat(), 'end_date': end.isoformat()}
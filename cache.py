@@ -0,0 +1,268 @@
+"""In-process result cache for the analytics endpoints
+
+Entries are keyed by endpoint and query arguments, bounded by total body
+size and by age, and evicted least recently used first.
+
+Invalidation is driven by date_changes, which triggers stamp with the day a
+write touched and a global sequence number. Before every lookup the cache
+reads only the stamps newer than the last one it has seen and drops the
+entries whose range contains one of those days, so a write to today's time
+blocks leaves cached results for last quarter alone. Writes to tables
+without a date column (categories, tasks, habits) are stamped with an empty
+day and drop every entry that reads the table. Because the stamps live in
+the database, writes from other processes and from direct SQL invalidate
+too.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+import clock
+import db
+
+# Source tables and the column holding the day each row belongs to
+DATED = {'time_blocks': 'block_date', 'habit_logs': 'log_date'}
+UNDATED = ('categories', 'tasks', 'habits')
+
+_STAMP = '''
+    INSERT INTO date_changes (table_name, change_date, seq)
+    VALUES ('{table}', {day}, (SELECT COALESCE(MAX(seq), 0) + 1 FROM date_changes))
+    ON CONFLICT (table_name, change_date) DO UPDATE SET seq = excluded.seq;
+'''
+
+
+def stamp_sql(table, day="''"):
+    """Trigger statement stamping a table as changed on the day `day` evaluates to
+
+    The default empty day means the change may affect any date.
+    """
+    return _STAMP.format(table=table, day=day)
+
+
+def stamp(cursor, table, day=''):
+    """Stamp a change made with the stamp triggers suspended or outside a data table"""
+    cursor.execute('''
+        INSERT INTO date_changes (table_name, change_date, seq)
+        VALUES (?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM date_changes))
+        ON CONFLICT (table_name, change_date) DO UPDATE SET seq = excluded.seq
+    ''', (table, day))
+
+
+def _triggers():
+    for table, column in DATED.items():
+        new = stamp_sql(table, f'NEW.{column}')
+        old = stamp_sql(table, f'OLD.{column}')
+        yield table, 'INSERT', new
+        yield table, 'DELETE', old
+        yield table, 'UPDATE', old + new
+    for table in UNDATED:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            yield table, event, stamp_sql(table)
+
+
+TRIGGERS = tuple(_triggers())
+
+
+def create(cursor):
+    """Create the change stamp table and the triggers that fill it"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS date_changes (
+            table_name TEXT NOT NULL,
+            change_date TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            PRIMARY KEY (table_name, change_date)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_date_changes_seq ON date_changes (seq)')
+    create_triggers(cursor)
+
+
+def create_triggers(cursor, table=None):
+    """(Re)create the stamp triggers, optionally for one table"""
+    for source, event, body in TRIGGERS:
+        if table in (None, source):
+            name = f'{source}_stamp_{event.lower()}'
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+            cursor.execute(f'CREATE TRIGGER {name} AFTER {event} ON {source} BEGIN {body} END')
+
+
+def drop_triggers(cursor, table=None):
+    """Drop the stamp triggers ahead of a bulk load; follow with stamp_range() and create_triggers()"""
+    for source, event, _ in TRIGGERS:
+        if table in (None, source):
+            cursor.execute(f'DROP TRIGGER IF EXISTS {source}_stamp_{event.lower()}')
+
+
+def stamp_range(cursor, table, start_date, end_date):
+    """Stamp every day of a dated table that has rows between two dates"""
+    cursor.execute(f'''
+        INSERT INTO date_changes (table_name, change_date, seq)
+        SELECT ?, {clock.DATE_SQL.format('day')},
+               (SELECT COALESCE(MAX(seq), 0) FROM date_changes) + ROW_NUMBER() OVER (ORDER BY day)
+        FROM (SELECT DISTINCT day FROM {table} WHERE day BETWEEN ? AND ?)
+        WHERE true
+        ON CONFLICT (table_name, change_date) DO UPDATE SET seq = excluded.seq
+    ''', (table, clock.day(start_date), clock.day(end_date)))
+
+
+class _Entry:
+    __slots__ = ('body', 'tables', 'start_date', 'end_date', 'expires')
+
+    def __init__(self, body, tables, start_date, end_date, expires):
+        self.body = body
+        self.tables = tables
+        self.start_date = start_date
+        self.end_date = end_date
+        self.expires = expires
+
+
+class ResultCache:
+    """Thread-safe LRU of response bodies with a byte budget and a TTL
+
+    A max_bytes of 0 disables caching.
+    """
+
+    def __init__(self, max_bytes=8 * 2 ** 20, ttl=300.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.seq = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def sync(self, conn):
+        """Apply the change stamps written since the last sync, returning the new high-water mark"""
+        if self.seq is None:
+            seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM date_changes').fetchone()[0]
+            with self._lock:
+                if self.seq is None:
+                    self.seq = seq
+                return self.seq
+
+        changes = conn.execute('SELECT table_name, change_date, seq FROM date_changes WHERE seq > ? ORDER BY seq',
+                               (self.seq,)).fetchall()
+        if changes:
+            with self._lock:
+                for table, day, seq in changes:
+                    if seq > self.seq:
+                        self._invalidate(table, day)
+                        self.seq = seq
+        return self.seq
+
+    def _invalidate(self, table, day):
+        stale = [key for key, entry in self._entries.items()
+                 if table in entry.tables and (not day or entry.start_date <= day <= entry.end_date)]
+        for key in stale:
+            self._remove(key)
+        self.invalidations += len(stale)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= len(entry.body)
+
+    def get(self, key):
+        """Return a cached body, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.body
+
+    def put(self, key, body, tables, start_date, end_date, seq):
+        """Store a body computed after sync() returned seq
+
+        The body is dropped if a change was applied in the meantime, since
+        it may predate that change and the stamp has already been consumed.
+        """
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if seq != self.seq:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(body, frozenset(tables), start_date, end_date,
+                                        time.monotonic() + self.ttl)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Return the entry count, size and hit/miss/eviction counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'size_bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'seq': self.seq
+            }
+
+
+_caches_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the app's result cache for its current database"""
+    app = current_app._get_current_object()
+    caches = app.extensions['ontrack_cache']
+    path = db.database_path()
+    cache = caches.get(path)
+    if cache is None:
+        with _caches_lock:
+            cache = caches.get(path)
+            if cache is None:
+                cache = caches[path] = ResultCache(app.config['ANALYTICS_CACHE_BYTES'],
+                                                   app.config['ANALYTICS_CACHE_TTL'])
+    return cache
+
+
+def total_stats():
+    """The counters of the app's caches for every open database, added up"""
+    totals = dict.fromkeys(('entries', 'size_bytes', 'hits', 'misses', 'evictions', 'invalidations'), 0)
+    for results in list(current_app.extensions['ontrack_cache'].values()):
+        stats = results.stats()
+        for key in totals:
+            totals[key] += stats[key]
+    return totals
+
+
+def _evict(app, path):
+    app.extensions['ontrack_cache'].pop(path, None)
+
+
+def init_app(app):
+    """Register the cache settings on the app"""
+    app.config.setdefault('ANALYTICS_CACHE_BYTES',
+                          int(os.environ.get('ONTRACK_ANALYTICS_CACHE_BYTES', 8 * 2 ** 20)))
+    app.config.setdefault('ANALYTICS_CACHE_TTL', float(os.environ.get('ONTRACK_ANALYTICS_CACHE_TTL', 300)))
+    app.extensions['ontrack_cache'] = {}
+    db.on_evict(app, _evict)
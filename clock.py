@@ -0,0 +1,70 @@
+"""Integer days and minutes behind time_blocks and habit_logs
+
+Both tables store their date as `day`, the number of days since
+1970-01-01, and time blocks store their times as `start_minute` and
+`end_minute`, minutes after midnight of that day. A block ending after
+midnight keeps its day and gets an end_minute past 1440, so durations are
+always end_minute - start_minute and never negative.
+
+The ISO block_date/log_date and HH:MM start_time/end_time columns (and
+duration_minutes) are virtual columns computed from these, so responses,
+exports and the rollup triggers see the same values as before while range
+scans, sorting and duration math work on integers.
+"""
+import re
+from datetime import date, timedelta
+
+EPOCH = date(1970, 1, 1)
+MINUTES_PER_DAY = 24 * 60
+_TIME = re.compile(r'([0-9]{1,2}):([0-9]{2})')
+
+# Expressions for the virtual columns, given the integer column's name
+DATE_SQL = "date({} * 86400, 'unixepoch')"
+TIME_SQL = "printf('%02d:%02d', {0} / 60 % 24, {0} % 60)"
+
+
+class InvalidDate(ValueError):
+    """Raised when a date or time from a request can't be parsed"""
+
+
+def parse_date(text):
+    """Parse a YYYY-MM-DD date, rejecting other ISO forms that compare differently as text"""
+    try:
+        parsed = date.fromisoformat(text)
+    except (TypeError, ValueError):
+        parsed = None
+    if parsed is None or parsed.isoformat() != text:
+        raise InvalidDate(f'dates must be YYYY-MM-DD, got {text!r}')
+    return parsed
+
+
+def day(text):
+    """Day number of a YYYY-MM-DD date"""
+    return (parse_date(text) - EPOCH).days
+
+
+def iso(day_number):
+    """YYYY-MM-DD date of a day number"""
+    return (EPOCH + timedelta(days=day_number)).isoformat()
+
+
+def minute(text):
+    """Minutes after midnight of an HH:MM time"""
+    # A regex rather than strptime, which dominated the cost of CSV imports
+    match = _TIME.fullmatch(text) if isinstance(text, str) else None
+    if match is None or int(match[1]) > 23 or int(match[2]) > 59:
+        raise InvalidDate(f'times must be HH:MM, got {text!r}')
+    return int(match[1]) * 60 + int(match[2])
+
+
+def hhmm(minutes):
+    """HH:MM clock time of a minute count, wrapping past midnight"""
+    return f'{minutes // 60 % 24:02d}:{minutes % 60:02d}'
+
+
+def span(start_time, end_time):
+    """(start_minute, end_minute) of a block, ending on the next day when end_time is earlier"""
+    start, end = minute(start_time), minute(end_time)
+    if end < start:
+        end += MINUTES_PER_DAY
+    return start, end
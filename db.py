@@ -0,0 +1,302 @@
+"""SQLite connection layer shared by every route in app.py"""
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g
+
+DEFAULT_DATABASE = 'data/ontrack.db'
+
+# Applied to every new connection. WAL lets readers run alongside a writer,
+# and NORMAL sync is durable in WAL mode except on power loss.
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16000),      # 16 MB page cache per connection
+    ('mmap_size', 134217728),    # 128 MB memory-mapped reads
+    ('busy_timeout', 5000),
+)
+
+
+slow_log = logging.getLogger('ontrack.sql')
+
+# Statements EXPLAIN QUERY PLAN has something to say about
+_PLANNED = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor that charges its statements, time and fetched rows to its connection
+
+    Time spent fetching counts towards the statement that produced the
+    rows, so streamed scans are measured as well as the initial step.
+    """
+
+    def _charge(self, started, rows=0):
+        elapsed = time.perf_counter() - started
+        conn = self.connection
+        conn.sql_time += elapsed
+        conn.rows += rows
+        self._elapsed += elapsed
+        if not self._logged and conn.slow_query is not None and self._elapsed >= conn.slow_query:
+            self._logged = True
+            conn.log_slow(self._sql, self._params, self._elapsed)
+
+    def _begin(self, sql, params):
+        self._sql = sql
+        self._params = params
+        self._elapsed = 0.0
+        self._logged = False
+        self.connection.statements += 1
+
+    def execute(self, sql, params=()):
+        self._begin(sql, params)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._charge(started)
+
+    def executemany(self, sql, seq_of_params):
+        self._begin(sql, None)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            self._charge(started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._charge(started, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._charge(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._charge(started, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        row = super().__next__()
+        self._charge(started, 1)
+        return row
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """Connection that totals statements, SQLite time and rows fetched
+
+    The totals cover everything since reset_stats(); get_db() resets them
+    when a request checks the connection out, so they are per request.
+    Statements taking at least slow_query seconds are counted and logged
+    once to the ontrack.sql logger with their query plan.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slow_query = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.statements = 0
+        self.sql_time = 0.0
+        self.rows = 0
+        self.slow = 0
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            self.sql_time += time.perf_counter() - started
+
+    def log_slow(self, sql, params, elapsed):
+        self.slow += 1
+        plan = []
+        if params is not None and sql.lstrip().upper().startswith(_PLANNED):
+            try:
+                # A plain cursor, so the EXPLAIN isn't profiled itself
+                plan = [row[3] for row in sqlite3.Cursor(self).execute('EXPLAIN QUERY PLAN ' + sql, params)]
+            except sqlite3.Error as e:
+                plan = [f'(no plan: {e})']
+        slow_log.warning('Slow query took %.1f ms: %s\n  plan: %s', elapsed * 1000,
+                         ' '.join(sql.split()), '; '.join(plan) or '-')
+
+
+def connect(path, pragmas=PRAGMAS, slow_query=None):
+    """Open a new profiled SQLite connection with the given pragmas applied"""
+    conn = sqlite3.connect(path, check_same_thread=False, factory=ProfiledConnection)
+    conn.row_factory = sqlite3.Row
+    conn.slow_query = slow_query
+    for name, value in pragmas:
+        conn.execute(f'PRAGMA {name} = {value}')
+    conn.reset_stats()
+    return conn
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections handed out to request threads
+
+    A size of 0 disables pooling: every acquire opens a fresh connection
+    and every release closes it again.
+    """
+
+    def __init__(self, path, size=8, timeout=30.0, pragmas=PRAGMAS, slow_query=None):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self.slow_query = slow_query
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size) if size > 0 else None
+        self.retired = False
+
+    def acquire(self):
+        """Check out a connection, opening a new one if none are idle"""
+        if self._slots is None:
+            return connect(self.path, self.pragmas, self.slow_query)
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise RuntimeError('Timed out waiting for a database connection')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return connect(self.path, self.pragmas, self.slow_query)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        """Return a connection to the pool, discarding any open transaction"""
+        if self._slots is None:
+            conn.close()
+            return
+
+        try:
+            if self.retired:
+                # Its shard was evicted while the connection was out
+                conn.close()
+                return
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+        else:
+            self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def retire(self):
+        """Close the idle connections now and the checked-out ones as they come back"""
+        self.retired = True
+        self.close()
+
+    def close(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools_lock = threading.Lock()
+
+
+def database_path():
+    """The database file of the current request: its tenant's shard, or DATABASE"""
+    return g.get('database') or current_app.config['DATABASE']
+
+
+def on_evict(app, callback):
+    """Call `callback(app, path)` when a database leaves the app's open shards"""
+    app.extensions['ontrack_evict'].append(callback)
+
+
+def get_pool(path=None):
+    """Return the app's pool for a database file, creating it on first use
+
+    The app keeps pools for the MAX_OPEN_SHARDS most recently used database
+    files. Opening one more retires the least recently used pool and lets
+    the other per-database state go (see on_evict()).
+    """
+    app = current_app._get_current_object()
+    path = path or database_path()
+    pools = app.extensions['ontrack_db']
+    evicted = []
+    with _pools_lock:
+        pool = pools.get(path)
+        if pool is None:
+            pool = ConnectionPool(path,
+                                  size=app.config['DB_POOL_SIZE'],
+                                  timeout=app.config['DB_POOL_TIMEOUT'],
+                                  pragmas=app.config['DB_PRAGMAS'],
+                                  slow_query=app.config['SLOW_QUERY_MS'] / 1000 or None)
+            pools[path] = pool
+            while len(pools) > max(app.config['MAX_OPEN_SHARDS'], 1):
+                oldest = next(iter(pools))
+                evicted.append((oldest, pools.pop(oldest)))
+        else:
+            # Dicts keep insertion order, so re-inserting makes this the most recently used
+            pools[path] = pools.pop(path)
+    for old_path, old_pool in evicted:
+        old_pool.retire()
+        for callback in app.extensions['ontrack_evict']:
+            callback(app, old_path)
+    return pool
+
+
+def get_db():
+    """Return this app context's connection, checking one out on first use"""
+    if 'db' not in g:
+        g.db_pool = get_pool()
+        g.db = g.db_pool.acquire()
+        g.db.reset_stats()
+    return g.db
+
+
+def release_db(exc=None):
+    """Hand the app context's connection back to its pool"""
+    conn = g.pop('db', None)
+    pool = g.pop('db_pool', None)
+    if conn is not None:
+        pool.release(conn)
+
+
+def close_pools(app):
+    """Close every idle pooled connection owned by the app"""
+    for pool in app.extensions.get('ontrack_db', {}).values():
+        pool.close()
+
+
+def init_app(app):
+    """Register connection settings and the teardown hook on the app"""
+    app.config.setdefault('DATABASE', os.environ.get('ONTRACK_DATABASE', DEFAULT_DATABASE))
+    app.config.setdefault('DB_POOL_SIZE', int(os.environ.get('ONTRACK_DB_POOL_SIZE', 8)))
+    app.config.setdefault('DB_POOL_TIMEOUT', float(os.environ.get('ONTRACK_DB_POOL_TIMEOUT', 30)))
+    app.config.setdefault('DB_PRAGMAS', PRAGMAS)
+    app.config.setdefault('SLOW_QUERY_MS', float(os.environ.get('ONTRACK_SLOW_QUERY_MS', 100)))
+    app.config.setdefault('MAX_OPEN_SHARDS', int(os.environ.get('ONTRACK_MAX_OPEN_SHARDS', 32)))
+    app.extensions['ontrack_db'] = {}
+    app.extensions['ontrack_evict'] = []
+    app.teardown_appcontext(release_db)
@@ -0,0 +1,228 @@
+"""Change events for live updates over Server-Sent Events
+
+Triggers on the data tables append one row to `events` per insert, update
+and delete: the entity, the operation, the row id and the day it belongs to
+(for time blocks and habit logs). Every write path is covered, including
+overlap merges, batches and the cascading deletes of a habit's logs or a
+category's tasks. CSV imports suspend the triggers and record a single
+`import` event per table instead.
+
+Events are numbered by `seq`, which SQLite hands out under the write lock,
+so readers see them in commit order and never a later event before an
+earlier one. /api/events streams them to browsers; a stream wakes as soon
+as a write request in its own process finishes and otherwise polls every
+EVENTS_POLL seconds, which picks up writes from other gunicorn workers and
+from outside the app. Only the newest RETENTION events are kept, so a client
+that was away for longer is told to reload instead.
+
+Each open stream holds one of its worker's request threads, so a worker
+serves at most EVENTS_MAX_STREAMS of them (half its threads by default)
+and answers 503 past that; the page then reloads lists after its own
+writes, as it does without live updates, and tries again later. Streams
+end after EVENTS_MAX_AGE seconds and the browser reconnects, so slots held
+by forgotten tabs come free.
+"""
+import json
+import os
+import threading
+import time
+
+from flask import current_app, request
+
+import db
+
+RETENTION = 10000
+PRUNE_EVERY = 1000
+BATCH = 500
+
+# Source table -> (entity name, column holding the row's day or None)
+ENTITIES = {
+    'habits': ('habit', None),
+    'habit_logs': ('habit_log', 'log_date'),
+    'categories': ('category', None),
+    'tasks': ('task', None),
+    'time_blocks': ('time_block', 'block_date'),
+}
+OPS = (('INSERT', 'create', 'NEW'), ('UPDATE', 'update', 'NEW'), ('DELETE', 'delete', 'OLD'))
+
+
+def create(cursor):
+    """Create the events table and the triggers that fill it"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            op TEXT NOT NULL,
+            row_id INTEGER,
+            change_date TEXT
+        )
+    ''')
+    # Pruning in batches keeps the per-write cost to one insert
+    cursor.execute('DROP TRIGGER IF EXISTS events_prune')
+    cursor.execute(f'''
+        CREATE TRIGGER events_prune AFTER INSERT ON events WHEN NEW.seq % {PRUNE_EVERY} = 0
+        BEGIN
+            DELETE FROM events WHERE seq <= NEW.seq - {RETENTION};
+        END
+    ''')
+    create_triggers(cursor)
+
+
+def create_triggers(cursor, table=None):
+    """(Re)create the event triggers, optionally for one table"""
+    for name, (entity, column) in ENTITIES.items():
+        if table not in (None, name):
+            continue
+        for event, op, row in OPS:
+            day = f'{row}.{column}' if column else 'NULL'
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}_event_{op}')
+            cursor.execute(f'''
+                CREATE TRIGGER {name}_event_{op} AFTER {event} ON {name}
+                BEGIN
+                    INSERT INTO events (entity, op, row_id, change_date) VALUES ('{entity}', '{op}', {row}.id, {day});
+                END
+            ''')
+
+
+def drop_triggers(cursor, table=None):
+    """Drop the event triggers ahead of a bulk load; follow with record() and create_triggers()"""
+    for name in ENTITIES:
+        if table in (None, name):
+            for _, op, _ in OPS:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}_event_{op}')
+
+
+def record(cursor, table, op, row_id=None, change_date=None):
+    """Append an event by hand, for writes made with the triggers suspended"""
+    cursor.execute('INSERT INTO events (entity, op, row_id, change_date) VALUES (?, ?, ?, ?)',
+                   (ENTITIES[table][0], op, row_id, change_date))
+
+
+class Broker:
+    """Wakes this process's event streams when one of its requests wrote"""
+
+    def __init__(self, max_streams):
+        self._changed = threading.Condition()
+        self.generation = 0
+        self.max_streams = max_streams
+        self.streams = 0
+        self._streams_lock = threading.Lock()
+
+    def open_stream(self):
+        """Take a stream slot; False when all max_streams are in use"""
+        with self._streams_lock:
+            if self.streams >= self.max_streams:
+                return False
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self._streams_lock:
+            self.streams -= 1
+
+    def notify(self):
+        with self._changed:
+            self.generation += 1
+            self._changed.notify_all()
+
+    def wait(self, generation, timeout):
+        """Block until a notify() after the one that produced `generation`, or the timeout"""
+        with self._changed:
+            self._changed.wait_for(lambda: self.generation != generation, timeout)
+
+
+def get_broker():
+    return current_app.extensions['ontrack_events']
+
+
+def _latest(conn):
+    row = conn.execute('SELECT COALESCE(MAX(seq), 0), MIN(seq) FROM events').fetchone()
+    return row[0], row[1]
+
+
+def _message(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+def stream(since=None):
+    """Generate the SSE messages for one client, starting after event `since`
+
+    Without `since` the stream starts at the newest event and it ends after
+    EVENTS_MAX_AGE seconds. The database connection is borrowed from the
+    pool only while polling, so idle streams don't hold pool slots.
+    """
+    pool = db.get_pool()
+    broker = get_broker()
+    poll = current_app.config['EVENTS_POLL']
+    keepalive = current_app.config['EVENTS_KEEPALIVE']
+    deadline = time.monotonic() + current_app.config['EVENTS_MAX_AGE']
+
+    def generate():
+        conn = pool.acquire()
+        try:
+            latest, oldest = _latest(conn)
+        finally:
+            pool.release(conn)
+        last = latest if since is None else since
+        yield f'retry: {int(poll * 1000) + 1000}\n\n'
+        if since is not None and (since > latest or (oldest is not None and since < oldest - 1)):
+            # Pruned past the client's position (or a different database): start over
+            last = latest
+            yield f'id: {last}\n' + _message('reset', {'seq': last})
+
+        quiet_since = time.monotonic()
+        while True:
+            # Read before polling, so a write finishing mid-poll still wakes the wait below
+            generation = broker.generation
+            conn = pool.acquire()
+            try:
+                rows = conn.execute('''
+                    SELECT seq, entity, op, row_id, change_date FROM events WHERE seq > ? ORDER BY seq LIMIT ?
+                ''', (last, BATCH)).fetchall()
+            finally:
+                pool.release(conn)
+            for seq, entity, op, row_id, change_date in rows:
+                last = seq
+                yield f'id: {seq}\n' + _message('change', {'seq': seq, 'entity': entity, 'op': op,
+                                                           'id': row_id, 'date': change_date})
+            if len(rows) == BATCH:
+                continue
+            if rows:
+                quiet_since = time.monotonic()
+            elif time.monotonic() - quiet_since >= keepalive:
+                # Comments keep proxies from closing an idle stream and reveal dead clients
+                quiet_since = time.monotonic()
+                yield ': keepalive\n\n'
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # The browser reconnects after `retry:` and resumes from the last id
+                return
+            broker.wait(generation, min(poll, remaining))
+    return generate()
+
+
+def requested_since():
+    """The event id to resume after, from Last-Event-ID or ?since="""
+    value = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+def _notify(response):
+    if request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and response.status_code < 400:
+        get_broker().notify()
+    return response
+
+
+def init_app(app):
+    """Register the broker, the stream settings and the wake-up hook on the app"""
+    app.config.setdefault('EVENTS_POLL', float(os.environ.get('ONTRACK_EVENTS_POLL', 0.5)))
+    app.config.setdefault('EVENTS_KEEPALIVE', float(os.environ.get('ONTRACK_EVENTS_KEEPALIVE', 15)))
+    app.config.setdefault('EVENTS_MAX_AGE', float(os.environ.get('ONTRACK_EVENTS_MAX_AGE', 300)))
+    # Leave at least half of a gunicorn worker's threads (gunicorn.conf.py) for other requests
+    default_streams = int(os.environ.get('ONTRACK_THREADS', 4)) // 2
+    app.config.setdefault('EVENTS_MAX_STREAMS', int(os.environ.get('ONTRACK_EVENTS_MAX_STREAMS', default_streams)))
+    app.extensions['ontrack_events'] = Broker(app.config['EVENTS_MAX_STREAMS'])
+    app.after_request(_notify)
@@ -0,0 +1,26 @@
+"""Gunicorn settings for serving OnTrack in production
+
+    gunicorn -c gunicorn.conf.py
+
+Workers are separate processes, each with its own connection pool and
+analytics cache; threads serve concurrent requests inside a worker. SQLite in
+WAL mode lets readers in every worker run alongside the single writer.
+"""
+import multiprocessing
+import os
+
+wsgi_app = 'app:create_app()'
+bind = os.environ.get('ONTRACK_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('ONTRACK_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('ONTRACK_THREADS', 4))
+timeout = int(os.environ.get('ONTRACK_TIMEOUT', 120))  # CSV imports of large files run long
+accesslog = os.environ.get('ONTRACK_ACCESS_LOG')
+
+
+def on_starting(server):
+    """Apply migrations once in the master before any worker is forked"""
+    from app import create_app, setup_database
+
+    applied = setup_database(create_app())
+    if applied:
+        server.log.info('Applied migrations: %s', applied)
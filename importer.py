@@ -0,0 +1,232 @@
+"""Streaming, batched CSV import for habit logs and time blocks
+
+Rows are read straight from the uploaded stream, names are resolved through
+dicts loaded once per import, and inserts go out in executemany batches
+inside the caller's transaction. Memory stays bounded by the batch size and
+the (capped) error list, however large the file is.
+
+The per-row rollup, streak, change-counter, change-stamp, change-event and
+change-log triggers are dropped for the duration of the load; the rollups
+and streaks are recomputed once for the imported date range, the counter
+bumped once, the imported days stamped, a single import event recorded and
+the range's rows logged for sync in one statement instead.
+Callers must
+run the import inside an explicit transaction so a failure restores them.
+"""
+import csv
+import io
+
+import cache
+import clock
+import events
+import rollups
+import streaks
+import sync
+import versions
+
+BATCH_SIZE = 5000
+MAX_ERRORS = 100
+
+
+class ImportResult:
+    """Running totals and line-numbered errors for one import"""
+
+    def __init__(self):
+        self.imported = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(f'Line {line}: {message}')
+
+    def to_dict(self):
+        return {
+            'success': True,
+            'imported': self.imported,
+            'error_count': self.error_count,
+            'errors': self.errors
+        }
+
+
+def read_csv(stream, columns):
+    """Yield (line number, row) from a binary upload stream without reading it all
+
+    Rows are lists ordered like `columns`; columns missing from the file or
+    from a short row come back as None.
+    """
+    # utf-8-sig tolerates the byte order mark spreadsheet tools prepend
+    reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    header = next(reader, [])
+    width = len(header)
+    # Missing columns point past the end of the padded row
+    order = [header.index(name) if name in header else width for name in columns]
+    padding = [None] * (width + 1)
+    for row in reader:
+        if len(row) <= width:
+            row += padding[len(row):]
+        yield reader.line_num, [row[i] for i in order]
+
+
+def suspend_triggers(cursor, table):
+    """Drop the per-row maintenance triggers on a table for a bulk load"""
+    rollups.drop_triggers(cursor, table)
+    streaks.drop_triggers(cursor, table)
+    versions.drop_triggers(cursor, table)
+    cache.drop_triggers(cursor, table)
+    events.drop_triggers(cursor, table)
+    sync.drop_triggers(cursor, table)
+
+
+def restore_triggers(cursor, table, start_date=None, end_date=None):
+    """Put the triggers back once the bulk load's derived data is rebuilt"""
+    if start_date is not None:
+        cache.stamp_range(cursor, table, start_date, end_date)
+        events.record(cursor, table, 'import')
+        sync.mark_range(cursor, table, start_date, end_date)
+    sync.create_triggers(cursor, table)
+    events.create_triggers(cursor, table)
+    cache.create_triggers(cursor, table)
+    versions.bump(cursor, table)
+    versions.create_triggers(cursor, table)
+    streaks.create_triggers(cursor, table)
+    rollups.create_triggers(cursor, table)
+
+
+def name_map(cursor, table):
+    """Load a name -> id dict for a table in one query"""
+    cursor.execute(f'SELECT id, name FROM {table} ORDER BY id DESC')
+    # Ordered so the lowest id wins when names repeat, like the old per-row lookup
+    return {row[1]: row[0] for row in cursor.fetchall()}
+
+
+class _Batcher:
+    """Collects parameter tuples and flushes them with executemany
+
+    Tracks the earliest and latest value of the day column so the rollups
+    can be rebuilt for just the imported range.
+    """
+
+    def __init__(self, cursor, sql, day_index, result):
+        self.cursor = cursor
+        self.sql = sql
+        self.day_index = day_index
+        self.result = result
+        self.rows = []
+        self.first_day = None
+        self.last_day = None
+
+    def flush(self):
+        if not self.rows:
+            return
+        days = [row[self.day_index] for row in self.rows]
+        first, last = min(days), max(days)
+        if self.first_day is None or first < self.first_day:
+            self.first_day = first
+        if self.last_day is None or last > self.last_day:
+            self.last_day = last
+        self.cursor.executemany(self.sql, self.rows)
+        self.result.imported += len(self.rows)
+        self.rows = []
+
+    def date_range(self):
+        """The imported (start_date, end_date) as ISO dates, or (None, None) when nothing was"""
+        if self.first_day is None:
+            return None, None
+        return clock.iso(self.first_day), clock.iso(self.last_day)
+
+
+def import_habit_logs(conn, stream):
+    """Import an /export/habits style CSV, creating unknown habits by name"""
+    cursor = conn.cursor()
+    result = ImportResult()
+    suspend_triggers(cursor, 'habit_logs')
+    habits = name_map(cursor, 'habits')
+    batch = _Batcher(cursor, '''
+        INSERT INTO habit_logs (habit_id, day, hours_spent, completed, notes)
+        VALUES (?, ?, ?, ?, ?)
+    ''', 1, result)
+    rows = batch.rows
+
+    columns = ['Habit Name', 'Type', 'Target Hours', 'Date', 'Hours Spent', 'Completed', 'Notes']
+    for line, (name, habit_type, target_hours, log_date, hours_spent, completed, notes) in read_csv(stream, columns):
+        if name is None:
+            result.error(line, 'missing Habit Name')
+            continue
+        if not log_date:
+            result.error(line, 'missing Date')
+            continue
+        try:
+            day = clock.day(log_date)
+        except clock.InvalidDate as e:
+            result.error(line, str(e))
+            continue
+
+        habit_id = habits.get(name)
+        if habit_id is None:
+            cursor.execute('''
+                INSERT INTO habits (name, habit_type, target_hours)
+                VALUES (?, ?, ?)
+            ''', (name, habit_type or 'daily', target_hours if target_hours else None))
+            habit_id = habits[name] = cursor.lastrowid
+
+        completed = (completed or '').lower() in ['true', '1', 'yes']
+        rows.append((habit_id, day, hours_spent if hours_spent else None, completed, notes or ''))
+        if len(rows) >= BATCH_SIZE:
+            batch.flush()
+            rows = batch.rows
+
+    batch.flush()
+    start_date, end_date = batch.date_range()
+    if start_date is not None:
+        rollups.rebuild_habit_logs(cursor, start_date, end_date)
+        streaks.rebuild(cursor, start_date, end_date)
+    restore_triggers(cursor, 'habit_logs', start_date, end_date)
+    return result
+
+
+def import_time_blocks(conn, stream):
+    """Import an /export/timeblocks style CSV, matching categories and tasks by name
+
+    Blocks are loaded as given, without the overlap checks of the API: an
+    export of overlapping blocks re-imports as it was. Use
+    GET /api/time-blocks/overlaps to find any afterwards.
+    """
+    cursor = conn.cursor()
+    result = ImportResult()
+    suspend_triggers(cursor, 'time_blocks')
+    categories = name_map(cursor, 'categories')
+    tasks = name_map(cursor, 'tasks')
+    batch = _Batcher(cursor, '''
+        INSERT INTO time_blocks (day, start_minute, end_minute, activity, category_id, task_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', 0, result)
+    rows = batch.rows
+
+    columns = ['Date', 'Start Time', 'End Time', 'Activity', 'Duration (minutes)', 'Category', 'Task']
+    for line, (block_date, start_time, end_time, activity, _, category, task) in read_csv(stream, columns):
+        if not (block_date and start_time and end_time and activity):
+            result.error(line, 'Date, Start Time, End Time and Activity are required')
+            continue
+
+        # Durations follow from the times, so the Duration column is ignored
+        try:
+            day = clock.day(block_date)
+            start_minute, end_minute = clock.span(start_time, end_time)
+        except clock.InvalidDate as e:
+            result.error(line, str(e))
+            continue
+
+        # Unknown category or task names import as uncategorized, as before
+        rows.append((day, start_minute, end_minute, activity, categories.get(category), tasks.get(task)))
+        if len(rows) >= BATCH_SIZE:
+            batch.flush()
+            rows = batch.rows
+
+    batch.flush()
+    start_date, end_date = batch.date_range()
+    if start_date is not None:
+        rollups.rebuild_time_blocks(cursor, start_date, end_date)
+    restore_triggers(cursor, 'time_blocks', start_date, end_date)
+    return result
@@ -0,0 +1,165 @@
+"""Per-route request and SQL metrics in Prometheus text format
+
+init_app() times every request and, when it used the database, reads the
+statement count, SQLite time and rows fetched that the profiled connection
+from db.py accumulated for it. render() formats everything for /metrics.
+
+Metrics live in process memory, so under gunicorn each worker reports its
+own; scrape each worker or run with one worker when exact totals matter.
+"""
+import threading
+import time
+
+from flask import current_app, g, request
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500, 1000)
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    """Monotonic totals keyed by label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            yield self.name, _labels(self.labels, label_values), value
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count keyed by label values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            state = self.values.get(label_values)
+            if state is None:
+                state = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self.values.items())
+        for label_values, (counts, total, count) in items:
+            base = _labels(self.labels, label_values)
+            sep = ',' if base else ''
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket', f'{base}{sep}le="{bound}"', bucket_count
+            yield f'{self.name}_bucket', f'{base}{sep}le="+Inf"', count
+            yield f'{self.name}_sum', base, total
+            yield f'{self.name}_count', base, count
+
+
+class Metrics:
+    """The app's request and SQL metrics"""
+
+    def __init__(self):
+        route = ('method', 'route')
+        self.requests = Counter('ontrack_http_requests_total', 'HTTP requests handled',
+                                ('method', 'route', 'status'))
+        self.latency = Histogram('ontrack_http_request_duration_seconds', 'Request latency', route)
+        self.statements = Histogram('ontrack_sql_statements_per_request', 'SQL statements executed per request',
+                                    route, STATEMENT_BUCKETS)
+        self.sql_time = Counter('ontrack_sql_seconds_total', 'Time spent in SQLite, including fetches and commits',
+                                route)
+        self.sql_rows = Counter('ontrack_sql_rows_total', 'Rows fetched from SQLite', route)
+        self.slow = Counter('ontrack_sql_slow_statements_total', 'Statements over the slow query threshold', route)
+        self.all = (self.requests, self.latency, self.statements, self.sql_time, self.sql_rows, self.slow)
+
+    def record(self, method, route, status, elapsed, conn):
+        labels = (method, route)
+        self.requests.inc((method, route, status))
+        self.latency.observe(labels, elapsed)
+        statements = conn.statements if conn is not None else 0
+        self.statements.observe(labels, statements)
+        if statements:
+            self.sql_time.inc(labels, conn.sql_time)
+            self.sql_rows.inc(labels, conn.rows)
+        if statements and conn.slow:
+            self.slow.inc(labels, conn.slow)
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def render(families):
+    """Prometheus text exposition of counters, histograms and (name, help, type, value) samples"""
+    lines = []
+    for family in families:
+        if isinstance(family, tuple):
+            name, help_text, kind, value = family
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {_format(value)}']
+            continue
+        lines += [f'# HELP {family.name} {family.help}', f'# TYPE {family.name} {family.kind}']
+        for name, labels, value in family.samples():
+            lines.append(f'{name}{{{labels}}} {_format(value)}' if labels else f'{name} {_format(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def get_metrics():
+    return current_app.extensions['ontrack_metrics']
+
+
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+
+def _record(exc=None):
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    rule = request.url_rule
+    status = g.pop('response_status', 500 if exc is not None else 200)
+    get_metrics().record(request.method, rule.rule if rule is not None else 'unmatched', status,
+                         time.perf_counter() - started, g.get('db'))
+
+
+def _remember_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+def init_app(app):
+    """Register the metrics store and the request timing hooks on the app"""
+    app.extensions['ontrack_metrics'] = Metrics()
+    app.before_request(_start_timer)
+    app.after_request(_remember_status)
+    app.teardown_request(_record)
@@ -0,0 +1,338 @@
+"""Versioned schema migrations for the OnTrack database
+
+Each migration is a function registered with @migration(version, description).
+migrate() applies the ones newer than the version recorded in schema_version,
+each inside its own transaction, so it is safe to run on every startup and
+on databases created before versioning existed.
+"""
+import cache
+import clock
+import events
+import rollups
+import search
+import streaks
+import sync
+import versions
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register a schema migration"""
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return register
+
+
+def current_version(conn):
+    """Return the schema version recorded in the database"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def migrate(conn):
+    """Apply all pending migrations, returning the versions applied"""
+    applied = []
+    for version, description, func in MIGRATIONS:
+        if version <= current_version(conn):
+            continue
+        # IMMEDIATE takes the write lock up front so two processes starting
+        # together cannot both apply the same migration
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if version > current_version(conn):
+                cursor = conn.cursor()
+                func(cursor)
+                cursor.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                               (version, description))
+                applied.append(version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return applied
+
+
+@migration(1, 'Base tables')
+def base_tables(cursor):
+    # Habits table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS habits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            habit_type TEXT NOT NULL,
+            target_hours INTEGER,
+            target_value INTEGER,
+            target_type TEXT DEFAULT 'binary',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Habit logs table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS habit_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            habit_id INTEGER,
+            log_date DATE NOT NULL,
+            hours_spent REAL,
+            value INTEGER,
+            completed BOOLEAN,
+            completion_percentage INTEGER,
+            notes TEXT,
+            FOREIGN KEY (habit_id) REFERENCES habits (id)
+        )
+    ''')
+
+    # Categories table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            color TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Tasks table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            category_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (category_id) REFERENCES categories (id)
+        )
+    ''')
+
+    # Time blocks table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS time_blocks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            block_date DATE NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            activity TEXT NOT NULL,
+            duration_minutes INTEGER,
+            category_id INTEGER,
+            task_id INTEGER,
+            FOREIGN KEY (category_id) REFERENCES categories (id),
+            FOREIGN KEY (task_id) REFERENCES tasks (id)
+        )
+    ''')
+
+
+@migration(2, 'Secondary indexes for date, range and name lookups')
+def secondary_indexes(cursor):
+    # Day views and the analytics joins filter by date first, then by owner
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_habit_logs_date_habit ON habit_logs (log_date, habit_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_habit_logs_habit_date ON habit_logs (habit_id, log_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_time_blocks_date_start ON time_blocks (block_date, start_time)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_time_blocks_category_date ON time_blocks (category_id, block_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_time_blocks_task_date ON time_blocks (task_id, block_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tasks_category ON tasks (category_id)')
+    # categories.name and tasks.name are already covered by their UNIQUE indexes
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_habits_name ON habits (name)')
+
+
+@migration(3, 'Daily rollup tables for analytics')
+def daily_rollups(cursor):
+    # Filled in by integer_dates(), as the rebuild reads the integer day columns
+    rollups.create(cursor)
+
+
+@migration(4, 'Per-table change counters for ETags')
+def table_versions(cursor):
+    versions.create(cursor)
+
+
+@migration(5, 'Per-day change stamps for analytics cache invalidation')
+def date_changes(cursor):
+    cache.create(cursor)
+
+
+@migration(6, 'Incrementally maintained habit streaks')
+def habit_streaks(cursor):
+    streaks.create(cursor)
+    streaks.rebuild(cursor)
+
+
+@migration(7, 'Index for time block overlap checks')
+def time_block_overlaps(cursor):
+    # Overlap checks compare times as text, which needs zero-padded hours
+    for column in ('start_time', 'end_time'):
+        cursor.execute(f"UPDATE time_blocks SET {column} = '0' || {column} WHERE {column} GLOB '[0-9]:[0-9][0-9]'")
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_time_blocks_date_end ON time_blocks (block_date, end_time, start_time)
+    ''')
+
+
+def _minutes(column):
+    return f'(CAST(substr({column}, 1, 2) AS INTEGER) * 60 + CAST(substr({column}, 4, 2) AS INTEGER))'
+
+
+def _replace_table(cursor, table, create_sql, copy_sql):
+    """Swap a table for a rebuilt copy, keeping its AUTOINCREMENT sequence"""
+    cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,))
+    row = cursor.fetchone()
+    cursor.execute(create_sql.format(table=f'{table}_new'))
+    cursor.execute(copy_sql.format(table=f'{table}_new'))
+    # Dropping the table drops its indexes and triggers too
+    cursor.execute(f'DROP TABLE {table}')
+    cursor.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+    if row is not None:
+        cursor.execute('UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?', (row[0], table))
+
+
+@migration(8, 'Integer day and minute columns for time blocks and habit logs')
+def integer_dates(cursor):
+    # Columns can't change type in place, so both tables are rebuilt with
+    # the integer columns stored and the old text ones computed from them
+    _replace_table(cursor, 'time_blocks', f'''
+        CREATE TABLE {{table}} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            day INTEGER NOT NULL,
+            start_minute INTEGER NOT NULL,
+            end_minute INTEGER NOT NULL,
+            activity TEXT NOT NULL,
+            category_id INTEGER,
+            task_id INTEGER,
+            block_date TEXT GENERATED ALWAYS AS ({clock.DATE_SQL.format('day')}) VIRTUAL,
+            start_time TEXT GENERATED ALWAYS AS ({clock.TIME_SQL.format('start_minute')}) VIRTUAL,
+            end_time TEXT GENERATED ALWAYS AS ({clock.TIME_SQL.format('end_minute')}) VIRTUAL,
+            duration_minutes INTEGER GENERATED ALWAYS AS (end_minute - start_minute) VIRTUAL,
+            FOREIGN KEY (category_id) REFERENCES categories (id),
+            FOREIGN KEY (task_id) REFERENCES tasks (id)
+        )
+    ''', f'''
+        INSERT INTO {{table}} (id, day, start_minute, end_minute, activity, category_id, task_id)
+        SELECT id, CAST(julianday(block_date) - 2440587.5 AS INTEGER), start_minute,
+               -- Blocks whose end is before their start ran past midnight
+               CASE WHEN end_minute < start_minute THEN end_minute + {clock.MINUTES_PER_DAY} ELSE end_minute END,
+               activity, category_id, task_id
+        FROM (SELECT *, {_minutes('start_time')} AS start_minute, {_minutes('end_time')} AS end_minute
+              FROM time_blocks)
+    ''')
+    cursor.execute('CREATE INDEX idx_time_blocks_day_start ON time_blocks (day, start_minute)')
+    cursor.execute('CREATE INDEX idx_time_blocks_day_end ON time_blocks (day, end_minute, start_minute)')
+    cursor.execute('CREATE INDEX idx_time_blocks_category_day ON time_blocks (category_id, day)')
+    cursor.execute('CREATE INDEX idx_time_blocks_task_day ON time_blocks (task_id, day)')
+
+    _replace_table(cursor, 'habit_logs', f'''
+        CREATE TABLE {{table}} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            habit_id INTEGER,
+            day INTEGER NOT NULL,
+            hours_spent REAL,
+            value INTEGER,
+            completed BOOLEAN,
+            completion_percentage INTEGER,
+            notes TEXT,
+            log_date TEXT GENERATED ALWAYS AS ({clock.DATE_SQL.format('day')}) VIRTUAL,
+            FOREIGN KEY (habit_id) REFERENCES habits (id)
+        )
+    ''', '''
+        INSERT INTO {table} (id, habit_id, day, hours_spent, value, completed, completion_percentage, notes)
+        SELECT id, habit_id, CAST(julianday(log_date) - 2440587.5 AS INTEGER), hours_spent, value, completed,
+               completion_percentage, notes
+        FROM habit_logs
+    ''')
+    cursor.execute('CREATE INDEX idx_habit_logs_day_habit ON habit_logs (day, habit_id)')
+    cursor.execute('CREATE INDEX idx_habit_logs_habit_day ON habit_logs (habit_id, day)')
+
+    for table in ('time_blocks', 'habit_logs'):
+        rollups.create_triggers(cursor, table)
+        versions.create_triggers(cursor, table)
+        cache.create_triggers(cursor, table)
+    # Durations of blocks past midnight were negative before
+    rollups.rebuild(cursor)
+    streaks.rebuild(cursor)
+
+
+@migration(9, 'Change events for live updates')
+def change_events(cursor):
+    events.create(cursor)
+
+
+@migration(10, 'Change log for delta sync')
+def change_log(cursor):
+    sync.create(cursor)
+
+
+@migration(11, 'Full-text search indexes')
+def search_indexes(cursor):
+    search.create(cursor)
+
+
+@migration(12, 'Change log compaction through the tombstone index')
+def change_log_compaction(cursor):
+    sync.create_compact_trigger(cursor)
+
+
+# Representative hot queries and the index each one must use. check_indexes()
+# runs them through EXPLAIN QUERY PLAN so a schema or query change that stops
+# using an index is caught instead of silently falling back to a table scan.
+INDEX_CHECKS = (
+    ('SELECT * FROM habit_logs hl JOIN habits h ON hl.habit_id = h.id WHERE hl.day = ?',
+     (19723,), 'idx_habit_logs_day_habit'),
+    ('SELECT * FROM time_blocks WHERE day = ? ORDER BY start_minute',
+     (19723,), 'idx_time_blocks_day_start'),
+    ('SELECT * FROM time_blocks WHERE (day, start_minute, id) > (?, ?, ?) AND day <= ? '
+     'ORDER BY day, start_minute, id LIMIT 101',
+     (19723, 540, 1, 20088), 'idx_time_blocks_day_start ((day,start_minute)>'),
+    ('SELECT id FROM time_blocks WHERE day BETWEEN ? AND ? AND day * 1440 + end_minute > ? '
+     'AND day * 1440 + start_minute < ?',
+     (19722, 19723, 28401660, 28401720), 'COVERING INDEX idx_time_blocks_day_end (day>? AND day<?)'),
+    ('SELECT * FROM habit_logs WHERE (day, habit_id, id) > (?, ?, ?) AND day <= ? '
+     'ORDER BY day, habit_id, id LIMIT 101',
+     (19723, 1, 1, 20088), 'idx_habit_logs_day_habit ((day,habit_id)>'),
+    ('SELECT SUM(duration_minutes) FROM time_blocks WHERE category_id = ? AND day BETWEEN ? AND ?',
+     (1, 19723, 20088), 'idx_time_blocks_category_day'),
+    ('SELECT SUM(duration_minutes) FROM time_blocks WHERE category_id IS NULL AND day BETWEEN ? AND ?',
+     (19723, 20088), 'idx_time_blocks_category_day'),
+    ('SELECT SUM(duration_minutes) FROM time_blocks WHERE task_id = ? AND day BETWEEN ? AND ?',
+     (1, 19723, 20088), 'idx_time_blocks_task_day'),
+    ('SELECT COUNT(*) FROM habit_logs WHERE habit_id = ? AND day BETWEEN ? AND ?',
+     (1, 19723, 20088), 'idx_habit_logs_habit_day'),
+    ('SELECT SUM(total_minutes) FROM category_daily WHERE category_id = ? AND block_date BETWEEN ? AND ?',
+     (1, '2024-01-01', '2024-12-31'), 'PRIMARY KEY (category_id=? AND block_date>? AND block_date<?)'),
+    ('SELECT SUM(total_minutes) FROM task_daily WHERE task_id = ? AND block_date BETWEEN ? AND ?',
+     (1, '2024-01-01', '2024-12-31'), 'PRIMARY KEY (task_id=? AND block_date>? AND block_date<?)'),
+    ('SELECT SUM(log_count) FROM habit_daily WHERE habit_id = ? AND log_date BETWEEN ? AND ?',
+     (1, '2024-01-01', '2024-12-31'), 'PRIMARY KEY (habit_id=? AND log_date>? AND log_date<?)'),
+    ('SELECT table_name, change_date, seq FROM date_changes WHERE seq > ? ORDER BY seq',
+     (0,), 'idx_date_changes_seq'),
+    ('SELECT MAX(length) FROM habit_streak_runs WHERE habit_id = ?', (1,), 'idx_habit_streak_runs_length'),
+    ('SELECT end_date FROM habit_streak_runs WHERE habit_id = ? AND start_date = ?',
+     (1, '2024-01-01'), 'idx_habit_streak_runs_start'),
+    ('SELECT seq FROM changes WHERE entity = ? AND row_id = ?', ('time_block', 1), 'idx_changes_entity_row'),
+    ('SELECT seq FROM changes WHERE deleted AND changed_at < ?', (0,), 'idx_changes_tombstones'),
+    ('SELECT MAX(seq) FROM changes INDEXED BY idx_changes_tombstones WHERE deleted AND changed_at < ?',
+     (0,), 'idx_changes_tombstones'),
+    ('SELECT id FROM habits WHERE name = ?', ('Read',), 'idx_habits_name'),
+    ('SELECT id FROM categories WHERE name = ?', ('Work',), 'sqlite_autoindex_categories_1'),
+    ('SELECT id FROM tasks WHERE name = ?', ('Code',), 'sqlite_autoindex_tasks_1'),
+)
+
+
+def query_plan(conn, sql, params=()):
+    """Return the EXPLAIN QUERY PLAN detail lines for a statement"""
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+
+def check_indexes(conn):
+    """Return a list of (sql, expected index, plan) for checks that failed"""
+    failures = []
+    for sql, params, index in INDEX_CHECKS:
+        plan = query_plan(conn, sql, params)
+        if not any(index in detail for detail in plan):
+            failures.append((sql, index, plan))
+    return failures
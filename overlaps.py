@@ -0,0 +1,198 @@
+"""Overlap handling for time blocks
+
+Two blocks overlap when each starts before the other ends. Blocks are
+compared on absolute minutes, day * 1440 + minute, so a block running past
+midnight overlaps the early blocks of the next day. Only blocks starting on
+the day before can reach into a day, so a probe reads the days from the one
+before its start to the one its end falls on, and
+idx_time_blocks_day_end (day, end_minute, start_minute) lets it filter on
+both ends inside the index before reading any block from the table.
+
+A write says what to do with the blocks it would overlap:
+
+    reject  refuse the write with 409 and list the overlapping blocks
+    trim    store only the parts of the new block not already covered,
+            which may split it in two or more blocks
+    merge   absorb the overlapping blocks into the new one, which grows to
+            cover them; the absorbed blocks are deleted
+    allow   store it as given, like before overlaps were checked
+
+CSV imports (importer.py) and snapshot loads are bulk loads and always
+store blocks as given.
+"""
+import os
+
+from flask import current_app, request
+
+import clock
+
+MODES = ('reject', 'trim', 'merge', 'allow')
+DAY = clock.MINUTES_PER_DAY
+
+
+class InvalidMode(ValueError):
+    """An unknown overlap mode was requested"""
+
+
+class OverlapError(ValueError):
+    """A block could not be placed without overlapping others"""
+
+    def __init__(self, message, blocks):
+        super().__init__(message)
+        self.blocks = blocks
+
+
+def requested_mode(data=None):
+    """The overlap mode from the JSON body, the query string or the app default"""
+    mode = data.get('overlap') if isinstance(data, dict) else None
+    mode = mode or request.args.get('overlap') or current_app.config['TIME_BLOCK_OVERLAP']
+    if mode not in MODES:
+        raise InvalidMode(f"overlap must be one of {', '.join(MODES)}, got {mode!r}")
+    return mode
+
+
+def find(cursor, start, end, exclude_id=None):
+    """Blocks overlapping the absolute minutes start..end, in start order
+
+    Returns (start, end, block) triples, with block the dict reported to clients.
+    """
+    cursor.execute(f'''
+        SELECT id, day, start_minute, end_minute, block_date, start_time, end_time, activity, category_id, task_id
+        FROM time_blocks
+        WHERE day BETWEEN ? AND ? AND day * {DAY} + end_minute > ? AND day * {DAY} + start_minute < ?
+          AND id IS NOT ?
+        ORDER BY day, start_minute
+    ''', (start // DAY - 1, (end - 1) // DAY, start, end, exclude_id))
+    found = []
+    for row in cursor.fetchall():
+        block = dict(row)
+        base = block.pop('day') * DAY
+        found.append((base + block.pop('start_minute'), base + block.pop('end_minute'), block))
+    return found
+
+
+def _piece(start, end):
+    """(day, start_minute, end_minute) of a block spanning absolute minutes start..end"""
+    day = start // DAY
+    return day, start - day * DAY, end - day * DAY
+
+
+def _describe(start, end):
+    return f'{clock.iso(start // DAY)} {clock.hhmm(start)}-{clock.hhmm(end)}'
+
+
+def place(cursor, mode, day, start_minute, end_minute, exclude_id=None):
+    """Work out where a new or edited block may go under an overlap mode
+
+    Returns the list of (day, start_minute, end_minute) pieces to store and
+    the ids of blocks merge deleted. exclude_id is the block being edited,
+    which never overlaps itself. Raises OverlapError when reject finds
+    overlaps, trim finds the block fully covered or merge would grow it to a
+    day or longer.
+    """
+    start, end = day * DAY + start_minute, day * DAY + end_minute
+    if mode == 'allow' or end <= start:
+        return [(day, start_minute, end_minute)], []
+
+    found = find(cursor, start, end, exclude_id)
+    if not found:
+        return [(day, start_minute, end_minute)], []
+    blocks = [block for _, _, block in found]
+
+    if mode == 'reject':
+        raise OverlapError(f'{_describe(start, end)} overlaps {len(blocks)} time block(s)', blocks)
+
+    if mode == 'trim':
+        pieces = []
+        free_from = start
+        for block_start, block_end, _ in found:
+            if block_start > free_from:
+                pieces.append(_piece(free_from, block_start))
+            free_from = max(free_from, block_end)
+        if free_from < end:
+            pieces.append(_piece(free_from, end))
+        if not pieces:
+            raise OverlapError(f'{_describe(start, end)} is already covered by other time blocks', blocks)
+        return pieces, []
+
+    # merge: grow until no further block overlaps the union
+    absorbed = {}
+    while found:
+        for block_start, block_end, block in found:
+            absorbed[block['id']] = block
+            start = min(start, block_start)
+            end = max(end, block_end)
+        found = [item for item in find(cursor, start, end, exclude_id) if item[2]['id'] not in absorbed]
+    if end - start >= DAY:
+        raise OverlapError(f'merging would make {_describe(start, end)} a day or longer', list(absorbed.values()))
+    ids = sorted(absorbed)
+    cursor.execute(f"DELETE FROM time_blocks WHERE id IN ({', '.join('?' * len(ids))})", ids)
+    return [_piece(start, end)], ids
+
+
+def _union(intervals):
+    covered, reach = 0, None
+    for start, end in sorted(intervals):
+        if reach is None or start >= reach:
+            covered += end - start
+            reach = end
+        elif end > reach:
+            covered += end - reach
+            reach = end
+    return covered
+
+
+def day_overlaps(cursor, start_date=None, end_date=None):
+    """Every pair of overlapping blocks in a date range, and the minutes counted twice per day
+
+    A pair belongs to the day of the block starting first, and a day's
+    double-counted minutes are the sum of its overlapping blocks' durations
+    minus the length of their union, which is what analytics totals
+    over-report for that day.
+    """
+    conditions, params = [], []
+    if start_date:
+        conditions.append('a.day >= ?')
+        params.append(clock.day(start_date))
+    if end_date:
+        conditions.append('a.day <= ?')
+        params.append(clock.day(end_date))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    cursor.execute(f'''
+        SELECT a.block_date,
+               a.day * {DAY} + a.start_minute, a.day * {DAY} + a.end_minute,
+               a.id, a.block_date, a.start_time, a.end_time, a.activity, a.category_id, a.task_id,
+               b.day * {DAY} + b.start_minute, b.day * {DAY} + b.end_minute,
+               b.id, b.block_date, b.start_time, b.end_time, b.activity, b.category_id, b.task_id
+        FROM time_blocks a
+        JOIN time_blocks b ON b.day BETWEEN a.day AND a.day + 1
+                          AND b.day * {DAY} + b.end_minute > a.day * {DAY} + a.start_minute
+                          AND b.day * {DAY} + b.start_minute < a.day * {DAY} + a.end_minute
+                          AND (b.day * {DAY} + b.start_minute, b.id) > (a.day * {DAY} + a.start_minute, a.id)
+        {where}
+        ORDER BY a.day, a.start_minute, a.id, b.day, b.start_minute
+    ''', params)
+
+    fields = ('id', 'block_date', 'start_time', 'end_time', 'activity', 'category_id', 'task_id')
+    pairs, days = [], {}
+    for row in cursor.fetchall():
+        first_span, second_span = row[1:3], row[10:12]
+        first, second = dict(zip(fields, row[3:10])), dict(zip(fields, row[12:19]))
+        block_date = row[0]
+        overlap = min(first_span[1], second_span[1]) - max(first_span[0], second_span[0])
+        pairs.append({'block_date': block_date, 'first': first, 'second': second, 'overlap_minutes': overlap})
+        involved = days.setdefault(block_date, {})
+        involved[first['id']] = first_span
+        involved[second['id']] = second_span
+
+    summary = []
+    for block_date in sorted(days):
+        spans = days[block_date].values()
+        summary.append({'block_date': block_date,
+                        'double_counted_minutes': sum(end - start for start, end in spans) - _union(spans)})
+    return pairs, summary
+
+
+def init_app(app):
+    """Register the default overlap mode on the app"""
+    app.config.setdefault('TIME_BLOCK_OVERLAP', os.environ.get('ONTRACK_TIME_BLOCK_OVERLAP', 'reject'))
@@ -0,0 +1,94 @@
+"""Keyset pagination for the list endpoints
+
+Pages are ordered by a unique key (e.g. block_date, start_time, id) and the
+next page starts strictly after the last key returned, so every page is an
+index range scan of page-size rows instead of an OFFSET that re-reads all
+earlier pages. The key travels to the client as an opaque cursor.
+"""
+import base64
+import json
+import os
+
+from flask import current_app, request
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor or page size from the query string can't be used"""
+
+
+def encode_cursor(key):
+    """Pack a row's key values into an opaque URL-safe token"""
+    raw = json.dumps(list(key), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, width):
+    """Unpack a token from encode_cursor(), checking it has `width` values"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        raise InvalidCursor('Invalid cursor')
+    if not isinstance(key, list) or len(key) != width:
+        raise InvalidCursor('Invalid cursor')
+    # Values are bound as query parameters, which must be scalars
+    if not all(value is None or isinstance(value, (int, float, str)) for value in key):
+        raise InvalidCursor('Invalid cursor')
+    return key
+
+
+def requested():
+    """True when the request asks for a page rather than the whole list"""
+    return 'limit' in request.args or 'cursor' in request.args
+
+
+def page_size():
+    """The request's limit, defaulting to PAGE_SIZE and capped at MAX_PAGE_SIZE"""
+    limit = request.args.get('limit')
+    if limit is None:
+        return current_app.config['PAGE_SIZE']
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise InvalidCursor('limit must be an integer')
+    if limit < 1:
+        raise InvalidCursor('limit must be positive')
+    return min(limit, current_app.config['MAX_PAGE_SIZE'])
+
+
+def after(columns, descending=False):
+    """Return (condition, params) selecting rows past the request's cursor
+
+    The condition is a row-value comparison on `columns`, which must match
+    the query's ORDER BY. Without a cursor it selects every row.
+    """
+    token = request.args.get('cursor')
+    if not token:
+        return '1', []
+    key = decode_cursor(token, len(columns))
+    op = '<' if descending else '>'
+    placeholders = ', '.join('?' for _ in columns)
+    return f"({', '.join(columns)}) {op} ({placeholders})", key
+
+
+def fetch_page(cursor, limit, key_columns, hidden=()):
+    """Fetch up to `limit` rows as dicts plus the cursor for the next page
+
+    The query must select limit + 1 rows; the extra row only signals that
+    another page exists. key_columns name the result columns forming the key,
+    and hidden the ones selected only for the key, which are left out of the rows.
+    """
+    rows = [dict(row) for row in cursor.fetchmany(limit + 1)]
+    next_cursor = None
+    if len(rows) > limit:
+        rows.pop()
+        next_cursor = encode_cursor(rows[-1][column] for column in key_columns)
+    for row in rows:
+        for column in hidden:
+            del row[column]
+    return rows, next_cursor
+
+
+def init_app(app):
+    """Register the page size settings on the app"""
+    app.config.setdefault('PAGE_SIZE', int(os.environ.get('ONTRACK_PAGE_SIZE', 100)))
+    app.config.setdefault('MAX_PAGE_SIZE', int(os.environ.get('ONTRACK_MAX_PAGE_SIZE', 1000)))
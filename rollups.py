@@ -0,0 +1,186 @@
+"""Per-day rollup tables behind the analytics endpoints
+
+category_daily and task_daily hold minutes and block counts per owner per
+day, and habit_daily holds log counts, completions and hours per habit per
+day. Triggers on time_blocks and habit_logs keep them current on every
+insert, update and delete, so every write path (API routes, CSV import,
+direct SQL) is covered. An id of 0 stands for "none", e.g. uncategorized.
+
+The primary keys lead with the owner id so the analytics joins read one
+contiguous date range per category, task or habit. They stay keyed by
+ISO date text, while the raw tables filter and group on their integer day.
+"""
+import clock
+
+TABLES = (
+    '''
+    CREATE TABLE IF NOT EXISTS category_daily (
+        category_id INTEGER NOT NULL,
+        block_date DATE NOT NULL,
+        total_minutes INTEGER NOT NULL DEFAULT 0,
+        block_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (category_id, block_date)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS task_daily (
+        task_id INTEGER NOT NULL,
+        block_date DATE NOT NULL,
+        total_minutes INTEGER NOT NULL DEFAULT 0,
+        block_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (task_id, block_date)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS habit_daily (
+        habit_id INTEGER NOT NULL,
+        log_date DATE NOT NULL,
+        log_count INTEGER NOT NULL DEFAULT 0,
+        completed_count INTEGER NOT NULL DEFAULT 0,
+        completion_sum REAL NOT NULL DEFAULT 0,
+        total_hours REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (habit_id, log_date)
+    ) WITHOUT ROWID
+    ''',
+)
+
+# Statements shared by the triggers; {row} is NEW or OLD and {owner} is
+# category or task
+_ADD_BLOCK = '''
+    INSERT INTO {owner}_daily ({owner}_id, block_date, total_minutes, block_count)
+    VALUES (COALESCE({row}.{owner}_id, 0), {row}.block_date, COALESCE({row}.duration_minutes, 0), 1)
+    ON CONFLICT ({owner}_id, block_date) DO UPDATE SET
+        total_minutes = total_minutes + excluded.total_minutes,
+        block_count = block_count + 1;
+'''
+
+_REMOVE_BLOCK = '''
+    UPDATE {owner}_daily
+    SET total_minutes = total_minutes - COALESCE({row}.duration_minutes, 0),
+        block_count = block_count - 1
+    WHERE {owner}_id = COALESCE({row}.{owner}_id, 0) AND block_date = {row}.block_date;
+    DELETE FROM {owner}_daily
+    WHERE {owner}_id = COALESCE({row}.{owner}_id, 0) AND block_date = {row}.block_date
+        AND block_count <= 0;
+'''
+
+_ADD_LOG = '''
+    INSERT INTO habit_daily (habit_id, log_date, log_count, completed_count, completion_sum, total_hours)
+    VALUES (COALESCE({row}.habit_id, 0), {row}.log_date, 1,
+            CASE WHEN {row}.completed = 1 THEN 1 ELSE 0 END,
+            COALESCE({row}.completion_percentage, CASE WHEN {row}.completed = 1 THEN 100 ELSE 0 END),
+            COALESCE({row}.hours_spent, 0))
+    ON CONFLICT (habit_id, log_date) DO UPDATE SET
+        log_count = log_count + 1,
+        completed_count = completed_count + excluded.completed_count,
+        completion_sum = completion_sum + excluded.completion_sum,
+        total_hours = total_hours + excluded.total_hours;
+'''
+
+_REMOVE_LOG = '''
+    UPDATE habit_daily
+    SET log_count = log_count - 1,
+        completed_count = completed_count - CASE WHEN {row}.completed = 1 THEN 1 ELSE 0 END,
+        completion_sum = completion_sum
+            - COALESCE({row}.completion_percentage, CASE WHEN {row}.completed = 1 THEN 100 ELSE 0 END),
+        total_hours = total_hours - COALESCE({row}.hours_spent, 0)
+    WHERE habit_id = COALESCE({row}.habit_id, 0) AND log_date = {row}.log_date;
+    DELETE FROM habit_daily
+    WHERE habit_id = COALESCE({row}.habit_id, 0) AND log_date = {row}.log_date AND log_count <= 0;
+'''
+
+
+def _blocks(template, row):
+    return ''.join(template.format(row=row, owner=owner) for owner in ('category', 'task'))
+
+
+TRIGGERS = (
+    ('time_blocks_rollup_insert', 'time_blocks', 'AFTER INSERT',
+     _blocks(_ADD_BLOCK, 'NEW')),
+    ('time_blocks_rollup_delete', 'time_blocks', 'AFTER DELETE',
+     _blocks(_REMOVE_BLOCK, 'OLD')),
+    ('time_blocks_rollup_update', 'time_blocks', 'AFTER UPDATE',
+     _blocks(_REMOVE_BLOCK, 'OLD') + _blocks(_ADD_BLOCK, 'NEW')),
+    ('habit_logs_rollup_insert', 'habit_logs', 'AFTER INSERT',
+     _ADD_LOG.format(row='NEW')),
+    ('habit_logs_rollup_delete', 'habit_logs', 'AFTER DELETE',
+     _REMOVE_LOG.format(row='OLD')),
+    ('habit_logs_rollup_update', 'habit_logs', 'AFTER UPDATE',
+     _REMOVE_LOG.format(row='OLD') + _ADD_LOG.format(row='NEW')),
+)
+
+
+def create(cursor):
+    """Create the rollup tables and the triggers that maintain them"""
+    for sql in TABLES:
+        cursor.execute(sql)
+    create_triggers(cursor)
+
+
+def create_triggers(cursor, table=None):
+    """(Re)create the maintenance triggers, optionally for one source table"""
+    for name, source, event, body in TRIGGERS:
+        if table in (None, source):
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+            cursor.execute(f'CREATE TRIGGER {name} {event} ON {source} BEGIN {body} END')
+
+
+def drop_triggers(cursor, table=None):
+    """Drop the maintenance triggers ahead of a bulk load
+
+    Only do this inside a transaction that ends with rebuild_*() for the
+    affected range and create_triggers(), so a rollback restores them.
+    """
+    for name, source, _, _ in TRIGGERS:
+        if table in (None, source):
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+
+def _range(column, start_date, end_date):
+    if start_date is None:
+        return '', ()
+    return f'WHERE {column} BETWEEN ? AND ?', (start_date, end_date)
+
+
+def _day_range(start_date, end_date):
+    if start_date is None:
+        return '', ()
+    return 'WHERE day BETWEEN ? AND ?', (clock.day(start_date), clock.day(end_date))
+
+
+def rebuild_time_blocks(cursor, start_date=None, end_date=None):
+    """Recompute category_daily and task_daily, optionally for a date range only"""
+    where, params = _range('block_date', start_date, end_date)
+    day_where, day_params = _day_range(start_date, end_date)
+    for owner in ('category', 'task'):
+        cursor.execute(f'DELETE FROM {owner}_daily {where}', params)
+        cursor.execute(f'''
+            INSERT INTO {owner}_daily ({owner}_id, block_date, total_minutes, block_count)
+            SELECT COALESCE({owner}_id, 0), block_date, SUM(COALESCE(duration_minutes, 0)), COUNT(*)
+            FROM time_blocks
+            {day_where}
+            GROUP BY COALESCE({owner}_id, 0), day
+        ''', day_params)
+
+
+def rebuild_habit_logs(cursor, start_date=None, end_date=None):
+    """Recompute habit_daily, optionally for a date range only"""
+    where, params = _range('log_date', start_date, end_date)
+    cursor.execute(f'DELETE FROM habit_daily {where}', params)
+    day_where, day_params = _day_range(start_date, end_date)
+    cursor.execute(f'''
+        INSERT INTO habit_daily (habit_id, log_date, log_count, completed_count, completion_sum, total_hours)
+        SELECT COALESCE(habit_id, 0), log_date, COUNT(*),
+               SUM(CASE WHEN completed = 1 THEN 1 ELSE 0 END),
+               SUM(COALESCE(completion_percentage, CASE WHEN completed = 1 THEN 100 ELSE 0 END)),
+               SUM(COALESCE(hours_spent, 0))
+        FROM habit_logs
+        {day_where}
+        GROUP BY COALESCE(habit_id, 0), day
+    ''', day_params)
+
+
+def rebuild(cursor):
+    """Recompute every rollup table from the raw rows"""
+    rebuild_time_blocks(cursor)
+    rebuild_habit_logs(cursor)
@@ -0,0 +1,216 @@
+"""Full-text search over time block activities and habit log notes
+
+An FTS5 index per table, time_blocks_fts over time_blocks.activity and
+habit_logs_fts over habit_logs.notes, is kept in step by triggers on every
+insert, delete and edit of the text. The indexes are external-content
+tables keyed by the row id, so they hold the terms but no second copy of
+the text. A search reads the matching ids from the index, newest first,
+applies the date, category, task and habit filters on the rows they point
+to, ranks them with bm25 and builds snippets for the ones it returns. A
+word found in most rows is ranked among its newest RANK_CANDIDATES matches
+only, which keeps common words about as fast as rare ones.
+
+Queries are plain words that must all match, in any order; the last word
+also matches as a prefix, so results narrow while typing.
+"""
+import html
+import re
+
+from flask import request
+
+import clock
+
+# Source table -> (result type, indexed column)
+SOURCES = {
+    'time_blocks': ('time_block', 'activity'),
+    'habit_logs': ('habit_log', 'notes'),
+}
+TOKENIZER = 'unicode61 remove_diacritics 2'
+# Prefix indexes make two- and three-letter prefix queries index lookups
+PREFIXES = '2 3'
+MAX_TERMS = 16
+# bm25 is scored for at most this many of the newest matches per table
+RANK_CANDIDATES = 2000
+SNIPPET_TOKENS = 12
+_WORD = re.compile(r'\w+')
+# Snippets are marked with control characters, escaped, then given <mark> tags
+_OPEN, _CLOSE = '\x02', '\x03'
+
+# Row fields returned per source, and the filters each one supports
+_COLUMNS = {
+    'time_blocks': '''
+        tb.id, tb.block_date AS date, tb.start_time, tb.end_time, tb.activity, tb.duration_minutes,
+        tb.category_id, c.name AS category_name, tb.task_id, t.name AS task_name
+    ''',
+    'habit_logs': '''
+        hl.id, hl.log_date AS date, hl.habit_id, h.name AS habit_name, hl.hours_spent, hl.completed,
+        hl.completion_percentage, hl.notes
+    ''',
+}
+_JOINS = {
+    'time_blocks': '''
+        JOIN time_blocks tb ON tb.id = hits.id
+        LEFT JOIN categories c ON c.id = tb.category_id
+        LEFT JOIN tasks t ON t.id = tb.task_id
+    ''',
+    'habit_logs': '''
+        JOIN habit_logs hl ON hl.id = hits.id
+        LEFT JOIN habits h ON h.id = hl.habit_id
+    ''',
+}
+_FILTERS = {
+    'time_blocks': {'category_id': 'category_id', 'task_id': 'task_id'},
+    'habit_logs': {'habit_id': 'habit_id'},
+}
+
+
+class InvalidQuery(ValueError):
+    """Raised when a search query or its filters can't be used"""
+
+
+def create(cursor):
+    """Create the search indexes, index the existing rows and add the triggers"""
+    for table, (_, column) in SOURCES.items():
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+                {column}, content='{table}', content_rowid='id',
+                tokenize='{TOKENIZER}', prefix='{PREFIXES}'
+            )
+        ''')
+    rebuild(cursor)
+    create_triggers(cursor)
+
+
+def rebuild(cursor, table=None):
+    """Re-index the text of one table, or of every table, from scratch"""
+    for name in SOURCES:
+        if table in (None, name):
+            cursor.execute(f"INSERT INTO {name}_fts ({name}_fts) VALUES ('rebuild')")
+
+
+def create_triggers(cursor, table=None):
+    """(Re)create the index triggers, optionally for one table"""
+    for name, (_, column) in SOURCES.items():
+        if table not in (None, name):
+            continue
+        insert = f'INSERT INTO {name}_fts (rowid, {column}) VALUES (NEW.id, NEW.{column});'
+        # External-content rows are removed by passing the old text back
+        delete = f"INSERT INTO {name}_fts ({name}_fts, rowid, {column}) VALUES ('delete', OLD.id, OLD.{column});"
+        for event, body in (('INSERT', insert), ('DELETE', delete), (f'UPDATE OF {column}', delete + insert)):
+            trigger = f'{name}_search_{event.split()[0].lower()}'
+            cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+            cursor.execute(f'''
+                CREATE TRIGGER {trigger} AFTER {event} ON {name}
+                BEGIN
+                    {body}
+                END
+            ''')
+
+
+def drop_triggers(cursor, table=None):
+    """Drop the index triggers ahead of a bulk load; follow with rebuild() and create_triggers()"""
+    for name in SOURCES:
+        if table in (None, name):
+            for event in ('insert', 'delete', 'update'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}_search_{event}')
+
+
+def match_expression(text):
+    """FTS5 query for plain words: every word must match, the last one as a prefix"""
+    words = _WORD.findall(text or '')
+    if not words:
+        raise InvalidQuery('q must contain at least one word')
+    if len(words) > MAX_TERMS:
+        raise InvalidQuery(f'q may contain at most {MAX_TERMS} words')
+    # Quoting keeps words like AND, OR and NOT from being read as operators
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def requested_filters():
+    """The search filters from the query string, with dates as day numbers"""
+    args = request.args
+    kind = args.get('type')
+    types = {kind for kind, _ in SOURCES.values()}
+    if kind and kind not in types:
+        raise InvalidQuery(f"type must be one of {', '.join(sorted(types))}, got {kind!r}")
+    filters = {'type': kind,
+               'start_day': clock.day(args['start_date']) if args.get('start_date') else None,
+               'end_day': clock.day(args['end_date']) if args.get('end_date') else None}
+    for name in ('category_id', 'task_id', 'habit_id'):
+        value = args.get(name)
+        if value:
+            try:
+                filters[name] = int(value)
+            except ValueError:
+                raise InvalidQuery(f'{name} must be an integer')
+    return filters
+
+
+def _snippet(text):
+    escaped = html.escape(text or '')
+    return escaped.replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>')
+
+
+def _search_table(cursor, table, match, limit, filters):
+    alias = 'tb' if table == 'time_blocks' else 'hl'
+    conditions, params = [f'{table}_fts MATCH ?'], [match]
+    if filters.get('start_day') is not None:
+        conditions.append(f'{alias}.day >= ?')
+        params.append(filters['start_day'])
+    if filters.get('end_day') is not None:
+        conditions.append(f'{alias}.day <= ?')
+        params.append(filters['end_day'])
+    for name, column in _FILTERS[table].items():
+        if name in filters:
+            conditions.append(f'{alias}.{column} = ?')
+            params.append(filters[name])
+
+    kind, column = SOURCES[table]
+    # Walking the matches newest first is cheap and scoring them is not, so a
+    # word in most rows ranks only its newest RANK_CANDIDATES. Snippets are
+    # built during the same walk: looking rows up in the index again by id
+    # re-reads a prefix term's whole posting list for each one.
+    cursor.execute(f'''
+        WITH hits AS (
+            SELECT {table}_fts.rowid AS id, {table}_fts.rank AS rank,
+                   snippet({table}_fts, 0, '{_OPEN}', '{_CLOSE}', '…', {SNIPPET_TOKENS}) AS snippet
+            FROM {table}_fts
+            JOIN {table} {alias} ON {alias}.id = {table}_fts.rowid
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {table}_fts.rowid DESC
+            LIMIT {RANK_CANDIDATES}
+        )
+        SELECT {_COLUMNS[table]}, hits.rank AS rank, hits.snippet AS snippet
+        FROM (SELECT * FROM hits ORDER BY rank LIMIT ?) hits
+        {_JOINS[table]}
+        ORDER BY hits.rank
+    ''', params + [limit])
+    results = []
+    for row in cursor.fetchall():
+        result = dict(row)
+        result['type'] = kind
+        result['score'] = round(-result.pop('rank'), 6)
+        result['snippet'] = _snippet(result['snippet'])
+        results.append(result)
+    return results
+
+
+def run(cursor, text, limit, filters):
+    """The best `limit` matches for a plain-words query, best first
+
+    Category and task filters only apply to time blocks and a habit filter
+    only to habit logs, so each also limits the search to that table.
+    """
+    match = match_expression(text)
+    results = []
+    for table, (kind, _) in SOURCES.items():
+        if filters.get('type') not in (None, kind):
+            continue
+        if any(name in filters for source, names in _FILTERS.items() if source != table for name in names):
+            continue
+        results += _search_table(cursor, table, match, limit, filters)
+    # bm25 scores from the two indexes are on comparable scales for short texts
+    results.sort(key=lambda result: result['score'], reverse=True)
+    return results[:limit]
@@ -0,0 +1,76 @@
+"""Day, ISO week and month bucketing for the time-series analytics
+
+bucket_sql() maps a date column to the first day of its bucket inside SQL,
+so one GROUP BY over a rollup table produces every bucket at once, and
+bucket_starts() lists the same first days in Python so buckets with no data
+can be filled with zeros.
+"""
+from datetime import date, timedelta
+
+BUCKETS = ('day', 'week', 'month')
+MAX_BUCKETS = 2000
+
+
+def bucket_sql(bucket, column):
+    """SQL expression for the first day of the bucket containing `column`"""
+    if bucket == 'day':
+        return column
+    if bucket == 'week':
+        # 'weekday 0' moves forward to Sunday; six days back is the ISO Monday
+        return f"date({column}, 'weekday 0', '-6 days')"
+    if bucket == 'month':
+        return f"date({column}, 'start of month')"
+    raise ValueError(f'unknown bucket {bucket!r}')
+
+
+def bucket_start(bucket, day):
+    """First day of the bucket containing a date"""
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def bucket_starts(bucket, start_date, end_date):
+    """First day of every bucket overlapping start_date..end_date, in order"""
+    day = bucket_start(bucket, start_date)
+    starts = []
+    while day <= end_date:
+        starts.append(day)
+        if len(starts) > MAX_BUCKETS:
+            raise ValueError(f'more than {MAX_BUCKETS} {bucket} buckets in range')
+        if bucket == 'day':
+            day += timedelta(days=1)
+        elif bucket == 'week':
+            day += timedelta(days=7)
+        else:
+            day = date(day.year + day.month // 12, day.month % 12 + 1, 1)
+    return starts
+
+
+def label(bucket, day):
+    """Display label for a bucket: 2024-03-05, 2024-W10 or 2024-03"""
+    if bucket == 'week':
+        year, week, _ = day.isocalendar()
+        return f'{year}-W{week:02d}'
+    if bucket == 'month':
+        return day.strftime('%Y-%m')
+    return day.isoformat()
+
+
+def dense(rows, starts, fields):
+    """Spread grouped (id, bucket, *fields) rows into zero-filled per-id lists
+
+    Returns {id: {field: [value per bucket]}} for the ids present in rows.
+    """
+    index = {day.isoformat(): i for i, day in enumerate(starts)}
+    series = {}
+    for row in rows:
+        values = series.get(row[0])
+        if values is None:
+            values = series[row[0]] = {field: [0] * len(starts) for field in fields}
+        i = index[row[1]]
+        for field, value in zip(fields, row[2:]):
+            values[field][i] = value
+    return series
@@ -0,0 +1,303 @@
+"""Binary snapshots of every table, for backups and fast bulk loads
+
+/export/snapshot writes the stored columns of habits, categories, tasks,
+habit_logs and time_blocks, ids included, and /import/snapshot replaces
+the tables with a snapshot's rows, so a round trip restores the database's
+data exactly. Virtual columns (block_date, start_time, ...) are left out
+and recomputed on load.
+
+A snapshot is a stream of length-prefixed frames, little-endian:
+
+    MAGIC, then a JSON header {"format", "schema_version", "created_at"}
+    per table: a JSON header {"table", "columns"}, then chunks of at most
+        CHUNK_ROWS rows, each (rows, columns) followed by a zlib-compressed
+        block per column; a chunk of 0 rows ends the table
+    an empty table header ends the snapshot
+
+Within a chunk each column is stored on its own, in the first encoding
+that fits all its values: integers as deltas from the previous row in an
+array of int64 (ids and days then compress to almost nothing), reals as an
+array of doubles, both with a null mask when there are NULLs, and text
+dictionary-encoded, so a category, task or habit name or a repeated
+activity is stored once per chunk and referenced by number. Columns mixing
+types fall back to JSON. Writing and reading both go a chunk at a time, so
+memory stays bounded by CHUNK_ROWS whatever the size of the database.
+
+Loading suspends the per-row triggers like the CSV import and drops the
+tables' secondary indexes, inserts the rows in executemany batches, then
+rebuilds the indexes, rollups, streaks and search indexes once and records the load in the cache stamps, change events and
+sync log, where rows missing from the snapshot become deletions.
+"""
+import json
+import operator
+import struct
+import sys
+import zlib
+from array import array
+from datetime import datetime, timezone
+from itertools import accumulate, chain
+
+import cache
+import events
+import importer
+import rollups
+import search
+import streaks
+import sync
+
+MAGIC = b'ONTRACK-SNAPSHOT\n'
+FORMAT = 1
+# Parents before the rows that reference them
+TABLES = ('habits', 'categories', 'tasks', 'habit_logs', 'time_blocks')
+CHUNK_ROWS = 65536
+COMPRESSION = 6
+
+_FRAME = struct.Struct('<I')
+_CHUNK = struct.Struct('<II')
+_SWAP = sys.byteorder == 'big'
+_NULL = type(None)
+
+
+class InvalidSnapshot(ValueError):
+    """Raised when an uploaded file is not a snapshot this version can read"""
+
+
+class SnapshotResult:
+    """Rows loaded per table"""
+
+    def __init__(self):
+        self.tables = {}
+
+    def to_dict(self):
+        return {'success': True, 'imported': sum(self.tables.values()), 'tables': self.tables}
+
+
+def stored_columns(cursor, table):
+    """The columns of a table that hold data, leaving out generated ones"""
+    cursor.execute(f'PRAGMA table_xinfo({table})')
+    return [row[1] for row in cursor.fetchall() if row[6] == 0]
+
+
+def _array_bytes(values):
+    if _SWAP:
+        values.byteswap()
+    return values.tobytes()
+
+
+def _array(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if _SWAP:
+        values.byteswap()
+    return values
+
+
+def _parts(kind, *parts):
+    return kind + b''.join(_FRAME.pack(len(part)) + part for part in parts)
+
+
+def _nulls(values):
+    """Null mask and the values with NULLs as 0, or (b'', values) without NULLs"""
+    if None not in values:
+        return b'', values
+    return bytes(value is None for value in values), [0 if value is None else value for value in values]
+
+
+def encode_column(values):
+    """One column of a chunk as a self-describing block"""
+    types = set(map(type, values))
+    types.discard(_NULL)
+    if types <= {int}:
+        mask, filled = _nulls(values)
+        try:
+            deltas = array('q', map(operator.sub, filled, chain((0,), filled)))
+        except OverflowError:
+            pass
+        else:
+            return _parts(b'i', _array_bytes(deltas), mask)
+    if float in types and types <= {int, float}:
+        mask, filled = _nulls(values)
+        try:
+            return _parts(b'f', _array_bytes(array('d', filled)), mask)
+        except OverflowError:
+            pass
+    if types <= {str}:
+        # Code 0 is NULL; codes 1.. index the chunk's distinct strings in first-seen order
+        index = {None: 0}
+        codes = array('I', [index.setdefault(value, len(index)) for value in values])
+        strings = [value.encode('utf-8') for value in index if value is not None]
+        lengths = array('I', map(len, strings))
+        return _parts(b's', _array_bytes(codes), _array_bytes(lengths), b''.join(strings))
+    return _parts(b'j', json.dumps(values).encode('utf-8'))
+
+
+def _split(block):
+    parts, offset = [], 1
+    while offset < len(block):
+        (size,) = _FRAME.unpack_from(block, offset)
+        offset += _FRAME.size
+        parts.append(block[offset:offset + size])
+        offset += size
+    return block[:1], parts
+
+
+def _apply_nulls(values, mask):
+    if not mask:
+        return values
+    return [None if null else value for value, null in zip(values, mask)]
+
+
+def decode_column(block, rows):
+    """The values of one column block of a chunk of `rows` rows"""
+    kind, parts = _split(block)
+    if kind == b'i':
+        values = list(accumulate(_array('q', parts[0])))
+        values = _apply_nulls(values, parts[1])
+    elif kind == b'f':
+        values = _apply_nulls(_array('d', parts[0]).tolist(), parts[1])
+    elif kind == b's':
+        codes = _array('I', parts[0])
+        strings, offset = [None], 0
+        for size in _array('I', parts[1]):
+            strings.append(parts[2][offset:offset + size].decode('utf-8'))
+            offset += size
+        values = list(map(strings.__getitem__, codes))
+    elif kind == b'j':
+        values = json.loads(parts[0])
+    else:
+        raise InvalidSnapshot(f'unknown column encoding {kind!r}')
+    if len(values) != rows:
+        raise InvalidSnapshot(f'a column has {len(values)} values in a chunk of {rows} rows')
+    return values
+
+
+def _frame(payload):
+    return _FRAME.pack(len(payload)) + payload
+
+
+def _header(data):
+    return _frame(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+
+def dump(conn):
+    """Generate a snapshot of every table as bytes, from one read transaction"""
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    conn.execute('BEGIN')
+    try:
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+        schema_version = cursor.fetchone()[0]
+        yield MAGIC + _header({'format': FORMAT, 'schema_version': schema_version,
+                               'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds')})
+        for table in TABLES:
+            columns = stored_columns(cursor, table)
+            yield _header({'table': table, 'columns': columns})
+            cursor.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY id")
+            while True:
+                rows = cursor.fetchmany(CHUNK_ROWS)
+                if not rows:
+                    break
+                blocks = [zlib.compress(encode_column(list(values)), COMPRESSION) for values in zip(*rows)]
+                yield _CHUNK.pack(len(rows), len(blocks)) + b''.join(map(_frame, blocks))
+            yield _CHUNK.pack(0, 0)
+        yield _FRAME.pack(0)
+    finally:
+        conn.rollback()
+
+
+def _read(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            raise InvalidSnapshot('the snapshot is truncated')
+        data += more
+    return data
+
+
+def _read_frame(stream):
+    (size,) = _FRAME.unpack(_read(stream, _FRAME.size))
+    return _read(stream, size)
+
+
+def _read_header(stream):
+    payload = _read_frame(stream)
+    if not payload:
+        return None
+    try:
+        return json.loads(payload)
+    except ValueError:
+        raise InvalidSnapshot('a snapshot header is not valid JSON')
+
+
+def read(stream):
+    """Yield (table, columns, rows) chunks from a binary snapshot stream"""
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise InvalidSnapshot('not an OnTrack snapshot')
+    header = _read_header(stream)
+    if not isinstance(header, dict) or header.get('format') != FORMAT:
+        raise InvalidSnapshot(f'unsupported snapshot format {header.get("format") if header else None!r}')
+    while True:
+        section = _read_header(stream)
+        if section is None:
+            return
+        table, columns = section.get('table'), section.get('columns')
+        if not isinstance(table, str) or not isinstance(columns, list):
+            raise InvalidSnapshot('a table header lacks its name or columns')
+        while True:
+            rows, count = _CHUNK.unpack(_read(stream, _CHUNK.size))
+            if rows == 0:
+                break
+            if count != len(columns):
+                raise InvalidSnapshot(f'{table} chunk has {count} columns, expected {len(columns)}')
+            try:
+                values = [decode_column(zlib.decompress(_read_frame(stream)), rows) for _ in columns]
+            except zlib.error as e:
+                raise InvalidSnapshot(f'a {table} chunk is corrupt: {e}')
+            yield table, columns, zip(*values)
+
+
+def load(conn, stream):
+    """Replace every table's rows with a snapshot's, inside the caller's transaction"""
+    cursor = conn.cursor()
+    result = SnapshotResult()
+    search.drop_triggers(cursor)
+    # Building the secondary indexes once at the end beats updating them row by row
+    cursor.execute(f'''
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({', '.join('?' for _ in TABLES)})
+    ''', TABLES)
+    indexes = cursor.fetchall()
+    for name, _ in indexes:
+        cursor.execute(f'DROP INDEX {name}')
+    for table in TABLES:
+        importer.suspend_triggers(cursor, table)
+        cursor.execute(f'DELETE FROM {table}')
+        result.tables[table] = 0
+
+    known = {table: set(stored_columns(cursor, table)) for table in TABLES}
+    for table, columns, rows in read(stream):
+        if table not in known:
+            # Tables from a newer version are skipped rather than failing the load
+            continue
+        # Likewise columns this schema doesn't have; missing ones take their defaults
+        keep = [i for i, column in enumerate(columns) if column in known[table]]
+        if len(keep) < len(columns):
+            rows = (tuple(row[i] for i in keep) for row in rows)
+        names = [columns[i] for i in keep]
+        cursor.executemany(f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})",
+                           rows)
+        result.tables[table] += cursor.rowcount
+    for _, sql in indexes:
+        cursor.execute(sql)
+
+    rollups.rebuild(cursor)
+    streaks.rebuild(cursor)
+    search.rebuild(cursor)
+    for table in TABLES:
+        cache.stamp(cursor, table)
+        events.record(cursor, table, 'import')
+        sync.mark_all(cursor, table)
+        importer.restore_triggers(cursor, table)
+    search.create_triggers(cursor)
+    return result
@@ -1,3 +1,6 @@
+// Prefix of every URL: /t/<tenant> when served for a tenant, otherwise empty
+const ROOT = document.body.dataset.root;
+
 // Set current date
 const dateInput = document.getElementById('currentDate');
 dateInput.value = new Date().toISOString().split('T')[0];
@@ -5,6 +8,26 @@ dateInput.value = new Date().toISOString().split('T')[0];
 // Global variable to track last end time
 let lastEndTime = '00:00';
 
+// The lists as last loaded, by id; the change event stream keeps them current
+const state = {
+    categories: new Map(),
+    tasks: new Map(),
+    habits: new Map(),
+    habitLogs: new Map(),   // logs of the selected date
+    timeBlocks: new Map()   // blocks of the selected date
+};
+
+// True while /api/events is connected, so writes don't need to reload lists
+let liveUpdates = false;
+
+// Reload lists after a write, unless its change events will patch them
+async function reloadUnlessLive(...loaders) {
+    if (liveUpdates) return;
+    for (const load of loaders) {
+        await load();
+    }
+}
+
 // Tab switching
 document.querySelectorAll('.tab-button').forEach(button => {
     button.addEventListener('click', () => {
@@ -45,7 +68,7 @@ document.getElementById('categoryForm').addEventListener('submit', async (e) =>
     const name = document.getElementById('categoryName').value;
     const color = document.getElementById('categoryColor').value;
     
-    const response = await fetch('/api/categories', {
+    const response = await fetch(ROOT + '/api/categories', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ name, color })
@@ -53,8 +76,7 @@ document.getElementById('categoryForm').addEventListener('submit', async (e) =>
     
     if (response.ok) {
         document.getElementById('categoryForm').reset();
-        await loadCategories();
-        await loadTasks();
+        await reloadUnlessLive(loadCategories);
     } else {
         const data = await response.json();
         alert(data.error || 'Error creating category');
@@ -67,7 +89,7 @@ document.getElementById('taskForm').addEventListener('submit', async (e) => {
     const name = document.getElementById('taskName').value;
     const categoryId = document.getElementById('taskCategorySelect').value || null;
     
-    const response = await fetch('/api/tasks', {
+    const response = await fetch(ROOT + '/api/tasks', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ name, category_id: categoryId })
@@ -75,7 +97,7 @@ document.getElementById('taskForm').addEventListener('submit', async (e) => {
     
     if (response.ok) {
         document.getElementById('taskForm').reset();
-        await loadTasks();
+        await reloadUnlessLive(loadTasks);
     } else {
         const data = await response.json();
         alert(data.error || 'Error creating task');
@@ -90,7 +112,7 @@ document.getElementById('habitForm').addEventListener('submit', async (e) => {
     const targetHours = document.getElementById('targetHours').value;
     const targetType = document.getElementById('targetType').value;
     
-    const response = await fetch('/api/habits', {
+    const response = await fetch(ROOT + '/api/habits', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -105,7 +127,7 @@ document.getElementById('habitForm').addEventListener('submit', async (e) => {
         document.getElementById('habitForm').reset();
         document.getElementById('targetHours').style.display = 'none';
         document.getElementById('targetType').style.display = 'none';
-        loadHabits();
+        reloadUnlessLive(loadHabits);
     }
 });
 
@@ -119,7 +141,7 @@ document.getElementById('timeBlockForm').addEventListener('submit', async (e) =>
     const taskId = document.getElementById('taskSelect').value || null;
     const blockDate = dateInput.value;
     
-    const response = await fetch('/api/time-blocks', {
+    const response = await fetch(ROOT + '/api/time-blocks', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -139,7 +161,11 @@ document.getElementById('timeBlockForm').addEventListener('submit', async (e) =>
         document.getElementById('endTime').value = '';
         document.getElementById('activity').value = '';
         // Keep category and task selected
-        loadTimeBlocks();
+        reloadUnlessLive(loadTimeBlocks);
+    } else if (response.status === 409) {
+        const result = await response.json();
+        const existing = result.overlaps.map(b => `${b.start_time}-${b.end_time} ${b.activity}`).join('\n');
+        alert(`This block overlaps:\n${existing}`);
     }
 });
 
@@ -157,7 +183,7 @@ async function loadTasksForCategory(categoryId) {
     
     if (!categoryId) return;
     
-    const response = await fetch(`/api/tasks?category_id=${categoryId}`);
+    const response = await fetch(`${ROOT}/api/tasks?category_id=${categoryId}`);
     const tasks = await response.json();
     
     tasks.forEach(task => {
@@ -170,15 +196,20 @@ async function loadTasksForCategory(categoryId) {
 
 // Load all categories
 async function loadCategories() {
-    const response = await fetch('/api/categories');
-    const categories = await response.json();
+    const response = await fetch(ROOT + '/api/categories');
+    fill(state.categories, await response.json());
+    renderCategories();
+}
+
+function renderCategories() {
+    const categories = sorted(state.categories, (a, b) => a.name.localeCompare(b.name));
     
     // Update all category selectors
-    const selectors = ['categorySelect', 'taskCategorySelect'];
-    selectors.forEach(selectorId => {
+    const selectors = { categorySelect: 'No category', taskCategorySelect: 'No category', stopwatchCategory: 'Select category' };
+    Object.entries(selectors).forEach(([selectorId, placeholder]) => {
         const select = document.getElementById(selectorId);
         const currentValue = select.value;
-        select.innerHTML = '<option value="">No category</option>';
+        select.innerHTML = `<option value="">${placeholder}</option>`;
         
         categories.forEach(cat => {
             const option = document.createElement('option');
@@ -247,16 +278,14 @@ async function saveCategoryEdit(catId) {
         return;
     }
     
-    const response = await fetch(`/api/categories/${catId}`, {
+    const response = await fetch(`${ROOT}/api/categories/${catId}`, {
         method: 'PUT',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ name, color })
     });
     
     if (response.ok) {
-        await loadCategories();
-        await loadTimeBlocks();
-        await loadTasks();
+        await reloadUnlessLive(loadCategories, loadTimeBlocks, loadTasks);
     } else {
         const data = await response.json();
         alert(data.error || 'Error updating category');
@@ -268,12 +297,10 @@ async function deleteCategory(catId) {
         return;
     }
     
-    const response = await fetch(`/api/categories/${catId}`, { method: 'DELETE' });
+    const response = await fetch(`${ROOT}/api/categories/${catId}`, { method: 'DELETE' });
     
     if (response.ok) {
-        await loadCategories();
-        await loadTimeBlocks();
-        await loadTasks();
+        await reloadUnlessLive(loadCategories, loadTimeBlocks, loadTasks);
     } else {
         const data = await response.json();
         alert(data.error || 'Error deleting category');
@@ -282,8 +309,15 @@ async function deleteCategory(catId) {
 
 // Load all tasks
 async function loadTasks() {
-    const response = await fetch('/api/tasks');
-    const tasks = await response.json();
+    const response = await fetch(ROOT + '/api/tasks');
+    fill(state.tasks, await response.json());
+    renderTasks();
+}
+
+function renderTasks() {
+    // Same order as the server: by category name, uncategorized first, then name
+    const tasks = sorted(state.tasks, (a, b) =>
+        (a.category_name || '').localeCompare(b.category_name || '') || a.name.localeCompare(b.name));
     
     const tasksList = document.getElementById('tasksList');
     if (tasks.length === 0) {
@@ -330,8 +364,7 @@ async function editTask(taskId, name, categoryId) {
     document.getElementById(`edit-task-${taskId}`).style.display = 'block';
     
     // Populate category dropdown
-    const response = await fetch('/api/categories');
-    const categories = await response.json();
+    const categories = sorted(state.categories, (a, b) => a.name.localeCompare(b.name));
     const select = document.getElementById(`edit-task-cat-${taskId}`);
     select.innerHTML = '<option value="">No category</option>';
     categories.forEach(cat => {
@@ -356,14 +389,14 @@ async function saveTaskEdit(taskId) {
         return;
     }
     
-    const response = await fetch(`/api/tasks/${taskId}`, {
+    const response = await fetch(`${ROOT}/api/tasks/${taskId}`, {
         method: 'PUT',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ name, category_id: categoryId })
     });
     
     if (response.ok) {
-        await loadTasks();
+        await reloadUnlessLive(loadTasks, loadTimeBlocks);
     } else {
         const data = await response.json();
         alert(data.error || 'Error updating task');
@@ -373,10 +406,10 @@ async function saveTaskEdit(taskId) {
 async function deleteTask(taskId) {
     if (!confirm('Delete this task?')) return;
     
-    const response = await fetch(`/api/tasks/${taskId}`, { method: 'DELETE' });
+    const response = await fetch(`${ROOT}/api/tasks/${taskId}`, { method: 'DELETE' });
     
     if (response.ok) {
-        await loadTasks();
+        await reloadUnlessLive(loadTasks);
     } else {
         const data = await response.json();
         alert(data.error || 'Error deleting task');
@@ -385,8 +418,14 @@ async function deleteTask(taskId) {
 
 // Load all habits
 async function loadHabits() {
-    const response = await fetch('/api/habits');
-    const habits = await response.json();
+    const response = await fetch(ROOT + '/api/habits');
+    fill(state.habits, await response.json());
+    renderHabits();
+}
+
+function renderHabits() {
+    // Newest first, like /api/habits
+    const habits = sorted(state.habits, (a, b) => b.created_at.localeCompare(a.created_at) || b.id - a.id);
     
     const habitsList = document.getElementById('habitsList');
     
@@ -403,15 +442,14 @@ async function loadHabits() {
         
         let progressHTML = '';
         if (habit.habit_type === 'project') {
-            const progressResponse = await fetch(`/api/habit-progress/${habit.id}`);
-            const progress = await progressResponse.json();
-            const percentage = (progress.total_hours / progress.target_hours) * 100;
+            // total_hours comes back with the habit list, no per-habit request needed
+            const percentage = (habit.total_hours / habit.target_hours) * 100;
             
             progressHTML = `
                 <div class="progress-bar">
                     <div class="progress-fill" style="width: ${Math.min(percentage, 100)}%"></div>
                 </div>
-                <p>${progress.total_hours} / ${progress.target_hours} hours (${percentage.toFixed(1)}%)</p>
+                <p>${habit.total_hours} / ${habit.target_hours} hours (${percentage.toFixed(1)}%)</p>
             `;
         }
         
@@ -441,8 +479,6 @@ async function loadHabits() {
         
         habitsList.appendChild(card);
     }
-    
-    loadHabitLogs();
 }
 
 async function logHabit(habitId, habitType, targetType) {
@@ -470,7 +506,7 @@ async function logHabit(habitId, habitType, targetType) {
     
     const notes = document.getElementById(`notes-${habitId}`).value;
     
-    const response = await fetch('/api/habit-logs', {
+    const response = await fetch(ROOT + '/api/habit-logs', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -494,26 +530,30 @@ async function logHabit(habitId, habitType, targetType) {
         }
         document.getElementById(`notes-${habitId}`).value = '';
         
-        loadHabits();
-        loadHabitLogs();
+        reloadUnlessLive(loadHabits, loadHabitLogs);
     }
 }
 
 async function deleteHabit(habitId) {
     if (!confirm('Are you sure you want to delete this habit and all its logs?')) return;
     
-    const response = await fetch(`/api/habits/${habitId}`, { method: 'DELETE' });
+    const response = await fetch(`${ROOT}/api/habits/${habitId}`, { method: 'DELETE' });
     
     if (response.ok) {
-        loadHabits();
+        reloadUnlessLive(loadHabits, loadHabitLogs);
     }
 }
 
 // Load habit logs for today
 async function loadHabitLogs() {
     const logDate = dateInput.value;
-    const response = await fetch(`/api/habit-logs?date=${logDate}`);
-    const logs = await response.json();
+    const response = await fetch(`${ROOT}/api/habit-logs?date=${logDate}`);
+    fill(state.habitLogs, await response.json());
+    renderHabitLogs();
+}
+
+function renderHabitLogs() {
+    const logs = sorted(state.habitLogs, (a, b) => b.id - a.id);
     
     const todayLogs = document.getElementById('todayLogs');
     
@@ -602,7 +642,7 @@ async function saveLogEdit(logId, habitType, targetType) {
     
     const notes = document.getElementById(`edit-notes-${logId}`).value;
     
-    const response = await fetch(`/api/habit-logs/${logId}`, {
+    const response = await fetch(`${ROOT}/api/habit-logs/${logId}`, {
         method: 'PUT',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -614,41 +654,47 @@ async function saveLogEdit(logId, habitType, targetType) {
     });
     
     if (response.ok) {
-        loadHabitLogs();
-        loadHabits();
+        reloadUnlessLive(loadHabitLogs, loadHabits);
     }
 }
 
 async function deleteLog(logId) {
     if (!confirm('Delete this log entry?')) return;
     
-    const response = await fetch(`/api/habit-logs/${logId}`, { method: 'DELETE' });
+    const response = await fetch(`${ROOT}/api/habit-logs/${logId}`, { method: 'DELETE' });
     
     if (response.ok) {
-        loadHabitLogs();
-        loadHabits();
+        reloadUnlessLive(loadHabitLogs, loadHabits);
     }
 }
 
 // Load time blocks
 async function loadTimeBlocks() {
     const blockDate = dateInput.value;
-    const response = await fetch(`/api/time-blocks?date=${blockDate}`);
+    const response = await fetch(`${ROOT}/api/time-blocks?date=${blockDate}`);
     const data = await response.json();
+    fill(state.timeBlocks, data.blocks);
+    renderTimeBlocks();
+}
+
+function renderTimeBlocks() {
+    const blocks = sorted(state.timeBlocks, (a, b) => a.start_time.localeCompare(b.start_time));
+    const totalMinutes = blocks.reduce((total, block) => total + block.duration_minutes, 0);
+    const totalHours = Math.round(totalMinutes / 60 * 100) / 100;
     
-    document.getElementById('totalTracked').textContent = data.total_hours;
-    document.getElementById('remainingTime').textContent = (24 - data.total_hours).toFixed(2);
+    document.getElementById('totalTracked').textContent = totalHours;
+    document.getElementById('remainingTime').textContent = (24 - totalHours).toFixed(2);
     
     const timeBlocksList = document.getElementById('timeBlocksList');
     
-    if (data.blocks.length === 0) {
+    if (blocks.length === 0) {
         timeBlocksList.innerHTML = '<div class="empty-state"><p>No time blocks for this date.</p></div>';
         return;
     }
     
     timeBlocksList.innerHTML = '';
     
-    data.blocks.forEach(block => {
+    blocks.forEach(block => {
         const blockCard = document.createElement('div');
         blockCard.className = 'time-block-card';
         
@@ -684,20 +730,20 @@ async function loadTimeBlocks() {
 async function deleteTimeBlock(blockId) {
     if (!confirm('Delete this time block?')) return;
     
-    const response = await fetch(`/api/time-blocks/${blockId}`, { method: 'DELETE' });
+    const response = await fetch(`${ROOT}/api/time-blocks/${blockId}`, { method: 'DELETE' });
     
     if (response.ok) {
-        await loadTimeBlocks();
+        await reloadUnlessLive(loadTimeBlocks);
     }
 }
 
 // Export/Import functions
 function exportHabits() {
-    window.location.href = '/export/habits';
+    window.location.href = ROOT + '/export/habits';
 }
 
 function exportTimeBlocks() {
-    window.location.href = '/export/timeblocks';
+    window.location.href = ROOT + '/export/timeblocks';
 }
 
 async function importHabits() {
@@ -712,7 +758,7 @@ async function importHabits() {
     const formData = new FormData();
     formData.append('file', file);
     
-    const response = await fetch('/import/habits', {
+    const response = await fetch(ROOT + '/import/habits', {
         method: 'POST',
         body: formData
     });
@@ -721,8 +767,7 @@ async function importHabits() {
     
     if (result.success) {
         alert(`Successfully imported ${result.imported} habit logs!`);
-        await loadHabits();
-        await loadHabitLogs();
+        await reloadUnlessLive(loadHabits, loadHabitLogs);
         fileInput.value = '';
     } else {
         alert('Error importing: ' + result.error);
@@ -741,7 +786,7 @@ async function importTimeBlocks() {
     const formData = new FormData();
     formData.append('file', file);
     
-    const response = await fetch('/import/timeblocks', {
+    const response = await fetch(ROOT + '/import/timeblocks', {
         method: 'POST',
         body: formData
     });
@@ -750,7 +795,7 @@ async function importTimeBlocks() {
     
     if (result.success) {
         alert(`Successfully imported ${result.imported} time blocks!`);
-        await loadTimeBlocks();
+        await reloadUnlessLive(loadCategories, loadTasks, loadTimeBlocks);
         fileInput.value = '';
     } else {
         alert('Error importing: ' + result.error);
@@ -777,7 +822,7 @@ async function loadAnalytics() {
     }
     
     // Load category analytics
-    const response = await fetch(`/api/analytics?start_date=${startDate}&end_date=${endDate}`);
+    const response = await fetch(`${ROOT}/api/analytics?start_date=${startDate}&end_date=${endDate}`);
     const data = await response.json();
     
     const analyticsResults = document.getElementById('analyticsResults');
@@ -822,7 +867,7 @@ async function loadAnalytics() {
     }
     
     // Load task analytics
-    const taskResponse = await fetch(`/api/analytics/tasks?start_date=${startDate}&end_date=${endDate}`);
+    const taskResponse = await fetch(`${ROOT}/api/analytics/tasks?start_date=${startDate}&end_date=${endDate}`);
     const taskData = await taskResponse.json();
     
     const taskAnalyticsResults = document.getElementById('taskAnalyticsResults');
@@ -865,7 +910,7 @@ async function loadAnalytics() {
     }
     
     // Load habit analytics
-    const habitResponse = await fetch(`/api/analytics/habits?start_date=${startDate}&end_date=${endDate}`);
+    const habitResponse = await fetch(`${ROOT}/api/analytics/habits?start_date=${startDate}&end_date=${endDate}`);
     const habitData = await habitResponse.json();
     
     const habitAnalyticsResults = document.getElementById('habitAnalyticsResults');
@@ -910,12 +955,196 @@ async function loadAnalytics() {
     }
 }
 
+// ====== LIVE UPDATES ======
+
+// Replace a state map's contents with a freshly loaded list
+function fill(map, rows) {
+    map.clear();
+    rows.forEach(row => map.set(row.id, row));
+}
+
+function sorted(map, compare) {
+    return [...map.values()].sort(compare);
+}
+
+// Fetch one row into a state map, or drop it if it's gone or no longer belongs there
+async function patchRow(map, url, id, belongs = () => true) {
+    const response = await fetch(url);
+    const row = response.ok ? await response.json() : null;
+    if (row && belongs(row)) {
+        map.set(id, row);
+    } else {
+        map.delete(id);
+    }
+}
+
+// Copy a category's or task's name onto the rows that show it
+function patchReferences(map, key, id, fields) {
+    let changed = false;
+    map.forEach(row => {
+        if (row[key] === id) {
+            Object.assign(row, fields);
+            changed = true;
+        }
+    });
+    return changed;
+}
+
+// Apply one event from /api/events: {entity, op, id, date}, op being
+// create, update, delete or import (a CSV import replaced many rows at once)
+async function applyChange(change) {
+    const { entity, op, id } = change;
+    const removed = op === 'delete';
+    const selectedDate = dateInput.value;
+    
+    if (op === 'import') {
+        if (entity === 'habit_log') {
+            await loadHabits();
+            await loadHabitLogs();
+        } else if (entity === 'time_block') {
+            await loadTimeBlocks();
+        }
+        return;
+    }
+    
+    if (entity === 'category') {
+        if (removed) {
+            state.categories.delete(id);
+        } else {
+            await patchRow(state.categories, `${ROOT}/api/categories/${id}`, id);
+            const category = state.categories.get(id);
+            if (category) {
+                const fields = { category_name: category.name, category_color: category.color };
+                if (patchReferences(state.tasks, 'category_id', id, fields)) renderTasks();
+                if (patchReferences(state.timeBlocks, 'category_id', id, fields)) renderTimeBlocks();
+            }
+        }
+        renderCategories();
+    } else if (entity === 'task') {
+        if (removed) {
+            state.tasks.delete(id);
+        } else {
+            await patchRow(state.tasks, `${ROOT}/api/tasks/${id}`, id);
+            const task = state.tasks.get(id);
+            if (task && patchReferences(state.timeBlocks, 'task_id', id, { task_name: task.name })) renderTimeBlocks();
+        }
+        renderTasks();
+    } else if (entity === 'habit') {
+        if (removed) {
+            state.habits.delete(id);
+        } else {
+            await patchRow(state.habits, `${ROOT}/api/habits/${id}`, id);
+            const habit = state.habits.get(id);
+            const fields = habit && { name: habit.name, habit_type: habit.habit_type, target_type: habit.target_type };
+            if (habit && patchReferences(state.habitLogs, 'habit_id', id, fields)) renderHabitLogs();
+        }
+        renderHabits();
+    } else if (entity === 'habit_log') {
+        // Logging changes the habit's total and streak too
+        let habitId = state.habitLogs.get(id)?.habit_id;
+        if (removed) {
+            state.habitLogs.delete(id);
+        } else {
+            const response = await fetch(`${ROOT}/api/habit-logs/${id}`);
+            const log = response.ok ? await response.json() : null;
+            if (log && log.log_date === selectedDate) {
+                state.habitLogs.set(id, log);
+            } else {
+                state.habitLogs.delete(id);
+            }
+            habitId = habitId ?? log?.habit_id;
+        }
+        renderHabitLogs();
+        if (habitId !== undefined) {
+            await patchRow(state.habits, `${ROOT}/api/habits/${habitId}`, habitId);
+            renderHabits();
+        } else {
+            // A deleted log from another day, whose habit we can't look up anymore
+            reloadSoon(loadHabits);
+        }
+    } else if (entity === 'time_block') {
+        if (removed) {
+            state.timeBlocks.delete(id);
+        } else if (change.date === selectedDate || state.timeBlocks.has(id)) {
+            await patchRow(state.timeBlocks, `${ROOT}/api/time-blocks/${id}`, id, block => block.block_date === selectedDate);
+        }
+        renderTimeBlocks();
+    }
+}
+
+// Events are applied one at a time, in the order they happened
+let pendingChanges = Promise.resolve();
+
+function queueChange(apply) {
+    pendingChanges = pendingChanges.then(apply).catch(error => console.error('Live update failed', error));
+}
+
+// Reload lists once after a burst of events that each asked for it
+const staleLoaders = new Set();
+let reloadTimer = null;
+
+function reloadSoon(load) {
+    staleLoaders.add(load);
+    clearTimeout(reloadTimer);
+    reloadTimer = setTimeout(() => {
+        const loaders = [...staleLoaders];
+        staleLoaders.clear();
+        queueChange(async () => {
+            for (const reload of loaders) {
+                await reload();
+            }
+        });
+    }, 250);
+}
+
+async function reloadAll() {
+    await loadCategories();
+    await loadTasks();
+    await loadHabits();
+    await loadHabitLogs();
+    await loadTimeBlocks();
+}
+
+// Id of the last event applied, to resume from after a refused stream
+let lastEventId = null;
+const EVENTS_RETRY_MS = 30000;
+
+function connectEvents() {
+    if (!window.EventSource) return;
+    
+    // The browser reconnects by itself when a stream ends and resumes after
+    // the last event it saw, so nothing written while disconnected is missed
+    const since = lastEventId === null ? '' : `?since=${lastEventId}`;
+    const source = new EventSource(`${ROOT}/api/events${since}`);
+    source.onopen = () => { liveUpdates = true; };
+    source.onerror = () => {
+        liveUpdates = false;
+        // Refused (every stream slot in use) rather than dropped: the browser
+        // won't retry, so writes reload lists until a later attempt gets in
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(connectEvents, EVENTS_RETRY_MS);
+        }
+    };
+    source.addEventListener('change', e => {
+        lastEventId = e.lastEventId;
+        const change = JSON.parse(e.data);
+        queueChange(() => applyChange(change));
+    });
+    // Sent when the server no longer has the events we missed
+    source.addEventListener('reset', e => {
+        lastEventId = e.lastEventId;
+        queueChange(reloadAll);
+    });
+}
+
 // Initial load
 loadHabits();
+loadHabitLogs();
 loadTimeBlocks();
 loadCategories();
 loadTasks();
 initAnalytics();
+connectEvents();
 
 // ====== STOPWATCH FUNCTIONALITY ======
 
@@ -934,7 +1163,7 @@ document.getElementById('stopwatchCategory').addEventListener('change', async (e
     
     if (!e.target.value) return;
     
-    const response = await fetch(`/api/tasks?category_id=${e.target.value}`);
+    const response = await fetch(`${ROOT}/api/tasks?category_id=${e.target.value}`);
     const tasks = await response.json();
     
     tasks.forEach(task => {
@@ -1067,58 +1296,47 @@ async function saveStopwatchBlock() {
     
     const blockDate = dateInput.value;
     
-    // Save main activity block
-    const mainResponse = await fetch('/api/time-blocks', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-            block_date: blockDate,
-            start_time: startTime,
-            end_time: endTime,
-            activity: notes || 'Stopwatch activity',
-            category_id: categoryId,
-            task_id: taskId
-        })
-    });
+    // Breaks are lumped together at the end of the session so the two
+    // blocks don't overlap and no minute is counted twice
+    const breakStart = new Date(now.getTime() - breakDuration * 60000);
+    const breakFrom = `${pad(breakStart.getHours())}:${pad(breakStart.getMinutes())}`;
+    
+    // Save the activity block and, if there was break time, a break block
+    // in one request; the "Break" category is created by name if needed
+    const blocks = [{
+        block_date: blockDate,
+        start_time: startTime,
+        end_time: breakDuration > 0 ? breakFrom : endTime,
+        activity: notes || 'Stopwatch activity',
+        category_id: categoryId,
+        task_id: taskId
+    }];
     
-    // If there was break time, save break blocks
     if (breakDuration > 0) {
-        // Create "Break" category if it doesn't exist, or use existing
-        const categoriesResponse = await fetch('/api/categories');
-        const categories = await categoriesResponse.json();
-        let breakCategory = categories.find(c => c.name === 'Break');
-        
-        if (!breakCategory) {
-            const createResponse = await fetch('/api/categories', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ name: 'Break', color: '#999999' })
-            });
-            const result = await createResponse.json();
-            breakCategory = { id: result.id };
-        }
-        
         // For simplicity, create one break block for total break time
         // In reality, breaks might be scattered throughout - this is an approximation
-        const breakResponse = await fetch('/api/time-blocks', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                block_date: blockDate,
-                start_time: startTime,
-                end_time: endTime,
-                activity: `Break time (deducted from activity)`,
-                category_id: breakCategory.id,
-                task_id: null
-            })
+        blocks.push({
+            block_date: blockDate,
+            start_time: breakFrom,
+            end_time: endTime,
+            activity: 'Break time',
+            category: 'Break',
+            category_color: '#999999'
         });
     }
     
-    if (mainResponse.ok) {
+    const response = await fetch(ROOT + '/api/time-blocks/batch', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        // Time already logged by hand wins; the stopwatch blocks fill around it
+        body: JSON.stringify({ blocks, atomic: true, overlap: 'trim' })
+    });
+    
+    if (response.ok) {
         alert(`Saved! Active time: ${Math.floor(activeDuration / 60)}h ${activeDuration % 60}m${breakDuration > 0 ? `\nBreak time: ${Math.floor(breakDuration / 60)}h ${breakDuration % 60}m` : ''}`);
         resetStopwatch();
         document.getElementById('stopwatchNotes').value = '';
-        await loadTimeBlocks();
+        await reloadUnlessLive(loadCategories, loadTimeBlocks);
     }
 }
 
@@ -1128,26 +1346,4 @@ function pad(num) {
 
 // ====== END STOPWATCH FUNCTIONALITY ======
 
-// Load categories into stopwatch dropdown
-async function loadStopwatchCategories() {
-    const response = await fetch('/api/categories');
-    const categories = await response.json();
-    
-    const select = document.getElementById('stopwatchCategory');
-    select.innerHTML = '<option value="">Select category</option>';
-    
-    categories.forEach(cat => {
-        const option = document.createElement('option');
-        option.value = cat.id;
-        option.textContent = cat.name;
-        select.appendChild(option);
-    });
-}
-
-// Update the initial load
-const originalInit = window.onload;
-window.onload = function() {
-    if (originalInit) originalInit();
-    loadStopwatchCategories();
-};
 
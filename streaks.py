@@ -0,0 +1,178 @@
+"""Habit streaks maintained incrementally from the habit_daily rollup
+
+A day counts towards a streak when at least one of the habit's logs for it
+is completed. habit_streak_runs holds every maximal run of consecutive
+completed days, and habit_streaks the per-habit summary: the length of the
+latest run, the longest run and the last completed day.
+
+Triggers on habit_daily react only when a day flips between completed and
+not completed. Completing a day merges it with the runs ending the day
+before and starting the day after; un-completing one splits the run that
+contains it. Both are a few primary-key lookups, so a new log costs the
+same however long the history is, and editing or deleting an old log only
+touches the runs around its day.
+"""
+import cache
+
+SOURCE = 'habit_logs'
+
+TABLES = (
+    '''
+    CREATE TABLE IF NOT EXISTS habit_streak_runs (
+        habit_id INTEGER NOT NULL,
+        end_date DATE NOT NULL,
+        start_date DATE NOT NULL,
+        length INTEGER NOT NULL,
+        PRIMARY KEY (habit_id, end_date)
+    ) WITHOUT ROWID
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_habit_streak_runs_start ON habit_streak_runs (habit_id, start_date)',
+    'CREATE INDEX IF NOT EXISTS idx_habit_streak_runs_length ON habit_streak_runs (habit_id, length)',
+    '''
+    CREATE TABLE IF NOT EXISTS habit_streaks (
+        habit_id INTEGER PRIMARY KEY,
+        current_streak INTEGER NOT NULL DEFAULT 0,
+        longest_streak INTEGER NOT NULL DEFAULT 0,
+        last_completed_date DATE
+    )
+    ''',
+)
+
+# Statements shared by the triggers; {row} is NEW or OLD. They upsert rather
+# than INSERT OR REPLACE, which the rollup triggers' own upserts would override.
+_COMPLETE = '''
+    INSERT INTO habit_streak_runs (habit_id, end_date, start_date, length)
+    SELECT {row}.habit_id, e, s, CAST(julianday(e) - julianday(s) AS INTEGER) + 1
+    FROM (SELECT
+        COALESCE((SELECT start_date FROM habit_streak_runs
+                  WHERE habit_id = {row}.habit_id AND end_date = date({row}.log_date, '-1 day')),
+                 {row}.log_date) AS s,
+        COALESCE((SELECT end_date FROM habit_streak_runs
+                  WHERE habit_id = {row}.habit_id AND start_date = date({row}.log_date, '+1 day')),
+                 {row}.log_date) AS e)
+    WHERE true
+    ON CONFLICT (habit_id, end_date) DO UPDATE SET start_date = excluded.start_date, length = excluded.length;
+    DELETE FROM habit_streak_runs
+    WHERE habit_id = {row}.habit_id AND end_date = date({row}.log_date, '-1 day');
+'''
+
+_UNCOMPLETE = '''
+    INSERT INTO habit_streak_runs (habit_id, end_date, start_date, length)
+    SELECT habit_id, date({row}.log_date, '-1 day'), start_date,
+           CAST(julianday({row}.log_date) - julianday(start_date) AS INTEGER)
+    FROM (SELECT habit_id, start_date FROM habit_streak_runs
+          WHERE habit_id = {row}.habit_id AND end_date >= {row}.log_date ORDER BY end_date LIMIT 1)
+    WHERE start_date < {row}.log_date;
+    INSERT INTO habit_streak_runs (habit_id, end_date, start_date, length)
+    SELECT habit_id, end_date, date({row}.log_date, '+1 day'),
+           CAST(julianday(end_date) - julianday({row}.log_date) AS INTEGER)
+    FROM (SELECT habit_id, start_date, end_date FROM habit_streak_runs
+          WHERE habit_id = {row}.habit_id AND end_date >= {row}.log_date ORDER BY end_date LIMIT 1)
+    WHERE start_date <= {row}.log_date AND end_date > {row}.log_date
+    ON CONFLICT (habit_id, end_date) DO UPDATE SET start_date = excluded.start_date, length = excluded.length;
+    DELETE FROM habit_streak_runs WHERE habit_id = {row}.habit_id AND end_date = {row}.log_date;
+'''
+
+_SUMMARY = '''
+    INSERT INTO habit_streaks (habit_id, current_streak, longest_streak, last_completed_date)
+    VALUES ({row}.habit_id,
+            COALESCE((SELECT length FROM habit_streak_runs
+                      WHERE habit_id = {row}.habit_id ORDER BY end_date DESC LIMIT 1), 0),
+            COALESCE((SELECT MAX(length) FROM habit_streak_runs WHERE habit_id = {row}.habit_id), 0),
+            (SELECT MAX(end_date) FROM habit_streak_runs WHERE habit_id = {row}.habit_id))
+    ON CONFLICT (habit_id) DO UPDATE SET
+        current_streak = excluded.current_streak,
+        longest_streak = excluded.longest_streak,
+        last_completed_date = excluded.last_completed_date;
+'''
+
+
+def _apply(template, row):
+    return template.format(row=row) + _SUMMARY.format(row=row) + cache.stamp_sql('habit_streaks')
+
+
+TRIGGERS = (
+    ('habit_daily_streak_insert', 'AFTER INSERT',
+     'NEW.habit_id != 0 AND NEW.completed_count > 0', _apply(_COMPLETE, 'NEW')),
+    ('habit_daily_streak_complete', 'AFTER UPDATE',
+     'NEW.habit_id != 0 AND OLD.completed_count <= 0 AND NEW.completed_count > 0', _apply(_COMPLETE, 'NEW')),
+    ('habit_daily_streak_uncomplete', 'AFTER UPDATE',
+     'OLD.habit_id != 0 AND OLD.completed_count > 0 AND NEW.completed_count <= 0', _apply(_UNCOMPLETE, 'OLD')),
+    ('habit_daily_streak_delete', 'AFTER DELETE',
+     'OLD.habit_id != 0 AND OLD.completed_count > 0', _apply(_UNCOMPLETE, 'OLD')),
+)
+
+
+def create(cursor):
+    """Create the streak tables and the triggers that maintain them"""
+    for sql in TABLES:
+        cursor.execute(sql)
+    create_triggers(cursor)
+
+
+def create_triggers(cursor, table=None):
+    """(Re)create the maintenance triggers; `table` is the source table, as in rollups"""
+    if table not in (None, SOURCE):
+        return
+    for name, event, when, body in TRIGGERS:
+        cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+        cursor.execute(f'CREATE TRIGGER {name} {event} ON habit_daily WHEN {when} BEGIN {body} END')
+
+
+def drop_triggers(cursor, table=None):
+    """Drop the maintenance triggers ahead of a bulk load
+
+    Only do this inside a transaction that ends with rebuild() for the
+    affected range and create_triggers(), so a rollback restores them.
+    """
+    if table not in (None, SOURCE):
+        return
+    for name, _, _, _ in TRIGGERS:
+        cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+
+def _touching(cursor, start_date, end_date):
+    """Widen a range until no run crosses or abuts its edges"""
+    while True:
+        cursor.execute('''
+            SELECT MIN(start_date), MAX(end_date) FROM habit_streak_runs
+            WHERE end_date >= date(?, '-1 day') AND start_date <= date(?, '+1 day')
+        ''', (start_date, end_date))
+        first, last = cursor.fetchone()
+        if first is None or (first >= start_date and last <= end_date):
+            return start_date, end_date
+        start_date, end_date = min(first, start_date), max(last, end_date)
+
+
+def rebuild(cursor, start_date=None, end_date=None):
+    """Recompute the runs from habit_daily, optionally only around a date range, then every summary"""
+    if start_date is None:
+        cursor.execute('DELETE FROM habit_streak_runs')
+        where, params = '', ()
+    else:
+        start_date, end_date = _touching(cursor, start_date, end_date)
+        cursor.execute('DELETE FROM habit_streak_runs WHERE end_date BETWEEN ? AND ?', (start_date, end_date))
+        where, params = 'AND log_date BETWEEN ? AND ?', (start_date, end_date)
+
+    # Consecutive completed days share julianday(log_date) - row number
+    cursor.execute(f'''
+        INSERT INTO habit_streak_runs (habit_id, end_date, start_date, length)
+        SELECT habit_id, MAX(log_date), MIN(log_date), COUNT(*)
+        FROM (
+            SELECT habit_id, log_date,
+                   julianday(log_date) - ROW_NUMBER() OVER (PARTITION BY habit_id ORDER BY log_date) AS island
+            FROM habit_daily
+            WHERE habit_id != 0 AND completed_count > 0 {where}
+        )
+        GROUP BY habit_id, island
+    ''', params)
+
+    cursor.execute('DELETE FROM habit_streaks')
+    cursor.execute('''
+        INSERT INTO habit_streaks (habit_id, current_streak, longest_streak, last_completed_date)
+        SELECT r.habit_id, r.length, (SELECT MAX(length) FROM habit_streak_runs WHERE habit_id = r.habit_id),
+               r.end_date
+        FROM habit_streak_runs r
+        WHERE r.end_date = (SELECT MAX(end_date) FROM habit_streak_runs WHERE habit_id = r.habit_id)
+    ''')
+    cache.stamp(cursor, 'habit_streaks')
@@ -0,0 +1,194 @@
+"""Change log for delta sync by offline clients
+
+`changes` holds one entry per row of the data tables that exists or was
+deleted, with a sequence number from a single AUTOINCREMENT counter.
+Triggers replace a row's entry on every insert, update and delete, so the
+entry carries the seq of the row's latest write and deletes leave a
+tombstone. /api/sync?since=<seq> reads the entries past a client's seq in
+seq order and returns the current rows, or their ids for tombstones. That
+costs one index range scan plus a primary-key lookup per changed row,
+however long the history is.
+
+Replacing entries compacts the log as it grows: only a row's latest write
+is kept. Tombstones older than TOMBSTONE_DAYS are dropped as well, and
+`sync_horizon` remembers the newest seq dropped that way. A client that
+last synced before the horizon may have missed deletes, so it is told to
+start over from an empty copy.
+"""
+import time
+
+import clock
+
+TOMBSTONE_DAYS = 90
+COMPACT_EVERY = 1000
+
+# Source table -> (entity name, columns returned for its rows)
+TABLES = {
+    'habits': ('habit', 'id, name, habit_type, target_hours, target_value, target_type, created_at'),
+    'habit_logs': ('habit_log', 'id, habit_id, log_date, hours_spent, value, completed, completion_percentage, notes'),
+    'categories': ('category', 'id, name, color, created_at'),
+    'tasks': ('task', 'id, name, category_id, created_at'),
+    'time_blocks': ('time_block', 'id, block_date, start_time, end_time, activity, duration_minutes, '
+                                  'category_id, task_id'),
+}
+ENTITY_TABLES = {entity: table for table, (entity, _) in TABLES.items()}
+EVENTS = (('INSERT', 'NEW', 0), ('UPDATE', 'NEW', 0), ('DELETE', 'OLD', 1))
+
+# Compaction, given an SQL expression for the cutoff time. Left to itself SQLite
+# answers MAX(seq) by walking the whole log backwards from the newest entry
+# whenever there are no old tombstones, so the index is named.
+_RAISE_HORIZON = '''
+    UPDATE sync_horizon SET seq = MAX(seq, COALESCE(
+        (SELECT MAX(seq) FROM changes INDEXED BY idx_changes_tombstones
+         WHERE deleted AND changed_at < {cutoff}), 0))
+'''
+_DROP_TOMBSTONES = 'DELETE FROM changes WHERE deleted AND changed_at < {cutoff}'
+
+
+class InvalidToken(ValueError):
+    """Raised when a sync token from the query string can't be used"""
+
+
+def create(cursor):
+    """Create the change log, fill it with every existing row and add its triggers"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            changed_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+        )
+    ''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_changes_entity_row ON changes (entity, row_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_changes_tombstones ON changes (changed_at) WHERE deleted')
+    cursor.execute('CREATE TABLE IF NOT EXISTS sync_horizon (seq INTEGER NOT NULL)')
+    cursor.execute('INSERT INTO sync_horizon (seq) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM sync_horizon)')
+    for table, (entity, _) in TABLES.items():
+        cursor.execute(f"INSERT OR IGNORE INTO changes (entity, row_id) SELECT '{entity}', id FROM {table} ORDER BY id")
+    create_compact_trigger(cursor)
+    create_triggers(cursor)
+
+
+def create_compact_trigger(cursor):
+    """(Re)create the trigger sweeping old tombstones every COMPACT_EVERY entries rather than per write"""
+    cursor.execute('DROP TRIGGER IF EXISTS changes_compact')
+    cutoff = f'NEW.changed_at - {TOMBSTONE_DAYS * 86400}'
+    cursor.execute(f'''
+        CREATE TRIGGER changes_compact AFTER INSERT ON changes WHEN NEW.seq % {COMPACT_EVERY} = 0
+        BEGIN
+            {_RAISE_HORIZON.format(cutoff=cutoff)};
+            {_DROP_TOMBSTONES.format(cutoff=cutoff)};
+        END
+    ''')
+
+
+def create_triggers(cursor, table=None):
+    """(Re)create the change log triggers, optionally for one table"""
+    for name, (entity, _) in TABLES.items():
+        if table not in (None, name):
+            continue
+        for event, row, deleted in EVENTS:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}_change_{event.lower()}')
+            # Delete and insert rather than INSERT OR REPLACE, which an outer INSERT OR IGNORE would override
+            cursor.execute(f'''
+                CREATE TRIGGER {name}_change_{event.lower()} AFTER {event} ON {name}
+                BEGIN
+                    DELETE FROM changes WHERE entity = '{entity}' AND row_id = {row}.id;
+                    INSERT INTO changes (entity, row_id, deleted) VALUES ('{entity}', {row}.id, {deleted});
+                END
+            ''')
+
+
+def drop_triggers(cursor, table=None):
+    """Drop the change log triggers ahead of a bulk load; follow with mark_range() and create_triggers()"""
+    for name in TABLES:
+        if table in (None, name):
+            for event, _, _ in EVENTS:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}_change_{event.lower()}')
+
+
+def mark_range(cursor, table, start_date, end_date):
+    """Log every row of a table in a date range as changed, after a bulk load into it"""
+    entity = TABLES[table][0]
+    start_day, end_day = clock.day(start_date), clock.day(end_date)
+    cursor.execute(f'DELETE FROM changes WHERE entity = ? AND row_id IN (SELECT id FROM {table} WHERE day BETWEEN ? AND ?)',
+                   (entity, start_day, end_day))
+    cursor.execute(f'INSERT INTO changes (entity, row_id) SELECT ?, id FROM {table} WHERE day BETWEEN ? AND ? ORDER BY id',
+                   (entity, start_day, end_day))
+
+
+def mark_all(cursor, table):
+    """Log every row of a table as changed, and logged rows it no longer has as deleted, after replacing it"""
+    entity = TABLES[table][0]
+    cursor.execute(f'''
+        INSERT OR REPLACE INTO changes (entity, row_id, deleted)
+        SELECT entity, row_id, 1 FROM changes WHERE entity = ? AND NOT deleted AND row_id NOT IN (SELECT id FROM {table})
+    ''', (entity,))
+    cursor.execute(f'DELETE FROM changes WHERE entity = ? AND row_id IN (SELECT id FROM {table})', (entity,))
+    cursor.execute(f'INSERT INTO changes (entity, row_id) SELECT ?, id FROM {table} ORDER BY id', (entity,))
+
+
+def compact(cursor, days=TOMBSTONE_DAYS):
+    """Drop tombstones older than `days` now; returns how many were dropped"""
+    cutoff = int(time.time()) - days * 86400
+    cursor.execute(_RAISE_HORIZON.format(cutoff='?'), (cutoff,))
+    cursor.execute(_DROP_TOMBSTONES.format(cutoff='?'), (cutoff,))
+    return cursor.rowcount
+
+
+def parse_token(value):
+    """The seq a client asks to sync from; a missing token means a full sync"""
+    if value is None or value == '':
+        return 0
+    try:
+        since = int(value)
+    except ValueError:
+        raise InvalidToken('since must be an integer sync token')
+    if since < 0:
+        raise InvalidToken('since must not be negative')
+    return since
+
+
+def changes_since(cursor, since, limit):
+    """Rows changed after seq `since`, at most `limit` log entries of them
+
+    Returns a dict with the current rows and deleted ids per table, the
+    token to pass as `since` next time, whether more changes are waiting
+    and whether the client must discard its copy first (`reset`). Run it
+    inside a read transaction so the rows match the log entries.
+    """
+    cursor.execute('SELECT seq FROM sync_horizon')
+    horizon = cursor.fetchone()[0]
+    cursor.execute("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'changes'), 0)")
+    latest = cursor.fetchone()[0]
+    # Tombstones were dropped past the client's token, or it is from another database
+    reset = since < horizon or since > latest
+    if reset:
+        since = 0
+
+    cursor.execute('SELECT seq, entity, row_id, deleted FROM changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                   (since, limit + 1))
+    entries = cursor.fetchall()
+    more = len(entries) > limit
+    entries = entries[:limit]
+
+    changed, deleted = {}, {}
+    for _, entity, row_id, is_deleted in entries:
+        table = ENTITY_TABLES[entity]
+        (deleted if is_deleted else changed).setdefault(table, []).append(row_id)
+
+    rows = {}
+    for table, ids in changed.items():
+        columns = TABLES[table][1]
+        placeholders = ', '.join('?' for _ in ids)
+        cursor.execute(f'SELECT {columns} FROM {table} WHERE id IN ({placeholders}) ORDER BY id', ids)
+        rows[table] = [dict(row) for row in cursor.fetchall()]
+
+    return {
+        'since': entries[-1][0] if entries else latest,
+        'more': more,
+        'reset': reset,
+        'changes': rows,
+        'deleted': {table: sorted(ids) for table, ids in deleted.items()},
+    }
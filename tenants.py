@@ -0,0 +1,140 @@
+"""Per-tenant databases: every user's data in a SQLite file of its own
+
+With TENANT_DIR set, each request belongs to a tenant and reads and writes
+only TENANT_DIR/<tenant>.db, its shard. The tenant comes from a /t/<tenant>
+prefix on the path, which the page uses so it works in a browser, or from
+the TENANT_HEADER header, which an authenticating proxy can set. When the
+header is present it decides the tenant, and a prefix naming another one is
+refused, since the client controls the path. Requests with neither are
+refused too; the tenant is not authenticated here.
+
+Everything that was per database already is per shard: the connection
+pools, writer threads and analytics caches are looked up by the request's
+database file (db.database_path()), so routes need no changes. Shards
+don't share a write lock, so writes for different tenants commit in
+parallel, each through its own writer thread. The pools, writers and
+caches of the MAX_OPEN_SHARDS most recently used shards are kept; older
+ones are closed until their tenant is back.
+
+A shard is created and migrated on the first request for its tenant in
+each process. Without TENANT_DIR the app serves DATABASE as before.
+"""
+import glob
+import os
+import re
+import threading
+
+from flask import current_app, g, jsonify, request
+
+import db
+import migrations
+
+TENANT_NAME = re.compile(r'[a-z0-9][a-z0-9_-]{0,63}')
+PREFIX = '/t/'
+
+
+class InvalidTenant(ValueError):
+    """Raised for a tenant name that can't name a shard file"""
+
+
+class PrefixMiddleware:
+    """Move a /t/<tenant> path prefix into SCRIPT_NAME, so routes and url_for work beneath it"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith(PREFIX):
+            tenant, _, rest = path[len(PREFIX):].partition('/')
+            environ['ontrack.tenant'] = tenant
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + PREFIX + tenant
+            environ['PATH_INFO'] = '/' + rest
+        return self.wsgi_app(environ, start_response)
+
+
+def shard_path(tenant):
+    return os.path.join(current_app.config['TENANT_DIR'], f'{tenant}.db')
+
+
+def shards(app):
+    """(tenant, path) of every shard in the app's TENANT_DIR"""
+    paths = sorted(glob.glob(os.path.join(app.config['TENANT_DIR'], '*.db')))
+    tenants = (os.path.basename(path)[:-len('.db')] for path in paths)
+    return [(tenant, path) for tenant, path in zip(tenants, paths) if TENANT_NAME.fullmatch(tenant)]
+
+
+_migrate_lock = threading.Lock()
+
+
+def _open(path):
+    """Create or migrate a shard the first time this process uses it"""
+    ready = current_app.extensions['ontrack_tenants']
+    if path in ready:
+        return
+    with _migrate_lock:
+        if path not in ready:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            conn = db.connect(path, current_app.config['DB_PRAGMAS'])
+            try:
+                migrations.migrate(conn)
+            finally:
+                conn.close()
+            ready.add(path)
+
+
+def migrate_all(app):
+    """Bring every existing shard up to date; run it with setup_database() before workers start"""
+    with app.app_context():
+        for _, path in shards(app):
+            _open(path)
+
+
+def use(tenant):
+    """Point the current app context at a tenant's shard, creating it if needed"""
+    if not TENANT_NAME.fullmatch(tenant or ''):
+        raise InvalidTenant('Tenant names are 1-64 lowercase letters, digits, - or _, '
+                            'starting with a letter or digit')
+    if not current_app.config['TENANT_DIR']:
+        raise InvalidTenant('Tenants need ONTRACK_TENANT_DIR to be set')
+    g.tenant = tenant
+    g.database = shard_path(tenant)
+    _open(g.database)
+
+
+def _route():
+    """Point the request at its tenant's shard"""
+    if request.endpoint in current_app.config['TENANT_EXEMPT']:
+        return None
+    header = current_app.config['TENANT_HEADER']
+    tenant = request.headers.get(header)
+    prefixed = request.environ.get('ontrack.tenant')
+    if tenant and prefixed and prefixed != tenant:
+        return jsonify({'success': False, 'error': f'{PREFIX}{prefixed}/ does not match the {header} header'}), 403
+    tenant = tenant or prefixed
+    if not tenant:
+        return jsonify({'success': False, 'error': f'No tenant: use {PREFIX}<tenant>/ or the {header} header'}), 400
+    try:
+        use(tenant)
+    except InvalidTenant as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return None
+
+
+def _vary(response):
+    # The same URL holds different data for each tenant named in the header
+    response.vary.add(current_app.config['TENANT_HEADER'])
+    return response
+
+
+def init_app(app):
+    """Register the tenancy settings and, with TENANT_DIR set, route requests to shards"""
+    app.config.setdefault('TENANT_DIR', os.environ.get('ONTRACK_TENANT_DIR', ''))
+    app.config.setdefault('TENANT_HEADER', os.environ.get('ONTRACK_TENANT_HEADER', 'X-OnTrack-Tenant'))
+    # Endpoints that aren't about any one tenant's data
+    app.config.setdefault('TENANT_EXEMPT', {'static', 'ontrack.prometheus_metrics'})
+    app.extensions['ontrack_tenants'] = set()
+    if app.config['TENANT_DIR']:
+        app.wsgi_app = PrefixMiddleware(app.wsgi_app)
+        app.before_request(_route)
+        app.after_request(_vary)
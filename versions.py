@@ -0,0 +1,66 @@
+"""Per-table change counters used to build ETags for read endpoints
+
+table_versions holds one counter per data table. Triggers bump it on every
+insert, update and delete, so any write path invalidates the ETags of the
+endpoints that read that table, and validating an ETag only ever reads
+this one small table.
+"""
+import hashlib
+from datetime import date
+
+TABLES = ('habits', 'habit_logs', 'categories', 'tasks', 'time_blocks')
+EVENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+def create(cursor):
+    """Create the counters table and the triggers that bump it"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    cursor.executemany('INSERT OR IGNORE INTO table_versions (name) VALUES (?)',
+                       [(table,) for table in TABLES])
+    create_triggers(cursor)
+
+
+def create_triggers(cursor, table=None):
+    """(Re)create the bump triggers, optionally for one table"""
+    for name in TABLES:
+        if table in (None, name):
+            for event in EVENTS:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}_version_{event.lower()}')
+                cursor.execute(f'''
+                    CREATE TRIGGER {name}_version_{event.lower()} AFTER {event} ON {name}
+                    BEGIN
+                        UPDATE table_versions SET version = version + 1 WHERE name = '{name}';
+                    END
+                ''')
+
+
+def drop_triggers(cursor, table=None):
+    """Drop the bump triggers ahead of a bulk load; follow with bump() and create_triggers()"""
+    for name in TABLES:
+        if table in (None, name):
+            for event in EVENTS:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}_version_{event.lower()}')
+
+
+def bump(cursor, table):
+    """Record a change to a table written with its triggers suspended"""
+    cursor.execute('UPDATE table_versions SET version = version + 1 WHERE name = ?', (table,))
+
+
+def etag(conn, tables, key=''):
+    """Build a strong ETag from the tables' counters and a per-resource key
+
+    The current date is mixed in because several endpoints default their
+    date range to today.
+    """
+    placeholders = ', '.join('?' for _ in tables)
+    rows = conn.execute(f'SELECT name, version FROM table_versions WHERE name IN ({placeholders}) ORDER BY name',
+                        tables).fetchall()
+    state = ';'.join(f'{name}={version}' for name, version in rows)
+    digest = hashlib.blake2b(f'{state}|{key}|{date.today()}'.encode(), digest_size=12)
+    return digest.hexdigest()
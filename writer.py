@@ -0,0 +1,321 @@
+"""Single writer thread that group-commits the app's writes
+
+Write routes hand their writes to a WriteQueue as jobs, functions taking
+a connection, instead of committing on their own connection. One thread
+per process owns the only writing connection. It takes every job waiting
+in the queue, up to WRITE_BATCH_SIZE of them, waiting at most
+WRITE_FLUSH_MS after the first one for more to arrive, and runs them in a
+single transaction with one commit. Concurrent requests then never
+contend for SQLite's write lock inside a worker, and a burst of writes
+costs one commit instead of one each.
+
+Every job runs in its own savepoint, so a job that raises undoes only its
+own writes and its caller gets the exception. Callers get a job's return
+value, or its exception, through a Future once the transaction holding it
+has committed. A job can also raise Rollback to undo its writes and still
+return a value, like an atomic batch reporting which items failed.
+
+Jobs run on the writer thread, outside the request: they must take what
+they need from the request as arguments, and must not commit or roll
+back themselves. Gunicorn workers each have their own writer and still
+meet at the database's lock, waiting up to busy_timeout for each other.
+
+A WRITE_BATCH_SIZE of 0 disables the queue: jobs then run on the request's
+own connection, each in its own transaction.
+"""
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app
+
+import db
+
+log = logging.getLogger('ontrack.writer')
+
+
+class WriterClosed(RuntimeError):
+    """Raised when submitting to a writer that was closed"""
+
+
+class Rollback(Exception):
+    """Raised by a job to undo its own writes and still return `value` to its caller"""
+
+    def __init__(self, value):
+        super().__init__(value)
+        self.value = value
+
+
+class WriteFuture(Future):
+    """Future of a queued job; `stats` holds the job's share of the SQL statistics"""
+
+    stats = (0, 0.0, 0, 0)
+
+
+class _Job:
+    __slots__ = ('future', 'function', 'args', 'value', 'error')
+
+    def __init__(self, function, args):
+        self.future = WriteFuture()
+        self.function = function
+        self.args = args
+        self.value = None
+        self.error = None
+
+
+def _stats(conn):
+    return conn.statements, conn.sql_time, conn.rows, conn.slow
+
+
+class WriteQueue:
+    """A writer thread with its own connection, committing queued jobs in groups"""
+
+    def __init__(self, path, flush=0.0, batch_size=64, pragmas=db.PRAGMAS, slow_query=None):
+        self.path = path
+        self.flush = flush
+        self.batch_size = batch_size
+        self.pragmas = pragmas
+        self.slow_query = slow_query
+        self.jobs = 0
+        self.batches = 0
+        self.failed_commits = 0
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='ontrack-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, function, *args):
+        """Queue `function(conn, *args)` to run in the next group; returns its Future"""
+        if self._closed:
+            raise WriterClosed('The database writer is closed')
+        job = _Job(function, args)
+        self._queue.put(job)
+        return job.future
+
+    def close(self, timeout=None):
+        """Run the jobs already queued, then stop the thread"""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {'jobs': self.jobs, 'batches': self.batches, 'failed_commits': self.failed_commits,
+                'queued': self._queue.qsize()}
+
+    def _collect(self, first):
+        """The first job and whatever else arrives within the flush window; None marks a close"""
+        batch = [first]
+        deadline = time.monotonic() + self.flush
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                job = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(job)
+            if job is None:
+                break
+        return batch
+
+    def _run(self):
+        conn = db.connect(self.path, self.pragmas, self.slow_query)
+        try:
+            while True:
+                batch = self._collect(self._queue.get())
+                closing = batch[-1] is None
+                jobs = [job for job in batch if job is not None and job.future.set_running_or_notify_cancel()]
+                if jobs:
+                    try:
+                        self._commit(conn, jobs)
+                    except Exception as e:
+                        # A broken connection must not leave callers waiting forever
+                        if conn.in_transaction:
+                            conn.rollback()
+                        self._resolve([job for job in jobs if not job.future.done()], e)
+                if closing:
+                    break
+        finally:
+            conn.close()
+
+    def _commit(self, conn, jobs):
+        pending = jobs
+        while pending:
+            pending = self._transaction(conn, pending)
+
+    def _transaction(self, conn, jobs):
+        """Run jobs in one transaction and resolve their futures; returns jobs left for another"""
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.Error as e:
+            self._resolve(jobs, e)
+            return []
+
+        done = []
+        for i, job in enumerate(jobs):
+            conn.execute('SAVEPOINT job')
+            before = _stats(conn)
+            try:
+                job.value = job.function(conn, *job.args)
+            except Rollback as e:
+                job.value = e.value
+                error = None
+            except Exception as e:
+                job.error = error = e
+            else:
+                job.future.stats = tuple(b - a for a, b in zip(before, _stats(conn)))
+                conn.execute('RELEASE job')
+                done.append(job)
+                continue
+
+            if not conn.in_transaction:
+                # Some errors roll back the whole transaction: the jobs before this one are lost too
+                self._resolve(done + [job], error or sqlite3.OperationalError('transaction rolled back'))
+                return jobs[i + 1:]
+            job.future.stats = tuple(b - a for a, b in zip(before, _stats(conn)))
+            conn.execute('ROLLBACK TO job')
+            conn.execute('RELEASE job')
+            done.append(job)
+
+        started = time.perf_counter()
+        try:
+            conn.commit()
+        except sqlite3.Error as e:
+            self.failed_commits += 1
+            if conn.in_transaction:
+                conn.rollback()
+            self._resolve(done, e)
+            return []
+        share = (time.perf_counter() - started) / len(done)
+
+        self.jobs += len(done)
+        self.batches += 1
+        for job in done:
+            statements, sql_time, rows, slow = job.future.stats
+            job.future.stats = (statements, sql_time + share, rows, slow)
+            if job.error is not None:
+                job.future.set_exception(job.error)
+            else:
+                job.future.set_result(job.value)
+        return []
+
+    def _resolve(self, jobs, error):
+        log.warning('Write transaction of %d jobs failed: %s', len(jobs), error)
+        for job in jobs:
+            job.future.set_exception(error)
+
+
+_writers_lock = threading.Lock()
+
+
+def get_writer():
+    """Return the app's writer for its current database, starting it on first use"""
+    app = current_app._get_current_object()
+    writers = app.extensions['ontrack_writer']
+    path = db.database_path()
+    writer = writers.get(path)
+    if writer is None:
+        with _writers_lock:
+            writer = writers.get(path)
+            if writer is None:
+                writer = writers[path] = WriteQueue(path,
+                                                    flush=app.config['WRITE_FLUSH_MS'] / 1000,
+                                                    batch_size=app.config['WRITE_BATCH_SIZE'],
+                                                    pragmas=app.config['DB_PRAGMAS'],
+                                                    slow_query=app.config['SLOW_QUERY_MS'] / 1000 or None)
+    return writer
+
+
+def _run_inline(conn, function, args):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        value = function(conn, *args)
+    except Rollback as e:
+        conn.rollback()
+        return e.value
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    return value
+
+
+def run(function, *args):
+    """Run `function(conn, *args)` as a write and return its result once committed
+
+    Raises what the job raised. The job's statements and its share of the
+    commit are counted towards the request's SQL metrics.
+    """
+    conn = db.get_db()
+    if current_app.config['WRITE_BATCH_SIZE'] <= 0:
+        return _run_inline(conn, function, args)
+
+    while True:
+        try:
+            future = get_writer().submit(function, *args)
+            break
+        except WriterClosed:
+            # Its shard was evicted between the lookup and the submit; the next lookup starts a new writer
+            continue
+    try:
+        value = future.result(current_app.config['WRITE_TIMEOUT'])
+    except TimeoutError:
+        # A job that already started will commit, so its caller must wait for it
+        if future.cancel():
+            raise RuntimeError('Timed out waiting for the database writer')
+        value = future.result()
+    finally:
+        if future.done() and not future.cancelled():
+            statements, sql_time, rows, slow = future.stats
+            conn.statements += statements
+            conn.sql_time += sql_time
+            conn.rows += rows
+            conn.slow += slow
+    return value
+
+
+def _execute(conn, statements):
+    cursor = conn.cursor()
+    for sql, params in statements:
+        cursor.execute(sql, params)
+    return cursor.lastrowid
+
+
+def execute(*statements):
+    """Run (sql, params) pairs as one write; returns the last one's lastrowid"""
+    return run(_execute, statements)
+
+
+def close_writers(app):
+    """Finish the queued writes of every writer the app started and stop them"""
+    for writer in app.extensions.get('ontrack_writer', {}).values():
+        writer.close()
+    app.extensions['ontrack_writer'] = {}
+
+
+def total_stats():
+    """The counters of the app's writers for every open database, added up"""
+    totals = dict.fromkeys(('jobs', 'batches', 'failed_commits', 'queued'), 0)
+    for writer in list(current_app.extensions['ontrack_writer'].values()):
+        for key, value in writer.stats().items():
+            totals[key] += value
+    return totals
+
+
+def _evict(app, path):
+    writer = app.extensions['ontrack_writer'].pop(path, None)
+    if writer is not None:
+        writer.close()
+
+
+def init_app(app):
+    """Register the write queue settings on the app"""
+    app.config.setdefault('WRITE_BATCH_SIZE', int(os.environ.get('ONTRACK_WRITE_BATCH_SIZE', 64)))
+    app.config.setdefault('WRITE_FLUSH_MS', float(os.environ.get('ONTRACK_WRITE_FLUSH_MS', 0)))
+    app.config.setdefault('WRITE_TIMEOUT', float(os.environ.get('ONTRACK_WRITE_TIMEOUT', 30)))
+    app.extensions['ontrack_writer'] = {}
+    db.on_evict(app, _evict)